@@ -0,0 +1,69 @@
+import asyncio
+
+# A failed apply is retried after this many seconds, doubling up to the max.
+RETRY_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+
+
+class ApplyScheduler:
+    """Coalesces bursts of peer updates into a single WireGuard apply.
+
+    submit() only records the latest desired state. The run() loop waits
+    `window` seconds after the first update of a burst, renders the newest
+    state, skips the apply if the rendered config equals the last applied
+    one, and otherwise runs the apply in a worker thread so subprocess calls
+    never block the event loop. A failed apply is retried with backoff unless
+    a newer state has arrived meanwhile."""
+
+    def __init__(self, render, apply, same, window=0.5):
+        self.render = render  # state -> config text
+        self.apply = apply  # (config, state) -> None, runs off the event loop
+        self.same = same  # (config_a, config_b) -> bool
+        self.window = window
+        self.pending = None
+        self.last_config = None
+        self.wakeup = asyncio.Event()
+        self.events_received = 0
+        self.applies_performed = 0
+        self.applies_skipped = 0
+        self.applies_failed = 0
+        self.retry_delay = RETRY_DELAY
+
+    def counters(self):
+        return {
+            'events_received': self.events_received,
+            'applies_performed': self.applies_performed,
+            'applies_skipped': self.applies_skipped,
+            'applies_failed': self.applies_failed,
+        }
+
+    def submit(self, state):
+        self.events_received += 1
+        self.pending = state
+        self.wakeup.set()
+
+    async def run(self):
+        while True:
+            await self.wakeup.wait()
+            if self.window > 0:
+                await asyncio.sleep(self.window)
+            self.wakeup.clear()
+            state, self.pending = self.pending, None
+            config = self.render(state)
+            if self.last_config is not None and self.same(config, self.last_config):
+                self.applies_skipped += 1
+                continue
+            try:
+                await asyncio.to_thread(self.apply, config, state)
+            except Exception as e:
+                self.applies_failed += 1
+                print(f'Error applying WireGuard config: {e}. Retrying in {self.retry_delay:.0f}s.')
+                if self.pending is None:
+                    self.pending = state
+                await asyncio.sleep(self.retry_delay)
+                self.retry_delay = min(self.retry_delay * 2, RETRY_MAX_DELAY)
+                self.wakeup.set()
+                continue
+            self.retry_delay = RETRY_DELAY
+            self.last_config = config
+            self.applies_performed += 1
@@ -0,0 +1,107 @@
+# Startup latency of STUN discovery with local stand-in STUN servers.
+#
+# Starts a few RFC 5389 responders on loopback, the first of which never
+# answers (an unreachable or overloaded server), plus one that reports a
+# different mapping the way a symmetric NAT would. Compares a serial client
+# that tries servers one after another with a per-server timeout (what
+# stun.get_ip_info does against its server list) against discovery.discover,
+# and checks the NAT classification for each server mix.
+#
+# Run from the repo root:  python -m benchmarks.bench_discovery
+import asyncio
+import socket
+import struct
+import time
+
+import discovery
+
+SERIAL_TIMEOUT = 2.0
+
+
+class Responder(asyncio.DatagramProtocol):
+    """Answers binding requests with the source address, optionally shifted
+    by `port_offset`, or not at all when `silent`."""
+
+    def __init__(self, silent=False, port_offset=0):
+        self.silent = silent
+        self.port_offset = port_offset
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if self.silent or len(data) < 20:
+            return
+        _, _, cookie, transaction_id = struct.unpack_from('!HHI12s', data)
+        ip, port = addr
+        port = (port + self.port_offset) & 0xFFFF
+        value = struct.pack(
+            '!BBH4s', 0, 1, port ^ (discovery.MAGIC_COOKIE >> 16),
+            (int.from_bytes(socket.inet_aton(ip), 'big') ^ discovery.MAGIC_COOKIE).to_bytes(4, 'big'),
+        )
+        attribute = struct.pack('!HH', discovery.ATTR_XOR_MAPPED_ADDRESS, len(value)) + value
+        header = struct.pack('!HHI12s', discovery.BINDING_SUCCESS, len(attribute), cookie, transaction_id)
+        self.transport.sendto(header + attribute, addr)
+
+
+async def start_responders(specs):
+    loop = asyncio.get_running_loop()
+    servers, transports = [], []
+    for silent, port_offset in specs:
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: Responder(silent, port_offset), local_addr=('127.0.0.1', 0)
+        )
+        servers.append('127.0.0.1:%d' % transport.get_extra_info('sockname')[1])
+        transports.append(transport)
+    return servers, transports
+
+
+def serial_lookup(servers):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(SERIAL_TIMEOUT)
+    try:
+        for server in servers:
+            transaction_id = b'serial-probe'
+            sock.sendto(discovery.binding_request(transaction_id), discovery.parse_server(server))
+            try:
+                parsed = discovery.parse_binding_response(sock.recv(2048))
+            except socket.timeout:
+                continue
+            if parsed:
+                return parsed[1]
+    finally:
+        sock.close()
+
+
+async def main():
+    servers, transports = await start_responders([(True, 0), (False, 0), (False, 0), (False, 0)])
+    started = time.perf_counter()
+    await asyncio.to_thread(serial_lookup, servers)
+    serial = time.perf_counter() - started
+
+    started = time.perf_counter()
+    result = await discovery.discover(0, servers, use_cache=False)
+    parallel = time.perf_counter() - started
+
+    started = time.perf_counter()
+    await discovery.discover(0, servers)
+    await discovery.discover(0, servers)
+    cached = (time.perf_counter() - started) / 2
+
+    print(f"{len(servers)} servers, first one silent")
+    print(f"{'serial':>10}: {serial * 1000:8.1f} ms")
+    print(f"{'parallel':>10}: {parallel * 1000:8.1f} ms  -> {result.external_ip}:{result.external_port} ({result.nat_type})")
+    print(f"{'cached':>10}: {cached * 1000:8.3f} ms")
+
+    symmetric, more = await start_responders([(False, 0), (False, 7)])
+    result = await discovery.discover(0, symmetric, timeout=1, use_cache=False)
+    print(f"mappings disagree: {result.nat_type}")
+    silent, more2 = await start_responders([(True, 0), (True, 0)])
+    result = await discovery.discover(0, silent, timeout=1, use_cache=False)
+    print(f"no answers:        {result.nat_type}")
+    for transport in transports + more + more2:
+        transport.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
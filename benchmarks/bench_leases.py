@@ -0,0 +1,51 @@
+# Cost of peer leases on the coordinator.
+#
+# renew:   one heartbeat (LeaseWheel.renew) with this many leases live.
+# tick:    one expiry tick with nothing due. It still sweeps the stale
+#          entries renewals left in that slot, so it scales with the
+#          renewal rate (here every lease renewed once per TTL), not with
+#          the number of leases.
+# expire:  the tick that expires every lease at once, the batch a
+#          coordinator sees after a network partition.
+# renew and the per-lease expiry cost should stay flat as leases grow.
+#
+# Run from the repo root:  python -m benchmarks.bench_leases
+import time
+
+from coord_server.leases import LeaseWheel
+
+SIZES = [1_000, 10_000, 100_000]
+TTL = 90.0
+
+
+def bench(size):
+    wheel = LeaseWheel(TTL)
+    now = 1_000_000.0
+    for i in range(size):
+        wheel.renew("g", str(i), now + TTL * (i + 1) / size)
+    wheel.advance(now)
+
+    start = time.perf_counter()
+    for i in range(size):
+        wheel.renew("g", str(i), now + TTL)
+    renew_us = (time.perf_counter() - start) / size * 1e6
+
+    start = time.perf_counter()
+    wheel.advance(now + 1)
+    tick_us = (time.perf_counter() - start) * 1e6
+
+    start = time.perf_counter()
+    expired = wheel.advance(now + TTL + 1)
+    burst_ms = (time.perf_counter() - start) * 1e3
+    assert len(expired["g"]) == size
+    print(f"{size:>7} leases  renew {renew_us:5.2f} us  tick {tick_us:7.1f} us  "
+          f"expire all {burst_ms:7.1f} ms ({burst_ms / size * 1e3:.2f} us/lease)")
+
+
+def main():
+    for size in SIZES:
+        bench(size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+# Scaling benchmark for the multi-queue, multi-worker data plane.
+#
+# Starts 1..N WorkerPool workers (one SO_REUSEPORT socket each, plus one
+# queue of a multi-queue TUN device when run as root) and blasts framed
+# packets at them from many UDP flows. Each worker does what peer_vpn's
+# udp_listener does: batched receive, framing-byte dispatch and a write into
+# its TUN queue. The packets are addressed to TEST-NET so the kernel drops
+# them after the TUN write.
+#
+# Throughput only scales with the number of cores available; the output
+# prints how many this box has.
+#
+# Run from the repo root:  python -m benchmarks.bench_multiqueue [max_workers]
+import multiprocessing
+import os
+import socket
+import struct
+import sys
+import time
+
+from batch_io import BatchReceiver, BatchSender, FRAME_DATA
+from multiqueue import WorkerPool, configure_tun, open_tun_queues
+
+PORT = 54398
+DURATION = 3.0
+SENDERS = 2
+FLOWS_PER_SENDER = 8
+PACKET_SIZE = 1400
+
+
+def ip_packet(size):
+    packet = bytearray(size)
+    packet[0] = 0x45
+    packet[16:20] = socket.inet_aton('192.0.2.1')
+    return bytes(packet)
+
+
+def sender(stop_at):
+    payload = ip_packet(PACKET_SIZE)
+    flows = []
+    for _ in range(FLOWS_PER_SENDER):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        flows.append(BatchSender(sock))
+    while time.time() < stop_at:
+        for tx in flows:
+            while True:
+                buf = tx.buffer()
+                if buf is None:
+                    break
+                buf[0] = FRAME_DATA
+                buf[1:1 + PACKET_SIZE] = payload
+                tx.commit(1 + PACKET_SIZE, ('127.0.0.1', PORT))
+            try:
+                tx.flush()
+            except OSError:
+                pass
+
+
+def receiver(index, sock, tun_fd, conn):
+    # Wake up periodically so the worker notices the end of the run.
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, struct.pack('ll', 0, 200000))
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 << 20)
+    stop_at = conn.recv()
+    rx = BatchReceiver(sock)
+    packets = 0
+    while time.time() < stop_at:
+        try:
+            frames = rx.recv()
+        except OSError:
+            continue
+        for frame, _ in frames:
+            if frame[0] == FRAME_DATA:
+                packets += 1
+                if tun_fd is not None:
+                    try:
+                        os.write(tun_fd, frame[1:])
+                    except OSError:
+                        pass
+    conn.send(packets)
+
+
+def run(workers):
+    if os.geteuid() == 0:
+        name, fds = open_tun_queues('mqbench%d', workers)
+        configure_tun(name, '10.232.0.1', '255.255.255.0')
+    else:
+        fds = [None] * workers
+    pool = WorkerPool(fds, PORT, receiver)
+    time.sleep(0.3)
+    stop_at = time.time() + DURATION
+    pool.publish(stop_at)
+    ctx = multiprocessing.get_context('fork')
+    senders = [ctx.Process(target=sender, args=(stop_at,)) for _ in range(SENDERS)]
+    for process in senders:
+        process.start()
+    total = sum(conn.recv() for conn in pool.conns)
+    for process in senders:
+        process.join()
+    pool.join()
+    return total / DURATION
+
+
+def main():
+    cpus = len(os.sched_getaffinity(0))
+    max_workers = int(sys.argv[1]) if len(sys.argv) > 1 else max(2, cpus)
+    print(f"{cpus} cpu(s) available, {SENDERS * FLOWS_PER_SENDER} flows, {PACKET_SIZE} byte packets")
+    base = None
+    workers = 1
+    while workers <= max_workers:
+        pps = run(workers)
+        base = base or pps
+        print(f"{workers:>3} workers: {pps:>12,.0f} pps  ({pps / base:.2f}x)")
+        workers *= 2
+
+
+if __name__ == "__main__":
+    main()
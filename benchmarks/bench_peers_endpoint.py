@@ -0,0 +1,62 @@
+# What GET /peers/{group} costs the coordinator per poll.
+#
+# uncached: what the handler used to do on every call: FastAPI's
+#           jsonable_encoder over the peer dicts plus json.dumps.
+# cached:   a SnapshotCache hit for an unchanged revision (the body is
+#           reused as is); a 304 costs the same without the body.
+# Also prints the body size per format and encoding.
+#
+# Run from the repo root:  python -m benchmarks.bench_peers_endpoint
+import json
+import time
+
+from fastapi.encoders import jsonable_encoder
+
+from coord_server.registry import GroupRegistry
+from coord_server.snapshots import JSON, RECORDS, SnapshotCache
+from wgkeys import generate_keypair
+
+SIZES = [100, 1_000, 10_000]
+SUBNET = "10.0.0.0/16"
+ROUNDS = 50
+
+
+def fill(size):
+    registry = GroupRegistry(SUBNET)
+    for i in range(size):
+        registry.add(f"peer{i}", generate_keypair()[1], f"198.51.{i // 256 % 256}.{i % 256}", 51820)
+    return registry
+
+
+def per_call_us(fn, rounds=ROUNDS):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - start) / rounds * 1e6
+
+
+def bench(size):
+    registry = fill(size)
+    cache = SnapshotCache(lambda group: registry.values())
+    cache.get("g", "epoch", 1)
+
+    def uncached():
+        json.dumps(jsonable_encoder(list(registry.values())))
+
+    def cached():
+        cache.get("g", "epoch", 1).body(JSON, compressed=True)
+
+    snapshot = cache.get("g", "epoch", 1)
+    sizes = {f"{name}{' gz' if gz else ''}": len(snapshot.body(fmt, gz))
+             for name, fmt in (("json", JSON), ("records", RECORDS)) for gz in (False, True)}
+    print(f"{size:>6} peers  uncached {per_call_us(uncached):10.0f} us  cached {per_call_us(cached):6.1f} us  "
+          + "  ".join(f"{name} {value / 1024:.0f}K" for name, value in sizes.items()))
+
+
+def main():
+    for size in SIZES:
+        bench(size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+# Micro-benchmark for the coordinator's peer registry.
+#
+# Times register (lookup + allocate), endpoint update and leave against groups
+# of increasing size. With hash indexes and the free-list allocator the
+# per-operation cost should stay flat from 100 to 10k peers.
+#
+# Run from the repo root:  python -m benchmarks.bench_registry
+import random
+import time
+
+from coord_server.registry import GroupRegistry
+
+SIZES = [100, 1_000, 10_000]
+OPS = 20_000
+SUBNET = "10.0.0.0/16"
+
+
+def fill(size):
+    registry = GroupRegistry(SUBNET)
+    for i in range(size):
+        registry.add(f"peer{i}", f"key{i}", f"198.51.{i // 256 % 256}.{i % 256}", 51820)
+    return registry
+
+
+def per_op_us(fn, ops=OPS):
+    start = time.perf_counter()
+    for i in range(ops):
+        fn(i)
+    return (time.perf_counter() - start) / ops * 1e6
+
+
+def bench(size):
+    registry = fill(size)
+    ids = list(registry.peers)
+    rng = random.Random(size)
+
+    def register(i):
+        # Re-registration of an existing peer, then a brand new one that
+        # leaves again so the group size stays constant.
+        peer = registry.get(ids[rng.randrange(len(ids))])
+        registry.find(peer["public_key"], peer["external_ip"], peer["external_port"])
+        new = registry.add("churn", f"churn{i}", "203.0.113.1", 40000 + i % 20000)
+        registry.remove(new["peer_id"])
+
+    def update(i):
+        registry.set_endpoint(ids[rng.randrange(len(ids))], "203.0.113.7", 30000 + i % 30000)
+
+    def leave(i):
+        peer = registry.find_by_key(f"key{rng.randrange(size)}")
+        if peer:
+            registry.remove(peer["peer_id"])
+            registry.add(peer["name"], peer["public_key"], peer["external_ip"], peer["external_port"],
+                         peer_id=peer["peer_id"])
+
+    return per_op_us(register), per_op_us(update), per_op_us(leave)
+
+
+def main():
+    print(f"{'peers':>8} {'register us':>12} {'update us':>10} {'leave us':>10}")
+    for size in SIZES:
+        register, update, leave = bench(size)
+        print(f"{size:>8} {register:>12.2f} {update:>10.2f} {leave:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+# Load benchmark for coord_server.relay.
+#
+# Opens SESSIONS relay sessions in one process (a single asyncio loop, as in
+# the coordinator) and drives them from a second process holding two local
+# UDP sockets per session. Every session first learns both sides, then the
+# client sends packets round-robin across all sessions from the A side. The
+# relay reports how many it forwarded and the CPU time it used, so the
+# packets per CPU-second figure holds even when both processes share a core.
+#
+# Run from the repo root:  python -m benchmarks.bench_relay [sessions]
+import asyncio
+import multiprocessing
+import os
+import resource
+import socket
+import sys
+import time
+
+from coord_server.relay import Relay
+
+SESSIONS = 2000
+PACKET_SIZE = 1200
+DURATION = 5.0
+PORTS = '41000-44999'
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def relay_process(sessions, rate, conn):
+    async def main():
+        relay = Relay(host='127.0.0.1', bind='127.0.0.1', ports=PORTS, rate=rate, burst=max(rate, PACKET_SIZE))
+        ports = []
+        for i in range(sessions):
+            endpoint = relay.open('bench', f'a{i}', f'b{i}', '127.0.0.1', '127.0.0.1')
+            ports.append(int(endpoint.rsplit(':', 1)[1]))
+        conn.send(ports)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, conn.recv)  # load starts
+        before, start_stats = cpu_seconds(), relay.stats()
+        await loop.run_in_executor(None, conn.recv)  # load finished
+        stats = relay.stats()
+        stats = {key: stats[key] - start_stats[key] for key in ('packets', 'bytes', 'dropped')}
+        conn.send((stats, cpu_seconds() - before))
+
+    asyncio.run(main())
+
+
+def client(ports, duration, conn):
+    payload = bytes(PACKET_SIZE)
+    pairs = []
+    for port in ports:
+        a = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        b = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        a.bind(('127.0.0.1', 0))
+        b.bind(('127.0.0.1', 0))
+        # Teach the relay both sides: A first, then B (forwarded to A).
+        a.sendto(b'hello', ('127.0.0.1', port))
+        pairs.append((a, b, ('127.0.0.1', port)))
+    time.sleep(0.5)
+    for a, b, dest in pairs:
+        b.sendto(b'hello', dest)
+    time.sleep(0.5)
+    conn.send('start')
+    sent = 0
+    started = time.perf_counter()
+    deadline = started + duration
+    while time.perf_counter() < deadline:
+        for a, _, dest in pairs:
+            try:
+                a.sendto(payload, dest)
+                sent += 1
+            except OSError:
+                pass
+    elapsed = time.perf_counter() - started
+    time.sleep(0.5)
+    for a, b, _ in pairs:
+        a.close()
+        b.close()
+    return sent, elapsed
+
+
+def run(sessions, rate):
+    ctx = multiprocessing.get_context('fork')
+    parent, child = ctx.Pipe()
+    relay = ctx.Process(target=relay_process, args=(sessions, rate, child))
+    relay.start()
+    ports = parent.recv()
+    sent, elapsed = client(ports, DURATION, parent)
+    parent.send('done')
+    stats, cpu = parent.recv()
+    relay.join()
+    return sent, elapsed, stats, cpu
+
+
+def main():
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    sessions = int(sys.argv[1]) if len(sys.argv) > 1 else SESSIONS
+    print(f"{sessions} sessions, {PACKET_SIZE} byte packets, {os.cpu_count()} cpu(s)")
+    sent, elapsed, stats, cpu = run(sessions, 1 << 40)
+    forwarded = stats['packets']
+    print(f"client sent:     {sent / elapsed:>12,.0f} pps")
+    print(f"relay forwarded: {forwarded / elapsed:>12,.0f} pps  "
+          f"{stats['bytes'] * 8 / elapsed / 1e6:>8,.0f} Mbit/s  ({stats['dropped']} dropped)")
+    print(f"relay CPU:       {cpu:>12.2f} s  -> {forwarded / cpu:,.0f} packets per CPU-second")
+
+    # Rate limiting: 100 KB/s per session should cap the total accordingly.
+    rate = 100_000
+    sent, elapsed, stats, cpu = run(min(sessions, 200), rate)
+    cap = rate * min(sessions, 200) * elapsed + min(sessions, 200) * max(rate, PACKET_SIZE)
+    print(f"rate limited:    {stats['bytes']:,} bytes forwarded (cap {cap:,.0f}), {stats['dropped']:,} dropped")
+
+
+if __name__ == '__main__':
+    main()
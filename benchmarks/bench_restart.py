@@ -0,0 +1,80 @@
+# Measures coordinator startup cost with the durable log store.
+#
+# Writes 100k peer registrations (plus endpoint churn) through LogStore, then
+# times a cold start that replays the raw log, and a cold start after the log
+# was compacted into a snapshot. "rebuild" is the time to load the result into
+# GroupRegistry indexes, as the coordinator does on startup.
+#
+# Run from the repo root:  python -m benchmarks.bench_restart
+import shutil
+import tempfile
+import time
+
+from coord_server.registry import GroupRegistry
+from coord_server.store import LogStore
+
+PEERS = 100_000
+GROUPS = 10
+CHURN = 20_000
+SUBNET = "10.0.0.0/16"
+
+
+def populate(directory):
+    store = LogStore(directory, compact_every=10 ** 9)
+    store.load()
+    registries = {f"group{g}": GroupRegistry(SUBNET) for g in range(GROUPS)}
+    revisions = dict.fromkeys(registries, 0)
+    for i in range(PEERS):
+        group = f"group{i % GROUPS}"
+        peer = registries[group].add(f"peer{i}", f"key{i}", "198.51.100.1", 1024 + i % 60000)
+        revisions[group] += 1
+        store.append(group, {"event": "peer_added", "peer": dict(peer), "revision": revisions[group]})
+    for i in range(CHURN):
+        group = f"group{i % GROUPS}"
+        peer_id = next(iter(registries[group].peers))
+        registries[group].set_endpoint(peer_id, "203.0.113.9", 2000 + i)
+        revisions[group] += 1
+        store.append(group, {
+            "event": "peer_endpoint_changed", "peer_id": peer_id,
+            "external_ip": "203.0.113.9", "external_port": 2000 + i, "revision": revisions[group],
+        })
+    store.close()
+    return {group: (revisions[group], list(registries[group].values())) for group in registries}
+
+
+def cold_start(directory):
+    started = time.perf_counter()
+    store = LogStore(directory)
+    state = store.load()
+    loaded = time.perf_counter()
+    for revision, peers in state.values():
+        registry = GroupRegistry(SUBNET)
+        for peer in peers:
+            registry.apply({"event": "peer_added", "peer": peer})
+    rebuilt = time.perf_counter()
+    return store, state, loaded - started, rebuilt - loaded
+
+
+def main():
+    directory = tempfile.mkdtemp(prefix="coord-log-")
+    try:
+        started = time.perf_counter()
+        populate(directory)
+        print(f"appended {PEERS + CHURN} events in {time.perf_counter() - started:.2f}s")
+
+        store, state, load, rebuild = cold_start(directory)
+        print(f"log replay:    load {load:.3f}s  rebuild {rebuild:.3f}s  total {load + rebuild:.3f}s")
+        started = time.perf_counter()
+        store.compact(state)
+        store.close()
+        print(f"compaction:    {time.perf_counter() - started:.3f}s")
+
+        store, _, load, rebuild = cold_start(directory)
+        store.close()
+        print(f"snapshot load: load {load:.3f}s  rebuild {rebuild:.3f}s  total {load + rebuild:.3f}s")
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
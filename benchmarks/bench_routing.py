@@ -0,0 +1,60 @@
+# Per-packet route lookup cost for the userspace tunnel's routing table.
+#
+# Builds a table with 10k /32 peer routes plus a few shorter prefixes and
+# times lookups straight from IPv4 packet headers: host-route hits, hits on
+# a covering prefix, and misses.
+#
+# Run from the repo root:  python -m benchmarks.bench_routing
+import random
+import socket
+import time
+
+from routing import RoutingTable
+
+ROUTES = 10_000
+LOOKUPS = 1_000_000
+
+
+def packet_to(address):
+    header = bytearray(20)
+    header[0] = 0x45
+    header[16:20] = socket.inet_aton(address)
+    return memoryview(bytes(header))
+
+
+def host(i):
+    return f"10.0.{i // 250}.{i % 250 + 2}"
+
+
+def time_lookups(table, packets):
+    lookup = table.lookup_packet
+    started = time.perf_counter()
+    for packet in packets:
+        lookup(packet)
+    return (time.perf_counter() - started) / len(packets) * 1e9
+
+
+def main():
+    table = RoutingTable()
+    started = time.perf_counter()
+    for i in range(ROUTES):
+        table.add(f"{host(i)}/32", ("198.51.100.1", 50000 + i % 10000))
+    table.add("10.1.0.0/16", ("203.0.113.1", 51820))
+    table.add("10.2.3.0/24", ("203.0.113.2", 51820))
+    table.add("0.0.0.0/0", ("203.0.113.3", 51820))
+    print(f"built {len(table)} routes in {(time.perf_counter() - started) * 1e3:.1f}ms")
+
+    rng = random.Random(1)
+    cases = {
+        "/32 hit": [packet_to(host(rng.randrange(ROUTES))) for _ in range(1000)],
+        "/16 hit": [packet_to(f"10.1.{rng.randrange(256)}.{rng.randrange(256)}") for _ in range(1000)],
+        "default": [packet_to(f"192.0.2.{rng.randrange(256)}") for _ in range(1000)],
+    }
+    for name, sample in cases.items():
+        packets = sample * (LOOKUPS // len(sample))
+        ns = time_lookups(table, packets)
+        print(f"{name:>8}: {ns:6.0f} ns/lookup  {1e9 / ns / 1e6:5.2f}M lookups/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+# Throughput benchmark for the peer_vpn.py UDP data path.
+#
+# Compares the old per-packet loop (one sendto / recvfrom per packet plus a
+# json.loads attempt on every datagram) with batch_io (sendmmsg/recvmmsg,
+# UDP GSO/GRO and framing-byte dispatch). Sender and receiver run as separate
+# processes; as root the receiver lives in its own network namespace behind a
+# veth pair, otherwise both ends use loopback.
+#
+# The TUN side is not exercised (it needs a configured tunnel); the sender
+# copies each payload into its buffer the way a TUN read would.
+#
+# Run from the repo root:  python -m benchmarks.bench_vpn_io [--loopback]
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from batch_io import BatchReceiver, BatchSender, FRAME_DATA
+
+NETNS = 'vpnbench'
+HOST_IF, NS_IF = 'vpnb-a', 'vpnb-b'
+HOST_IP, NS_IP = '10.231.0.1', '10.231.0.2'
+PORT = 54399
+PACKET_SIZE = 1400
+DURATION = 3.0
+
+
+def ip_packet(size):
+    # Minimal IPv4-looking payload: version nibble 4, rest filler.
+    return bytes([0x45]) + bytes(size - 1)
+
+
+def receive(mode, duration):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 << 20)
+    sock.bind(('', PORT))
+    print('ready', flush=True)
+    packets = 0
+    started = deadline = None
+    if mode == 'legacy':
+        while deadline is None or time.perf_counter() < deadline:
+            data, addr = sock.recvfrom(4096)
+            try:
+                json.loads(data.decode())
+            except Exception:
+                if len(data) >= 20 and data[0] >> 4 == 4:
+                    packets += 1
+            if started is None:
+                started = time.perf_counter()
+                deadline = started + duration
+    else:
+        rx = BatchReceiver(sock)
+        while deadline is None or time.perf_counter() < deadline:
+            for frame, _ in rx.recv():
+                if frame[0] == FRAME_DATA and len(frame) > 20 and frame[1] >> 4 == 4:
+                    packets += 1
+            if started is None:
+                started = time.perf_counter()
+                deadline = started + duration
+    elapsed = time.perf_counter() - started
+    print(json.dumps({'mode': mode, 'packets': packets, 'pps': packets / elapsed,
+                      'mbps': packets * PACKET_SIZE * 8 / elapsed / 1e6}), flush=True)
+
+
+def send(mode, dest_ip, duration):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 8 << 20)
+    dest = (dest_ip, PORT)
+    payload = ip_packet(PACKET_SIZE)
+    deadline = time.perf_counter() + duration
+    if mode == 'legacy':
+        while time.perf_counter() < deadline:
+            for _ in range(64):
+                sock.sendto(bytes(payload), dest)
+    else:
+        tx = BatchSender(sock)
+        while time.perf_counter() < deadline:
+            while True:
+                buf = tx.buffer()
+                if buf is None:
+                    break
+                buf[0] = FRAME_DATA
+                buf[1:1 + PACKET_SIZE] = payload
+                tx.commit(1 + PACKET_SIZE, dest)
+            try:
+                tx.flush()
+            except OSError:
+                pass  # receiver buffer full, keep going
+
+
+def sh(*args, check=True):
+    return subprocess.run(args, check=check, capture_output=True)
+
+
+def setup_netns():
+    teardown_netns()
+    sh('ip', 'netns', 'add', NETNS)
+    sh('ip', 'link', 'add', HOST_IF, 'type', 'veth', 'peer', 'name', NS_IF)
+    sh('ip', 'link', 'set', NS_IF, 'netns', NETNS)
+    sh('ip', 'addr', 'add', f'{HOST_IP}/24', 'dev', HOST_IF)
+    sh('ip', 'link', 'set', HOST_IF, 'up')
+    sh('ip', 'netns', 'exec', NETNS, 'ip', 'addr', 'add', f'{NS_IP}/24', 'dev', NS_IF)
+    sh('ip', 'netns', 'exec', NETNS, 'ip', 'link', 'set', NS_IF, 'up')
+    sh('ip', 'netns', 'exec', NETNS, 'ip', 'link', 'set', 'lo', 'up')
+
+
+def teardown_netns():
+    sh('ip', 'link', 'del', HOST_IF, check=False)
+    sh('ip', 'netns', 'del', NETNS, check=False)
+
+
+def run(mode, netns, duration):
+    cmd = [sys.executable, '-m', 'benchmarks.bench_vpn_io', '--role', 'recv', '--mode', mode,
+           '--duration', str(duration)]
+    if netns:
+        cmd = ['ip', 'netns', 'exec', NETNS] + cmd
+    receiver = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+    receiver.stdout.readline()  # ready
+    sender = subprocess.Popen([sys.executable, '-m', 'benchmarks.bench_vpn_io', '--role', 'send',
+                               '--mode', mode, '--dest', NS_IP if netns else '127.0.0.1',
+                               '--duration', str(duration + 1)])
+    result = json.loads(receiver.stdout.readline())
+    receiver.wait()
+    sender.wait()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--role', choices=['recv', 'send'])
+    parser.add_argument('--mode', choices=['legacy', 'batch'], default='batch')
+    parser.add_argument('--dest', default='127.0.0.1')
+    parser.add_argument('--duration', type=float, default=DURATION)
+    parser.add_argument('--loopback', action='store_true', help='skip the veth/netns setup')
+    args = parser.parse_args()
+    if args.role == 'recv':
+        return receive(args.mode, args.duration)
+    if args.role == 'send':
+        return send(args.mode, args.dest, args.duration)
+
+    netns = not args.loopback and os.geteuid() == 0
+    if netns:
+        try:
+            setup_netns()
+        except subprocess.CalledProcessError as e:
+            print(f'netns setup failed ({e.stderr.decode().strip()}), using loopback')
+            netns = False
+    try:
+        print(f"path: {'veth/netns' if netns else 'loopback'}, {PACKET_SIZE} byte packets")
+        results = [run(mode, netns, args.duration) for mode in ('legacy', 'batch')]
+    finally:
+        if netns:
+            teardown_netns()
+    for r in results:
+        print(f"{r['mode']:>8}: {r['pps']:>12,.0f} pps  {r['mbps']:>9,.0f} Mbit/s")
+    print(f"speedup: {results[1]['pps'] / results[0]['pps']:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+# Compares forking the wg tools with the in-process paths (wgkeys,
+# wg_netlink) for the two things the agent does most: making keys at
+# startup and applying a peer change.
+#
+# keys:  `wg genkey | wg pubkey` (two forks) vs wgkeys.generate_keypair().
+# apply: `wg set wg-bench peer ...` vs WgNetlink.set_peers() on a scratch
+#        interface.
+# Without the wg tool, fork+exec of /bin/true stands in as the floor of
+# every subprocess call. Without the wireguard module, the apply row times
+# a generic netlink round trip (family lookup), the floor of every netlink
+# call, instead of a real set.
+#
+# Run from the repo root as root:  python -m benchmarks.bench_wg_config [rounds]
+import shutil
+import subprocess
+import sys
+import time
+
+import wg_netlink
+import wgkeys
+
+ROUNDS = 200
+INTERFACE = 'wg-bench'
+
+
+def timed(func, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        func()
+    return (time.perf_counter() - started) / rounds
+
+
+def report(label, forked, native):
+    print(f'{label:<8} fork {forked * 1e3:8.3f} ms   in-process {native * 1e3:8.3f} ms   '
+          f'{forked / native:8.0f}x')
+
+
+def bench_keys(rounds, wg):
+    if wg:
+        def forked():
+            priv = subprocess.run([wg, 'genkey'], check=True, capture_output=True).stdout
+            subprocess.run([wg, 'pubkey'], input=priv, check=True, capture_output=True)
+    else:
+        def forked():
+            subprocess.run(['true'], check=True)
+            subprocess.run(['true'], check=True)
+    report('keys', timed(forked, rounds), timed(wgkeys.generate_keypair, rounds))
+
+
+def bench_apply(rounds, wg):
+    if not wg_netlink.available():
+        sock = wg_netlink.NetlinkSocket(wg_netlink.NETLINK_GENERIC)
+        native = timed(lambda: wg_netlink.resolve_family(sock, b'nlctrl'), rounds)
+        forked = timed(lambda: subprocess.run(['true'], check=True), rounds)
+        sock.close()
+        print('(no wireguard module: netlink round trip vs one fork)')
+        report('apply', forked, native)
+        return
+    backend = wg_netlink.WgNetlink(INTERFACE)
+    priv, _ = wgkeys.generate_keypair()
+    backend.up(priv, 0, '10.254.0.1/24', {})
+    _, peer = wgkeys.generate_keypair()
+    try:
+        ports = iter(range(1024, 65536))
+
+        def native():
+            backend.set_peers([], {peer: {'endpoint': f'192.0.2.1:{next(ports)}',
+                                          'allowed_ips': '10.254.0.2/32', 'keepalive': 25}})
+
+        def forked():
+            subprocess.run([wg or 'true', 'set', INTERFACE, 'peer', peer, 'endpoint', f'192.0.2.1:{next(ports)}',
+                            'allowed-ips', '10.254.0.2/32', 'persistent-keepalive', '25'], check=True)
+
+        if not wg:
+            print('(no wg tool: fork of /bin/true vs netlink set)')
+        report('apply', timed(forked, rounds), timed(native, rounds))
+    finally:
+        backend.down()
+        backend.close()
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else ROUNDS
+    wg = shutil.which('wg')
+    if not wg:
+        print('(no wg tool: timing fork+exec of /bin/true instead)')
+    bench_keys(rounds, wg)
+    bench_apply(rounds, wg)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,342 @@
+# Load test for the coordinator with thousands of simulated agents.
+#
+# Starts coord_server.main:app under uvicorn (memory store, no relay) and
+# runs AGENTS simulated agents spread over GROUPS groups in WORKERS client
+# processes. Each agent registers, keeps its group websocket open and reads
+# every event. The agents speak only the coordinator protocol, so nothing
+# touches `wg` and no WireGuard is needed. Once everyone is connected and
+# the server has gone quiet (the last joins are still fanning out when
+# registration returns), random agents churn for DURATION seconds at RATE
+# operations per second: mostly /update with a new endpoint, otherwise
+# /leave followed by a fresh /register.
+#
+# Delivery latency runs from just before the HTTP call that caused an event
+# until another agent in the same client process receives it on its
+# websocket, so it covers the handler, the fan-out and the socket. Server
+# CPU and memory come from /proc/<pid>, sampled between phases. The
+# clients' own CPU is reported too: when server plus clients approach the
+# number of cores, delivery latency measures the harness, not the server.
+#
+# The report is JSON (stdout and --output) so runs can be compared.
+#
+# Run from the repo root:  python -m benchmarks.loadtest --agents 5000 --groups 10
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+import websockets
+
+REGISTER_CONCURRENCY = 50
+LEAVE_SHARE = 0.2
+DRAIN_SECONDS = 2.0
+# The server counts as settled once it uses less than SETTLE_CPU of a core
+# over SETTLE_WINDOW seconds.
+SETTLE_WINDOW = 1.0
+SETTLE_CPU = 0.05
+# Give up if a phase takes longer than this (e.g. a worker died).
+PHASE_TIMEOUT = 900
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def percentiles(samples):
+    if not samples:
+        return {'samples': 0}
+    samples = sorted(samples)
+
+    def at(p):
+        return round(samples[min(len(samples) - 1, int(p * len(samples)))] * 1000, 3)
+
+    return {'samples': len(samples), 'p50_ms': at(0.5), 'p90_ms': at(0.9), 'p99_ms': at(0.99),
+            'max_ms': at(1.0)}
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def proc_stats(pid):
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    ticks = os.sysconf('SC_CLK_TCK')
+    memory = {}
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in ('VmRSS', 'VmHWM'):
+                memory[key] = int(value.split()[0]) / 1024
+    # utime and stime are fields 14 and 15 of /proc/pid/stat.
+    return {'cpu_seconds': (int(fields[11]) + int(fields[12])) / ticks,
+            'rss_mb': round(memory.get('VmRSS', 0), 1), 'peak_rss_mb': round(memory.get('VmHWM', 0), 1)}
+
+
+class Agent:
+    def __init__(self, number, group, sent, delivered):
+        self.number = number
+        self.group = group
+        self.name = f'agent{number}'
+        self.key = f'loadtest-key-{number}-{random.getrandbits(32):08x}'
+        self.port = 1024 + number % 60000
+        self.peer_id = None
+        self.ws = None
+        self.reader = None
+        self.sent = sent  # event key -> perf_counter before the causing request
+        self.delivered = delivered  # event name -> latencies
+
+    async def join(self, http, ws_base):
+        resp = await http.post('/register', json={
+            'group': self.group, 'name': self.name, 'public_key': self.key,
+            'external_ip': '198.51.100.7', 'external_port': self.port,
+        })
+        resp.raise_for_status()
+        self.peer_id = resp.json()['peer_id']
+        self.ws = await websockets.connect(f'{ws_base}/ws/{self.group}?peer_id={self.peer_id}',
+                                           max_size=None, ping_interval=None)
+        self.reader = asyncio.create_task(self.read())
+
+    async def read(self):
+        try:
+            async for text in self.ws:
+                now = time.perf_counter()
+                event = json.loads(text)
+                kind = event.get('event')
+                if kind == 'peer_endpoint_changed':
+                    key = (event['peer_id'], event['external_port'])
+                elif kind == 'peer_removed':
+                    key = event['peer_id']
+                elif kind == 'peer_added':
+                    key = event['peer']['public_key']
+                else:
+                    continue
+                started = self.sent.get(key)
+                if started is not None:
+                    self.delivered.setdefault(kind, []).append(now - started)
+        except websockets.ConnectionClosed:
+            pass
+
+    async def close(self):
+        if self.reader:
+            self.reader.cancel()
+        if self.ws:
+            await self.ws.close()
+        self.ws = self.reader = None
+
+
+async def worker_main(index, args, base_url, barrier, results):
+    raise_fd_limit()
+    ws_base = base_url.replace('http', 'ws', 1)
+    sent, delivered = {}, {}
+    requests = {'register': [], 'update': [], 'leave': []}
+    errors = 0
+    agents = [Agent(n, f'group{n % args.groups}', sent, delivered)
+              for n in range(index, args.agents, args.workers)]
+    limits = httpx.Limits(max_connections=REGISTER_CONCURRENCY, max_keepalive_connections=REGISTER_CONCURRENCY)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as http:
+        gate = asyncio.Semaphore(REGISTER_CONCURRENCY)
+
+        async def join(agent):
+            nonlocal errors
+            async with gate:
+                started = time.perf_counter()
+                try:
+                    await agent.join(http, ws_base)
+                except Exception as e:
+                    errors += 1
+                    print(f'worker {index}: {agent.name} could not join: {e!r}', file=sys.stderr)
+                    return
+                requests['register'].append(time.perf_counter() - started)
+
+        cpu_started = cpu_seconds()
+        await asyncio.gather(*(join(agent) for agent in agents))
+        cpu_joined = cpu_seconds()
+        await asyncio.to_thread(barrier.wait)  # everyone connected
+        await asyncio.to_thread(barrier.wait)  # server settled, start churning
+
+        async def churn_one(agent):
+            nonlocal errors
+            try:
+                if random.random() >= LEAVE_SHARE:
+                    agent.port = 1024 + (agent.port + 1 - 1024) % 64000
+                    started = time.perf_counter()
+                    sent[(agent.peer_id, agent.port)] = started
+                    (await http.post('/update', params={
+                        'group': agent.group, 'peer_id': agent.peer_id,
+                        'external_ip': '198.51.100.7', 'external_port': agent.port,
+                    })).raise_for_status()
+                    requests['update'].append(time.perf_counter() - started)
+                else:
+                    await agent.close()
+                    started = time.perf_counter()
+                    sent[agent.peer_id] = started
+                    (await http.post('/leave', json={'group': agent.group, 'public_key': agent.key})
+                     ).raise_for_status()
+                    requests['leave'].append(time.perf_counter() - started)
+                    agent.key = f'loadtest-key-{agent.number}-{random.getrandbits(32):08x}'
+                    sent[agent.key] = time.perf_counter()
+                    await agent.join(http, ws_base)
+            except Exception as e:
+                errors += 1
+                print(f'worker {index}: churn for {agent.name} failed: {e!r}', file=sys.stderr)
+
+        rate = args.rate / args.workers
+        live = [agent for agent in agents if agent.ws is not None]
+        busy = set()
+        operations = 0
+        deadline = time.perf_counter() + args.duration
+        next_at = time.perf_counter()
+        while live and time.perf_counter() < deadline:
+            agent = random.choice(live)
+            if agent.number not in busy:
+                busy.add(agent.number)
+                task = asyncio.create_task(churn_one(agent))
+                task.add_done_callback(lambda _, n=agent.number: busy.discard(n))
+                operations += 1
+            next_at += random.expovariate(rate)
+            await asyncio.sleep(max(0.0, next_at - time.perf_counter()))
+        await asyncio.sleep(DRAIN_SECONDS)
+        cpu_churned = cpu_seconds()
+        connected = sum(1 for agent in agents if agent.ws is not None)
+        await asyncio.to_thread(barrier.wait)  # churn finished
+        await asyncio.gather(*(agent.close() for agent in agents), return_exceptions=True)
+
+    results.put({
+        'connected': connected,
+        'join_cpu_seconds': cpu_joined - cpu_started,
+        'churn_cpu_seconds': cpu_churned - cpu_joined,
+        'operations': operations,
+        'errors': errors,
+        'requests': requests,
+        'delivered': delivered,
+    })
+
+
+def run_worker(index, args, base_url, barrier, results):
+    asyncio.run(worker_main(index, args, base_url, barrier, results))
+
+
+def settle(pid):
+    # Registration returns before the fan-out of the last joins reaches
+    # every websocket; wait for the server to go quiet before churning.
+    started = time.perf_counter()
+    while time.perf_counter() - started < PHASE_TIMEOUT:
+        before = proc_stats(pid)['cpu_seconds']
+        time.sleep(SETTLE_WINDOW)
+        if proc_stats(pid)['cpu_seconds'] - before < SETTLE_WINDOW * SETTLE_CPU:
+            break
+    return time.perf_counter() - started
+
+
+def start_server(port):
+    # The simulated agents send no lease heartbeats.
+    env = dict(os.environ, COORD_STORE='memory://', COORD_LEASE_TTL='0')
+    env.pop('COORD_RELAY_HOST', None)
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'coord_server.main:app', '--host', '127.0.0.1', '--port', str(port),
+         '--log-level', 'warning', '--backlog', '4096'],
+        env=env,
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            httpx.get(f'http://127.0.0.1:{port}/peers/ready', timeout=1)
+            return server
+        except httpx.TransportError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError('coordinator did not start')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--agents', type=int, default=2000)
+    parser.add_argument('--groups', type=int, default=10)
+    parser.add_argument('--workers', type=int, default=2, help='client processes')
+    parser.add_argument('--duration', type=float, default=20.0, help='churn seconds')
+    parser.add_argument('--rate', type=float, default=50.0, help='churn operations per second')
+    parser.add_argument('--output', default='loadtest_report.json')
+    args = parser.parse_args()
+
+    fd_limit = raise_fd_limit()  # inherited by the server and the workers
+    port = free_port()
+    server = start_server(port)
+    base_url = f'http://127.0.0.1:{port}'
+    try:
+        idle = proc_stats(server.pid)
+        barrier = multiprocessing.Barrier(args.workers + 1, timeout=PHASE_TIMEOUT)
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=run_worker, args=(i, args, base_url, barrier, results))
+                   for i in range(args.workers)]
+        for worker in workers:
+            worker.start()
+        started = time.perf_counter()
+        barrier.wait()
+        join_seconds = time.perf_counter() - started
+        settle_seconds = settle(server.pid)
+        joined = proc_stats(server.pid)
+        barrier.wait()
+        barrier.wait()
+        churned = proc_stats(server.pid)
+        reports = [results.get(timeout=PHASE_TIMEOUT) for _ in workers]
+        for worker in workers:
+            worker.join()
+    finally:
+        server.terminate()
+        server.wait()
+
+    requests = {kind: [s for r in reports for s in r['requests'][kind]] for kind in ('register', 'update', 'leave')}
+    kinds = {kind for r in reports for kind in r['delivered']}
+    delivered = {kind: [s for r in reports for s in r['delivered'].get(kind, [])] for kind in kinds}
+    operations = sum(r['operations'] for r in reports)
+    report = {
+        'config': dict(vars(args), fd_limit=fd_limit),
+        'agents_connected': sum(r['connected'] for r in reports),
+        'errors': sum(r['errors'] for r in reports),
+        'join': {
+            'seconds': round(join_seconds, 3),
+            'registrations_per_second': round(len(requests['register']) / join_seconds, 1),
+            'settle_seconds': round(settle_seconds, 3),
+            'server_cpu_seconds': round(joined['cpu_seconds'] - idle['cpu_seconds'], 3),
+            'client_cpu_seconds': round(sum(r['join_cpu_seconds'] for r in reports), 3),
+        },
+        'churn': {
+            'operations': operations,
+            'server_cpu_seconds': round(churned['cpu_seconds'] - joined['cpu_seconds'], 3),
+            'client_cpu_seconds': round(sum(r['churn_cpu_seconds'] for r in reports), 3),
+        },
+        'request_latency': {kind: percentiles(samples) for kind, samples in requests.items()},
+        'delivery_latency': {kind: percentiles(samples) for kind, samples in sorted(delivered.items())},
+        'server_memory': {
+            'idle_rss_mb': idle['rss_mb'],
+            'connected_rss_mb': joined['rss_mb'],
+            'final_rss_mb': churned['rss_mb'],
+            'peak_rss_mb': churned['peak_rss_mb'],
+        },
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    with open(args.output, 'w') as f:
+        f.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+import asyncio
+import json
+import random
+
+import httpx
+import websockets
+
+import peer_records
+
+# Seconds to wait for a coordinator response before retrying.
+REQUEST_TIMEOUT = 10.0
+CONNECT_TIMEOUT = 5.0
+RETRIES = 5
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+# Heartbeats per lease TTL, so one or two can be lost without losing it.
+HEARTBEATS_PER_LEASE = 3
+
+
+def heartbeat_interval(reg):
+    """Seconds between lease heartbeats, or None if the coordinator keeps
+    peers without them."""
+    ttl = reg.get('lease_ttl') or 0
+    return ttl / HEARTBEATS_PER_LEASE if ttl > 0 else None
+
+
+async def send_heartbeats(ws, interval):
+    """Renews our lease over the coordinator websocket until it closes."""
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            await ws.send(json.dumps({'type': 'heartbeat'}))
+    except websockets.ConnectionClosed:
+        pass
+
+
+class CoordClient:
+    """Async coordinator client sharing one keep-alive connection pool.
+
+    Transport errors and 5xx responses are retried with full-jitter
+    exponential backoff, so a fleet reconnecting after a coordinator blip
+    spreads out instead of arriving at once."""
+
+    def __init__(self, server_url, retries=RETRIES):
+        self.server_url = server_url.rstrip('/')
+        self.retries = retries
+        self.peer_lists = {}  # group -> (etag, epoch, revision, peers) from the last fetch_peers
+        self.http = httpx.AsyncClient(
+            base_url=self.server_url,
+            timeout=httpx.Timeout(REQUEST_TIMEOUT, connect=CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=4, max_keepalive_connections=4, keepalive_expiry=120),
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        await self.http.aclose()
+
+    def ws_url(self, group, peer_id=None):
+        url = self.server_url.replace('http', 'ws', 1) + f'/ws/{group}'
+        # Identifies us for hole punching; add resume params with '&'.
+        return url + f'?peer_id={peer_id}' if peer_id else url
+
+    async def _request(self, method, path, **kwargs):
+        for attempt in range(self.retries + 1):
+            try:
+                resp = await self.http.request(method, path, **kwargs)
+                if resp.status_code < 500 or attempt == self.retries:
+                    if resp.status_code != 304:  # Not Modified answers a conditional GET
+                        resp.raise_for_status()
+                    return resp
+                print(f'Coordinator returned {resp.status_code} for {path}, retrying...')
+            except httpx.TransportError as e:
+                if attempt == self.retries:
+                    raise
+                print(f'Coordinator request {path} failed ({e!r}), retrying...')
+            await asyncio.sleep(random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)))
+
+    async def register(self, group, name, public_key, external_ip, external_port, internal_ip=None):
+        body = {
+            'group': group,
+            'name': name,
+            'public_key': public_key,
+            'external_ip': external_ip,
+            'external_port': external_port
+        }
+        if internal_ip:
+            body['internal_ip'] = internal_ip  # ask for our old address back
+        resp = await self._request('POST', '/register', json=body)
+        return resp.json()
+
+    async def fetch_peers(self, group):
+        """The group's peer list. Sends the ETag of the copy we already have,
+        so an unchanged group costs a 304, and asks for the binary record
+        format (gzip comes with httpx's default Accept-Encoding)."""
+        headers = {'Accept': f'{peer_records.CONTENT_TYPE}, application/json;q=0.5'}
+        cached = self.peer_lists.get(group)
+        if cached:
+            headers['If-None-Match'] = cached[0]
+        resp = await self._request('GET', f'/peers/{group}', headers=headers)
+        if resp.status_code == 304 and cached:
+            return cached[3]
+        if resp.headers.get('content-type', '').startswith(peer_records.CONTENT_TYPE):
+            peers = peer_records.decode(resp.content)
+        else:
+            peers = resp.json()
+        if 'etag' in resp.headers:
+            self.peer_lists[group] = (resp.headers['etag'], resp.headers.get('x-peers-epoch'),
+                                      int(resp.headers.get('x-peers-revision', 0)), peers)
+        return peers
+
+    def peer_list_version(self, group):
+        """(epoch, revision) of the last peer list fetch_peers returned."""
+        cached = self.peer_lists.get(group)
+        return (cached[1], cached[2]) if cached else (None, 0)
+
+    async def update(self, group, peer_id, external_ip, external_port):
+        resp = await self._request('POST', '/update', params={
+            'group': group,
+            'peer_id': peer_id,
+            'external_ip': external_ip,
+            'external_port': external_port
+        })
+        return resp.json()
+
+    async def leave(self, group, public_key):
+        try:
+            resp = await self._request('POST', '/leave', json={'group': group, 'public_key': public_key})
+        except httpx.HTTPStatusError as e:
+            # A retried leave that already went through comes back as 404.
+            if e.response.status_code == 404:
+                return {'status': 'left'}
+            raise
+        return resp.json()
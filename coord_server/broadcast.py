@@ -0,0 +1,119 @@
+import asyncio
+import json
+from typing import Callable, Dict, Optional, Set, Tuple
+
+from fastapi import WebSocket
+
+# Messages buffered per websocket before it is treated as a slow consumer.
+OUTBOX_SIZE = 256
+# A client that cannot take one message within this many seconds is dropped.
+SEND_TIMEOUT = 10.0
+
+# Queue marker: replace everything pending with a fresh snapshot.
+RESYNC = object()
+
+
+def encode(message: dict) -> str:
+    return json.dumps(message, separators=(",", ":"))
+
+
+class Connection:
+    def __init__(self, group: str, websocket: WebSocket):
+        self.group = group
+        self.websocket = websocket
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=OUTBOX_SIZE)
+        # Events at or below this revision are already covered by a snapshot
+        # we sent and are skipped.
+        self.floor = -1
+        self.writer: Optional[asyncio.Task] = None
+
+    def offer(self, item) -> bool:
+        try:
+            self.queue.put_nowait(item)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    def resync(self, *extra):
+        # Coalesce a backlog of events into the latest snapshot. Messages for
+        # this connection only (revision None) are not in the snapshot and
+        # are queued again behind it; if they alone fill the outbox, the
+        # oldest go.
+        direct = []
+        while not self.queue.empty():
+            item = self.queue.get_nowait()
+            if item is not RESYNC and item[0] is None:
+                direct.append(item)
+        direct.extend(extra)
+        self.queue.put_nowait(RESYNC)
+        for item in direct[-(OUTBOX_SIZE - 1):]:
+            self.queue.put_nowait(item)
+
+    def send(self, message: dict):
+        """Queues a message for this connection only (not part of the event stream)."""
+        item = (None, encode(message))
+        if not self.offer(item):
+            self.resync(item)
+
+
+class Broadcaster:
+    """Per-group websocket fan-out. Each connection has a bounded outbox and
+    its own writer task, so publishing never waits on a client and a slow or
+    dead client only ever hurts itself."""
+
+    def __init__(self, snapshot: Callable[[str], Tuple[int, str]]):
+        # snapshot(group) -> (revision, encoded peer_snapshot message)
+        self.snapshot = snapshot
+        self.groups: Dict[str, Set[Connection]] = {}
+
+    def connections(self, group: str) -> Set[Connection]:
+        return self.groups.get(group, set())
+
+    def add(self, group: str, websocket: WebSocket, backlog=()) -> Connection:
+        conn = Connection(group, websocket)
+        backlog = list(backlog)
+        if len(backlog) >= OUTBOX_SIZE:
+            conn.resync()
+        else:
+            for event in backlog:
+                conn.offer((event.get("revision"), encode(event)))
+        self.groups.setdefault(group, set()).add(conn)
+        conn.writer = asyncio.create_task(self._writer(conn))
+        return conn
+
+    def remove(self, conn: Connection):
+        self.groups.get(conn.group, set()).discard(conn)
+        if conn.writer and conn.writer is not asyncio.current_task():
+            conn.writer.cancel()
+
+    def publish(self, group: str, event: dict):
+        """Serializes an event once and queues it on every connection in the group."""
+        conns = self.groups.get(group)
+        if not conns:
+            return
+        item = (event.get("revision"), encode(event))
+        for conn in conns:
+            if not conn.offer(item):
+                conn.resync()
+
+    async def _writer(self, conn: Connection):
+        try:
+            while True:
+                item = await conn.queue.get()
+                if item is RESYNC:
+                    revision, text = self.snapshot(conn.group)
+                    conn.floor = revision
+                else:
+                    revision, text = item
+                    if revision is not None and revision <= conn.floor:
+                        continue
+                await asyncio.wait_for(conn.websocket.send_text(text), SEND_TIMEOUT)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Dead or stuck client: drop it and let the receive loop notice.
+            self.remove(conn)
+            try:
+                await conn.websocket.close()
+            except Exception:
+                pass
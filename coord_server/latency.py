@@ -0,0 +1,97 @@
+import time
+from typing import Dict, List, Optional, Tuple
+
+# A direct path is poor when it loses this much...
+POOR_LOSS = 0.2
+# ...or when going through another peer is this much faster, by at least
+# DETOUR_MIN_GAIN_MS (so small differences never move traffic).
+DETOUR_FACTOR = 1.5
+DETOUR_MIN_GAIN_MS = 20.0
+# Reports older than this are left out of the matrix.
+REPORT_TTL = 300.0
+
+
+class LatencyMatrix:
+    """Per-group RTT/loss measurements between peers, as reported by the
+    agents' tunnel probes. Entry (a, b) is what a measured towards b."""
+
+    def __init__(self, ttl: float = REPORT_TTL):
+        self.ttl = ttl
+        # group -> source peer_id -> destination peer_id -> (rtt ms or None, loss, reported at)
+        self.groups: Dict[str, Dict[str, Dict[str, Tuple[Optional[float], float, float]]]] = {}
+
+    def report(self, group: str, source: str, peers: dict, known: Dict[str, dict]):
+        if source not in known:
+            return
+        now = time.time()
+        rows = self.groups.setdefault(group, {})
+        row = rows.setdefault(source, {})
+        for dest, sample in peers.items():
+            if dest not in known or dest == source or not isinstance(sample, (list, tuple)) or len(sample) != 2:
+                continue
+            rtt, loss = sample
+            if rtt is not None and not isinstance(rtt, (int, float)):
+                continue
+            if not isinstance(loss, (int, float)):
+                continue
+            row[dest] = (rtt, min(1.0, max(0.0, float(loss))), now)
+
+    def forget_peer(self, group: str, peer_id: str):
+        rows = self.groups.get(group)
+        if not rows:
+            return
+        rows.pop(peer_id, None)
+        for row in rows.values():
+            row.pop(peer_id, None)
+
+    def _fresh(self, group: str) -> Dict[str, Dict[str, Tuple[Optional[float], float]]]:
+        cutoff = time.time() - self.ttl
+        return {
+            source: {dest: (rtt, loss) for dest, (rtt, loss, at) in row.items() if at >= cutoff}
+            for source, row in self.groups.get(group, {}).items()
+        }
+
+    def matrix(self, group: str) -> dict:
+        return {
+            source: {dest: {"rtt_ms": rtt, "loss": loss} for dest, (rtt, loss) in row.items()}
+            for source, row in self._fresh(group).items()
+        }
+
+    def suggestions(self, group: str, relay_available: bool = False) -> List[dict]:
+        """Pairs whose direct path is lossy or much slower than a detour
+        through another peer, with the best next hop (or a relay)."""
+        fresh = self._fresh(group)
+
+        def usable_rtt(a: str, b: str) -> Optional[float]:
+            rtt, loss = fresh.get(a, {}).get(b, (None, 1.0))
+            return rtt if rtt is not None and loss < POOR_LOSS else None
+
+        result = []
+        for a, row in fresh.items():
+            for b, (rtt, loss) in row.items():
+                best_hop, best_rtt = None, None
+                for hop in fresh.get(a, {}):
+                    if hop in (a, b):
+                        continue
+                    first, second = usable_rtt(a, hop), usable_rtt(hop, b)
+                    if first is None or second is None:
+                        continue
+                    if best_rtt is None or first + second < best_rtt:
+                        best_hop, best_rtt = hop, first + second
+                lossy = rtt is None or loss >= POOR_LOSS
+                slow = (
+                    not lossy and best_rtt is not None and
+                    rtt > best_rtt * DETOUR_FACTOR and rtt - best_rtt >= DETOUR_MIN_GAIN_MS
+                )
+                if not (lossy or slow):
+                    continue
+                suggestion = {"source": a, "dest": b, "rtt_ms": rtt, "loss": loss,
+                              "reason": "loss" if lossy else "latency"}
+                if best_hop is not None:
+                    suggestion.update(via=best_hop, via_rtt_ms=round(best_rtt, 2))
+                elif relay_available:
+                    suggestion.update(via="relay")
+                else:
+                    continue
+                result.append(suggestion)
+        return result
@@ -0,0 +1,89 @@
+import math
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+# Peers that have not renewed their lease for this long are removed.
+LEASE_TTL = 90.0
+# Resolution of the wheel: leases expire at most one tick late.
+LEASE_TICK = 1.0
+
+Key = Tuple[str, str]  # (group, peer_id)
+
+
+class LeaseWheel:
+    """Peer leases in a hashed timer wheel.
+
+    Renewing is O(1): the peer goes into the slot of its new deadline and
+    stays in its old slot too, where it is skipped when that slot comes due
+    because its deadline has moved on. Advancing only visits the slots of
+    the ticks that passed, so the cost tracks renewals and expiries, never
+    the number of peers. The wheel spans one TTL, so a slot never holds
+    deadlines from two laps."""
+
+    def __init__(self, ttl: float = LEASE_TTL, tick: float = LEASE_TICK):
+        self.ttl = ttl
+        self.tick = tick
+        self.slots: List[Set[Key]] = [set() for _ in range(int(math.ceil(ttl / tick)) + 2)]
+        self.deadlines: Dict[Key, float] = {}
+        self.renewed: Dict[Key, float] = {}  # renewals not yet handed to the shared store
+        # Peers that renewed their own lease on this worker. The rest only
+        # carry a deadline set for them (added elsewhere, loaded at startup).
+        self.held: Set[Key] = set()
+        self.current: Optional[int] = None  # last tick advance() processed
+        self.expired = 0  # peers removed for it, counted by the caller
+
+    def __len__(self) -> int:
+        return len(self.deadlines)
+
+    def renew(self, group: str, peer_id: str, deadline: Optional[float] = None):
+        key = (group, peer_id)
+        if deadline is None:
+            deadline = time.time() + self.ttl
+            self.renewed[key] = deadline
+            self.held.add(key)
+        previous = self.deadlines.get(key)
+        self.deadlines[key] = deadline
+        slot = int(deadline // self.tick)
+        if previous is None or int(previous // self.tick) != slot:
+            self.slots[slot % len(self.slots)].add(key)
+
+    def forget(self, group: str, peer_id: str):
+        # Its slot entries are skipped once the deadline is gone.
+        self.deadlines.pop((group, peer_id), None)
+        self.renewed.pop((group, peer_id), None)
+        self.held.discard((group, peer_id))
+
+    def holds(self, group: str, peer_id: str) -> bool:
+        return (group, peer_id) in self.held
+
+    def take_renewed(self) -> Dict[Key, float]:
+        renewed, self.renewed = self.renewed, {}
+        return renewed
+
+    def advance(self, now: Optional[float] = None) -> Dict[str, List[str]]:
+        """Expires every lease whose deadline has passed, returning
+        group -> [peer_id]."""
+        now = time.time() if now is None else now
+        target = int(now // self.tick) - 1  # the last tick that is fully over
+        if self.current is None:
+            self.current = target - len(self.slots)
+        # After a long stall one lap covers every slot.
+        start = max(self.current + 1, target - len(self.slots) + 1)
+        expired: Dict[str, List[str]] = {}
+        for tick in range(start, target + 1):
+            slot = self.slots[tick % len(self.slots)]
+            keep = set()
+            for key in slot:
+                deadline = self.deadlines.get(key)
+                if deadline is None:
+                    continue
+                if deadline < now:
+                    del self.deadlines[key]
+                    self.renewed.pop(key, None)
+                    expired.setdefault(key[0], []).append(key[1])
+                elif int(deadline // self.tick) % len(self.slots) == tick % len(self.slots):
+                    keep.add(key)  # belongs here, a lap later
+            slot.clear()
+            slot.update(keep)
+        self.current = max(self.current, target)
+        return expired
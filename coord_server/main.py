@@ -1,36 +1,337 @@
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Body
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Body, Query, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
+from pydantic import BaseModel, Field
 from typing import Dict, List, Optional
-import uuid
+from collections import deque
+from contextlib import contextmanager
+import asyncio
+import json
+import os
+import time
+
+from coord_server.broadcast import Broadcaster
+from coord_server.latency import LatencyMatrix
+from coord_server.leases import LEASE_TICK, LeaseWheel
+from coord_server.registry import DEFAULT_SUBNET, GroupRegistry
+from coord_server.relay import RELAY_HOST, Relay
+from coord_server.rendezvous import Rendezvous
+from coord_server.signaling import Signaling
+from coord_server.snapshots import GZIP_MIN_SIZE, JSON, RECORDS, SnapshotCache, accepts, matches
+from coord_server.store import StoreReset, open_store
+from metrics import CONTENT_TYPE, Registry
+from topology import DEFAULT_SHARD_SIZE, FULL, Topology
 
 app = FastAPI()
+
+# Number of recent delta events kept per group so reconnecting clients can
+# resume from a revision instead of downloading a full snapshot.
+EVENT_LOG_SIZE = 1024
+# Address space each group allocates internal IPs from, e.g. 10.0.0.0/16
+# for groups of thousands of peers.
+GROUP_SUBNET = os.environ.get("COORD_SUBNET", DEFAULT_SUBNET)
+# Where group state lives: memory:// for a single worker,
+# sqlite:///path/state.db to share it between workers on one host, or
+# log:///path/dir for a durable snapshot + append-only log.
+STORE_URL = os.environ.get("COORD_STORE", "memory://")
+# How often a worker picks up events recorded by the other workers.
+STORE_POLL_INTERVAL = 0.05
+# How often we check whether the store wants its log compacted.
+COMPACT_CHECK_INTERVAL = 10.0
+# Which peers each node configures: "full" mesh, or "sharded" for very large
+# groups (COORD_SHARD_SIZE-address blocks meshed internally, joined by hubs).
+TOPOLOGY = Topology(os.environ.get("COORD_TOPOLOGY", FULL),
+                    int(os.environ.get("COORD_SHARD_SIZE", DEFAULT_SHARD_SIZE)), GROUP_SUBNET)
+# How often idle relay sessions are closed.
+RELAY_EXPIRE_INTERVAL = 30.0
+# Peers that send no heartbeat (or any other sign of life) for this many
+# seconds are removed; 0 keeps peers until they /leave. Only peers that
+# attached a websocket hold a lease: one-shot registrations (setup_peer)
+# stay until they /leave.
+LEASE_TTL = float(os.environ.get("COORD_LEASE_TTL", "90"))
+
+store = open_store(STORE_URL)
+
+metrics_registry = Registry()
+REQUEST_SECONDS = metrics_registry.histogram("coord_request_seconds", "Latency of the peer HTTP handlers.",
+                                             labelnames=("endpoint",))
+FANOUT_SECONDS = metrics_registry.histogram(
+    "coord_fanout_seconds", "Time to queue one event on every websocket of its group.",
+    buckets=(0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1))
+EVENTS = metrics_registry.counter("coord_events_total", "Peer events published.", labelnames=("event",))
+
 @app.post("/leave")
+@REQUEST_SECONDS.timed("leave")
 async def leave_peer(group: str = Body(...), public_key: str = Body(...)):
-    if group in groups:
-        remove_id = None
-        for pid, pinfo in groups[group].items():
-            if pinfo['public_key'] == public_key:
-                remove_id = pid
-                break
-        if remove_id:
-            del groups[group][remove_id]
-            # Notify via websocket
-            for ws in ws_connections[group]:
-                await ws.send_json({"event": "peer_update", "peers": list(groups[group].values())})
-            return {"status": "left"}
+    with mutation():
+        if group in groups:
+            peer_info = groups[group].find_by_key(public_key)
+            if peer_info:
+                remove_id = peer_info["peer_id"]
+                groups[group].remove(remove_id)
+                record_event(group, {"event": "peer_removed", "peer_id": remove_id})
+                return {"status": "left"}
     return JSONResponse(status_code=404, content={"error": "Peer not found in group"})
 
-groups: Dict[str, Dict[str, dict]] = {}  # group_name -> peer_id -> peer_info
-ws_connections: Dict[str, List[WebSocket]] = {}  # group_name -> list of websockets
+groups: Dict[str, GroupRegistry] = {}  # group_name -> peers
+revisions: Dict[str, int] = {}  # group_name -> last event revision
+event_logs: Dict[str, deque] = {}  # group_name -> recent delta events
+leases = LeaseWheel(LEASE_TTL) if LEASE_TTL > 0 else None
+
+def ensure_group(group: str):
+    if group not in groups:
+        groups[group] = GroupRegistry(GROUP_SUBNET)
+    if group not in revisions:
+        revisions[group] = 0
+        event_logs[group] = deque(maxlen=EVENT_LOG_SIZE)
+
+def hold_lease(group: str, peer_id: Optional[str]):
+    # A websocket with our peer_id: from now on the peer has to stay alive.
+    if leases is not None and peer_id:
+        leases.renew(group, peer_id)
+
+def renew_lease(group: str, peer_id: Optional[str]):
+    if leases is not None and peer_id and leases.holds(group, peer_id):
+        leases.renew(group, peer_id)
+
+def forget_peer(group: str, peer_id: str):
+    rendezvous.forget_peer(group, peer_id)
+    latency.forget_peer(group, peer_id)
+    if relay:
+        for pair in relay.pairs_of(group, peer_id):
+            relay.close(group, pair)
+    if leases is not None:
+        leases.forget(group, peer_id)
+
+def publish_event(group: str, event: dict):
+    if event["event"] == "peer_removed":
+        forget_peer(group, event["peer_id"])
+    elif event["event"] == "peers_removed":
+        for peer_id in event["peer_ids"]:
+            forget_peer(group, peer_id)
+    elif event["event"] == "peer_added" and leases is not None:
+        # Any worker may have to expire this peer if its own worker dies.
+        leases.renew(group, event["peer"]["peer_id"], time.time() + leases.ttl)
+    elif event["event"] == "peer_endpoint_changed" and relay:
+        relay.update_ip(group, event["peer_id"], event["external_ip"])
+    revisions[group] = event["revision"]
+    event_logs[group].append(event)
+    EVENTS.labels(event["event"]).inc()
+    with FANOUT_SECONDS.time():
+        broadcast(group, event)
+
+def record_event(group: str, event: dict) -> dict:
+    # Called after the registry was mutated, inside mutation().
+    event["revision"] = revisions[group] + 1
+    store.append(group, event)
+    publish_event(group, event)
+    return event
+
+def apply_remote_event(group: str, event: dict):
+    ensure_group(group)
+    if event["revision"] <= revisions[group]:
+        return
+    groups[group].apply(event)
+    publish_event(group, event)
+
+def load_state():
+    groups.clear()
+    revisions.clear()
+    event_logs.clear()
+    started = time.perf_counter()
+    for group, (revision, peers) in store.load().items():
+        ensure_group(group)
+        for peer_info in peers:
+            groups[group].apply({"event": "peer_added", "peer": peer_info})
+            if leases is not None:
+                # A full TTL for every agent to reconnect after a restart.
+                leases.renew(group, peer_info["peer_id"], time.time() + leases.ttl)
+        revisions[group] = revision
+    total = sum(len(registry) for registry in groups.values())
+    print(f"Loaded {total} peers in {len(groups)} groups in {time.perf_counter() - started:.3f}s.")
+
+def export_state():
+    return {group: (revisions[group], list(groups[group].values())) for group in groups}
+
+def catch_up_store():
+    try:
+        for group, event in store.poll():
+            apply_remote_event(group, event)
+    except StoreReset as e:
+        print(f"Fell behind the shared store ({e}), reloading state.")
+        load_state()
+        for group in groups:
+            for conn in broadcaster.connections(group):
+                conn.resync()
+
+@contextmanager
+def mutation():
+    """Serializes a state change against every worker sharing the store and
+    brings local state up to date before the handler looks at it."""
+    with store.transaction():
+        catch_up_store()
+        yield
+
+async def poll_store():
+    while True:
+        await asyncio.sleep(STORE_POLL_INTERVAL)
+        try:
+            catch_up_store()
+        except Exception as e:
+            print(f"Error polling shared store: {e}")
+
+async def compact_store():
+    while True:
+        await asyncio.sleep(COMPACT_CHECK_INTERVAL)
+        if store.needs_compaction():
+            try:
+                store.compact(export_state())
+            except Exception as e:
+                print(f"Error compacting store: {e}")
+
+@app.on_event("startup")
+async def startup():
+    load_state()
+    if store.shared:
+        app.state.store_poller = asyncio.create_task(poll_store())
+    app.state.store_compactor = asyncio.create_task(compact_store())
+    if relay:
+        app.state.relay_expirer = asyncio.create_task(expire_relays())
+    if leases is not None:
+        app.state.lease_expirer = asyncio.create_task(expire_leases())
+
+@app.on_event("shutdown")
+async def shutdown():
+    # A fresh snapshot makes the next startup a single file read.
+    store.compact(export_state())
+    store.close()
+
+def snapshot_event(group: str) -> dict:
+    return {
+        "event": "peer_snapshot",
+        "epoch": store.epoch,
+        "revision": revisions[group],
+        "peers": list(groups[group].values()),
+    }
+
+def catch_up_events(group: str, since: Optional[int], epoch: Optional[str]) -> List[dict]:
+    # Deltas after `since` if we still have all of them, otherwise a snapshot.
+    current = revisions[group]
+    if since is None or epoch != store.epoch or since > current:
+        return [snapshot_event(group)]
+    if since == current:
+        return []
+    log = event_logs[group]
+    if log and log[0]["revision"] <= since + 1:
+        return [e for e in log if e["revision"] > since]
+    return [snapshot_event(group)]
+
+# Encoded peer lists per group revision, shared by GET /peers and
+# websocket resyncs.
+snapshots = SnapshotCache(lambda group: groups[group].values())
+
+def snapshot_text(group: str):
+    ensure_group(group)
+    snapshot = snapshots.get(group, store.epoch, revisions[group])
+    return snapshot.revision, (f'{{"event":"peer_snapshot","epoch":{json.dumps(snapshot.epoch)},'
+                               f'"revision":{snapshot.revision},"peers":{snapshot.json_text()}}}')
+
+broadcaster = Broadcaster(snapshot_text)
+
+relay = Relay() if RELAY_HOST else None
+
+def notify_pair(group: str, pair, message: dict):
+    a, b = sorted(pair)
+    for me, other in ((a, b), (b, a)):
+        rendezvous.notify(group, me, dict(message, peer_id=other))
+
+def start_relay(group: str, pair):
+    a, b = sorted(pair)
+    peers = groups[group].peers if group in groups else {}
+    if a not in peers or b not in peers:
+        return
+    try:
+        endpoint = relay.open(group, a, b, peers[a]["external_ip"], peers[b]["external_ip"])
+    except OSError as e:
+        print(f"Could not open a relay session for {a} <-> {b}: {e}")
+        return
+    print(f"Relaying {a} <-> {b} in {group} via {endpoint}")
+    notify_pair(group, pair, {"type": "relay", "endpoint": endpoint})
+
+def pair_failed(group: str, pair):
+    # No direct path: hand both peers a relay endpoint for each other.
+    if relay:
+        start_relay(group, pair)
+
+def pair_direct(group: str, pair):
+    if relay and relay.close(group, pair):
+        notify_pair(group, pair, {"type": "relay_closed"})
+
+async def expire_relays():
+    while True:
+        await asyncio.sleep(RELAY_EXPIRE_INTERVAL)
+        for group, pair in relay.expire_idle():
+            # Let the pair punch again rather than keep a dead assignment.
+            rendezvous.clear_failed(group, pair)
+            notify_pair(group, pair, {"type": "relay_closed"})
+
+def evict_expired(expired: Dict[str, List[str]]):
+    now = time.time()
+    with mutation():
+        for group, peer_ids in expired.items():
+            # Peers whose websocket lives on another worker renew there.
+            rows = store.lease_deadlines(group, peer_ids)
+            later = {peer_id: deadline for peer_id, deadline in rows.items() if deadline > now}
+            for peer_id, deadline in later.items():
+                leases.renew(group, peer_id, deadline)
+            # Only peers that held a lease, here or as the store remembers
+            # (another worker, or before a restart), are expired; one-shot
+            # registrations never attached.
+            gone = [peer_id for peer_id in peer_ids
+                    if (leases.holds(group, peer_id) or peer_id in rows) and peer_id not in later
+                    and group in groups and peer_id in groups[group]]
+            for peer_id in set(peer_ids) - set(later) - set(gone):
+                leases.forget(group, peer_id)
+            if not gone:
+                continue
+            leases.expired += len(gone)
+            for peer_id in gone:
+                groups[group].remove(peer_id)
+            # One event per group however many expired in this tick.
+            record_event(group, {"event": "peers_removed", "peer_ids": gone})
+            print(f"Lease expired for {len(gone)} peers in group {group}.")
+
+async def expire_leases():
+    while True:
+        await asyncio.sleep(LEASE_TICK)
+        try:
+            # Shared stores tell other workers; the log store remembers
+            # who held a lease across restarts.
+            renewed = leases.take_renewed()
+            if renewed:
+                with store.transaction():
+                    store.renew_leases(renewed)
+            expired = leases.advance()
+            if expired:
+                evict_expired(expired)
+        except Exception as e:
+            print(f"Error expiring leases: {e}")
+
+rendezvous = Rendezvous(on_failed=pair_failed, on_direct=pair_direct)
+signaling = Signaling()
+latency = LatencyMatrix()
+
+def broadcast(group: str, event: dict):
+    broadcaster.publish(group, event)
 
 class PeerRegister(BaseModel):
     group: str
     name: str
     public_key: str
     external_ip: str
-    external_port: int
+    external_port: int = Field(ge=0, le=65535)
+    # Address to reuse when rejoining after our lease expired, if still free.
+    internal_ip: Optional[str] = None
 
 class PeerInfo(BaseModel):
     peer_id: str
@@ -41,82 +342,217 @@ class PeerInfo(BaseModel):
     external_port: int
 
 @app.post("/register")
+@REQUEST_SECONDS.timed("register")
 async def register_peer(peer: PeerRegister):
     group = peer.group
-    if group not in groups:
-        groups[group] = {}
-        ws_connections[group] = []
-
-    # Uniqueness: public_key + external_ip + external_port
-    existing_peer_id = None
-    for pid, pinfo in groups[group].items():
-        if (
-            pinfo['public_key'] == peer.public_key and
-            pinfo['external_ip'] == peer.external_ip and
-            pinfo['external_port'] == peer.external_port
-        ):
-            existing_peer_id = pid
-            break
-
-    if existing_peer_id:
-        # Update existing peer
-        groups[group][existing_peer_id]["name"] = peer.name
-        # Optionally update external_ip/port if changed
-        groups[group][existing_peer_id]["external_ip"] = peer.external_ip
-        groups[group][existing_peer_id]["external_port"] = peer.external_port
-        peer_id = existing_peer_id
-        internal_ip = groups[group][existing_peer_id]["internal_ip"]
-    else:
-        # Assign internal IP (simple: 10.0.0.x/24)
-        used_ips = {info['internal_ip'] for info in groups[group].values()}
-        for i in range(2, 255):
-            ip = f"10.0.0.{i}"
-            if ip not in used_ips:
-                internal_ip = ip
-                break
+    with mutation():
+        ensure_group(group)
+
+        # Uniqueness: public_key + external_ip + external_port
+        existing = groups[group].find(peer.public_key, peer.external_ip, peer.external_port)
+
+        if existing:
+            # Update existing peer; endpoint is part of the match so only the
+            # name can differ.
+            peer_id = existing["peer_id"]
+            internal_ip = existing["internal_ip"]
+            if existing["name"] != peer.name:
+                existing["name"] = peer.name
+                record_event(group, {"event": "peer_added", "peer": dict(existing)})
         else:
-            return JSONResponse(status_code=400, content={"error": "No IPs available"})
-        peer_id = str(uuid.uuid4())
-        peer_info = {
-            "peer_id": peer_id,
-            "name": peer.name,
-            "public_key": peer.public_key,
-            "internal_ip": internal_ip,
-            "external_ip": peer.external_ip,
-            "external_port": peer.external_port
-        }
-        groups[group][peer_id] = peer_info
-
-    # Notify via websocket
-    for ws in ws_connections[group]:
-        await ws.send_json({"event": "peer_update", "peers": list(groups[group].values())})
-    return {"peer_id": peer_id, "internal_ip": internal_ip, "peers": list(groups[group].values())}
+            peer_info = None
+            if peer.internal_ip:
+                try:
+                    peer_info = groups[group].add(peer.name, peer.public_key, peer.external_ip,
+                                                  peer.external_port, internal_ip=peer.internal_ip)
+                except (OSError, ValueError):
+                    pass
+            if peer_info is None:
+                peer_info = groups[group].add(peer.name, peer.public_key, peer.external_ip, peer.external_port)
+            if peer_info is None:
+                return JSONResponse(status_code=400, content={"error": "No IPs available"})
+            peer_id = peer_info["peer_id"]
+            internal_ip = peer_info["internal_ip"]
+            record_event(group, {"event": "peer_added", "peer": dict(peer_info)})
+        renew_lease(group, peer_id)
+
+    return {
+        "peer_id": peer_id,
+        "internal_ip": internal_ip,
+        "subnet": groups[group].subnet,
+        "topology": TOPOLOGY.as_dict(),
+        "lease_ttl": LEASE_TTL,
+        "peers": list(groups[group].values()),
+        "epoch": store.epoch,
+        "revision": revisions[group],
+    }
 
 @app.post("/update")
-async def update_peer(peer_id: str, group: str, external_ip: str, external_port: int):
-    if group in groups and peer_id in groups[group]:
-        groups[group][peer_id]["external_ip"] = external_ip
-        groups[group][peer_id]["external_port"] = external_port
-        # Notify via websocket
-        for ws in ws_connections[group]:
-            await ws.send_json({"event": "peer_update", "peers": list(groups[group].values())})
-        return {"status": "updated"}
+@REQUEST_SECONDS.timed("update")
+async def update_peer(peer_id: str, group: str, external_ip: str, external_port: int = Query(ge=0, le=65535)):
+    with mutation():
+        existing = groups[group].peers.get(peer_id) if group in groups else None
+        if existing:
+            renew_lease(group, peer_id)
+        if existing and (existing["external_ip"], existing["external_port"]) == (external_ip, external_port):
+            return {"status": "unchanged"}
+        if group in groups and groups[group].set_endpoint(peer_id, external_ip, external_port):
+            record_event(group, {
+                "event": "peer_endpoint_changed",
+                "peer_id": peer_id,
+                "external_ip": external_ip,
+                "external_port": external_port,
+            })
+            return {"status": "updated"}
     return JSONResponse(status_code=404, content={"error": "Peer not found"})
 
 @app.get("/peers/{group}")
-async def get_peers(group: str):
-    if group in groups:
-        return list(groups[group].values())
-    return []
+async def get_peers(group: str, request: Request):
+    # Served from the per-revision cache: an unchanged group costs a 304 or
+    # a memory copy, never a re-serialization.
+    if group not in groups:
+        return []
+    snapshot = snapshots.get(group, store.epoch, revisions[group])
+    fmt = RECORDS if accepts(request.headers.get("accept"), RECORDS) else JSON
+    if snapshot.body(fmt) is None:
+        fmt = JSON  # a peer the record format cannot hold
+    headers = {
+        "ETag": snapshot.etag(fmt),
+        "Vary": "Accept, Accept-Encoding",
+        "X-Peers-Epoch": snapshot.epoch,
+        "X-Peers-Revision": str(snapshot.revision),
+    }
+    if matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    body = snapshot.body(fmt)
+    if len(body) >= GZIP_MIN_SIZE and accepts(request.headers.get("accept-encoding"), "gzip"):
+        body = snapshot.body(fmt, compressed=True)
+        headers["Content-Encoding"] = "gzip"
+    return Response(body, media_type=fmt, headers=headers)
+
+@app.get("/topology/{group}")
+async def get_topology(group: str):
+    return TOPOLOGY.describe(groups[group].values() if group in groups else [])
+
+@app.get("/punch/stats")
+async def punch_stats():
+    return rendezvous.stats()
+
+@app.get("/signal/stats")
+async def signal_stats():
+    return signaling.stats()
+
+@app.get("/latency/{group}")
+async def get_latency(group: str):
+    # RTT/loss each peer measured to the others, plus pairs that would do
+    # better through another peer (or the relay).
+    peers = groups[group].peers if group in groups else {}
+    return {
+        "peers": {peer_id: info.get("name") for peer_id, info in peers.items()},
+        "matrix": latency.matrix(group),
+        "suggestions": latency.suggestions(group, relay_available=relay is not None),
+    }
+
+@metrics_registry.collector
+def collect_state():
+    # Read from live state at scrape time, so none of it costs anything
+    # on the request paths.
+    yield ("coord_websocket_clients", "gauge", "Connected websocket clients.", ("group",),
+           [((group,), len(conns)) for group, conns in broadcaster.groups.items()])
+    yield ("coord_group_peers", "gauge", "Registered peers.", ("group",),
+           [((group,), len(peers)) for group, peers in groups.items()])
+    yield ("coord_group_revision", "gauge", "Latest event revision.", ("group",),
+           [((group,), revision) for group, revision in revisions.items()])
+    if leases is not None:
+        yield ("coord_leases", "gauge", "Peer leases being tracked.", (), [((), len(leases))])
+        yield ("coord_leases_expired_total", "counter", "Peer leases that ran out.", (), [((), leases.expired)])
+    sections = [("coord_punch", rendezvous.stats()), ("coord_signal", signaling.stats())]
+    if relay:
+        sections.append(("coord_relay", relay.stats()))
+    for prefix, stats in sections:
+        for key, value in stats.items():
+            yield (f"{prefix}_{key}", "gauge", f"{key} from {prefix}.", (), [((), value)])
+
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics_registry.render(), media_type=CONTENT_TYPE)
+
+@app.get("/relay/stats")
+async def relay_stats():
+    if relay is None:
+        return {"enabled": False}
+    return dict(relay.stats(), enabled=True)
+
+def handle_client_message(group: str, peer_id: Optional[str], name: Optional[str], conn, message: dict):
+    # Messages clients send over their websocket. Signaling needs a name
+    # (?name=, or the registered peer's); hole punching a registered peer
+    # (?peer_id=).
+    kind = message.get("type")
+    if kind == "signal" and name:
+        error = signaling.relay(group, name, message)
+        if error:
+            conn.send({"type": "signal_error", "to": message.get("to"), "session": message.get("session"),
+                       "error": error})
+        return
+    if kind == "rtc_open" and name:
+        signaling.report_open(message.get("seconds"))
+        return
+    if peer_id is None:
+        return
+    if kind == "punch_request":
+        error = rendezvous.request(group, groups[group].peers, peer_id, message.get("peer_id"))
+        if error:
+            conn.send({"type": "punch_failed", "peer_id": message.get("peer_id"), "error": error})
+    elif kind == "punch_result":
+        rendezvous.report(group, peer_id, message.get("punch_id"), bool(message.get("success")),
+                          message.get("elapsed"))
+    elif kind == "latency_report" and isinstance(message.get("peers"), dict):
+        latency.report(group, peer_id, message["peers"], groups[group].peers)
+    elif kind == "activate" and message.get("peer_id") in groups[group].peers:
+        # Lazy peers: the sender has traffic for this peer and wants it to
+        # turn its keepalive on towards the sender.
+        rendezvous.notify(group, message["peer_id"], {"type": "activate", "peer_id": peer_id})
 
 @app.websocket("/ws/{group}")
-async def websocket_endpoint(websocket: WebSocket, group: str):
+async def websocket_endpoint(websocket: WebSocket, group: str, since: Optional[int] = None,
+                             epoch: Optional[str] = None, peer_id: Optional[str] = None,
+                             name: Optional[str] = None):
     await websocket.accept()
-    if group not in ws_connections:
-        ws_connections[group] = []
-    ws_connections[group].append(websocket)
+    ensure_group(group)
+    # Catch-up events are queued ahead of any live event in the same step,
+    # so live events can never overtake them.
+    conn = broadcaster.add(group, websocket, catch_up_events(group, since, epoch))
+    if peer_id and peer_id not in groups[group].peers and store.shared:
+        # Registered through another worker a moment ago?
+        catch_up_store()
+    if peer_id not in groups[group].peers:
+        peer_id = None
+    if peer_id:
+        hold_lease(group, peer_id)
+        rendezvous.attach(group, peer_id, conn)
+        # A reconnecting peer gets its relay assignments again.
+        for pair in relay.pairs_of(group, peer_id) if relay else ():
+            other, = pair - {peer_id}
+            conn.send({"type": "relay", "peer_id": other, "endpoint": relay.endpoint(group, pair)})
+        name = groups[group].peers[peer_id]["name"]
+    if name:
+        signaling.attach(group, name, conn)
     try:
         while True:
-            await websocket.receive_text()  # keep alive
+            text = await websocket.receive_text()
+            try:
+                message = json.loads(text)
+            except ValueError:
+                continue  # keep-alive or junk
+            if isinstance(message, dict):
+                # Heartbeats only renew the lease; so does everything else.
+                renew_lease(group, peer_id)
+                handle_client_message(group, peer_id, name, conn, message)
     except WebSocketDisconnect:
-        ws_connections[group].remove(websocket)
+        pass
+    finally:
+        if name:
+            signaling.detach(group, name, conn)
+        if peer_id:
+            rendezvous.detach(group, peer_id, conn)
+        broadcaster.remove(conn)
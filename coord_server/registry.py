@@ -0,0 +1,179 @@
+import ipaddress
+import socket
+import uuid
+from collections import deque
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+DEFAULT_SUBNET = "10.0.0.0/24"
+
+
+class AddressPool:
+    """Hands out host addresses from a subnet in O(1): a bump pointer for
+    never-used addresses plus a FIFO free-list of released ones."""
+
+    def __init__(self, subnet: str = DEFAULT_SUBNET):
+        self.network = ipaddress.ip_network(subnet)
+        self.base = int(self.network.network_address)
+        # .1 is left for the subnet's first host, the last address is broadcast.
+        self.first = 2
+        self.last = self.network.num_addresses - 2
+        self.next_offset = self.first
+        self.free: deque = deque()
+        self.used: Set[int] = set()
+
+    def _offset(self, ip: str) -> int:
+        # inet_aton/ntoa are several times faster than ipaddress, which
+        # matters when a restart reserves every address in a large group.
+        if self.network.version == 4:
+            return int.from_bytes(socket.inet_aton(ip), "big") - self.base
+        return int(ipaddress.ip_address(ip)) - self.base
+
+    def _address(self, offset: int) -> str:
+        if self.network.version == 4:
+            return socket.inet_ntoa((self.base + offset).to_bytes(4, "big"))
+        return str(ipaddress.ip_address(self.base + offset))
+
+    def capacity(self) -> int:
+        return max(0, self.last - self.first + 1)
+
+    def allocate(self) -> Optional[str]:
+        while self.free:
+            offset = self.free.popleft()
+            # Entries can go stale when reserve() claims a released address.
+            if offset not in self.used:
+                break
+        else:
+            if self.next_offset > self.last:
+                return None
+            offset = self.next_offset
+            self.next_offset += 1
+        self.used.add(offset)
+        return self._address(offset)
+
+    def reserve(self, ip: str) -> bool:
+        """Marks a specific address as used, e.g. when restoring state."""
+        offset = self._offset(ip)
+        if offset < self.first or offset > self.last or offset in self.used:
+            return False
+        if offset >= self.next_offset:
+            self.free.extend(range(self.next_offset, offset))
+            self.next_offset = offset + 1
+        self.used.add(offset)
+        return True
+
+    def release(self, ip: str):
+        offset = self._offset(ip)
+        if offset in self.used:
+            self.used.discard(offset)
+            self.free.append(offset)
+
+
+class GroupRegistry:
+    """Peers of one group with hash indexes by peer id, public key and
+    (public_key, external_ip, external_port) identity."""
+
+    def __init__(self, subnet: str = DEFAULT_SUBNET):
+        self.pool = AddressPool(subnet)
+        self.peers: Dict[str, dict] = {}  # peer_id -> peer_info
+        # public_key -> ordered peer_ids (a key may register from several endpoints)
+        self.by_key: Dict[str, Dict[str, None]] = {}
+        self.by_endpoint: Dict[Tuple[str, str, int], str] = {}
+
+    @property
+    def subnet(self) -> str:
+        return str(self.pool.network)
+
+    def __len__(self) -> int:
+        return len(self.peers)
+
+    def __contains__(self, peer_id: str) -> bool:
+        return peer_id in self.peers
+
+    def get(self, peer_id: str) -> Optional[dict]:
+        return self.peers.get(peer_id)
+
+    def values(self) -> Iterable[dict]:
+        return self.peers.values()
+
+    def find(self, public_key: str, external_ip: str, external_port: int) -> Optional[dict]:
+        peer_id = self.by_endpoint.get((public_key, external_ip, external_port))
+        return self.peers.get(peer_id) if peer_id else None
+
+    def find_by_key(self, public_key: str) -> Optional[dict]:
+        ids = self.by_key.get(public_key)
+        return self.peers[next(iter(ids))] if ids else None
+
+    def add(self, name: str, public_key: str, external_ip: str, external_port: int,
+            peer_id: Optional[str] = None, internal_ip: Optional[str] = None) -> Optional[dict]:
+        """Adds a peer, allocating an address unless one is given. Returns None
+        when the subnet is exhausted or the given address is taken."""
+        if internal_ip is None:
+            internal_ip = self.pool.allocate()
+            if internal_ip is None:
+                return None
+        elif not self.pool.reserve(internal_ip):
+            return None
+        peer_info = {
+            "peer_id": peer_id or str(uuid.uuid4()),
+            "name": name,
+            "public_key": public_key,
+            "internal_ip": internal_ip,
+            "external_ip": external_ip,
+            "external_port": external_port,
+        }
+        self.insert(peer_info)
+        return peer_info
+
+    def insert(self, peer_info: dict):
+        peer_id = peer_info["peer_id"]
+        self.peers[peer_id] = peer_info
+        self.by_key.setdefault(peer_info["public_key"], {})[peer_id] = None
+        self.by_endpoint[self._endpoint_key(peer_info)] = peer_id
+
+    def remove(self, peer_id: str) -> Optional[dict]:
+        peer_info = self.peers.pop(peer_id, None)
+        if peer_info is None:
+            return None
+        ids = self.by_key.get(peer_info["public_key"])
+        if ids is not None:
+            ids.pop(peer_id, None)
+            if not ids:
+                del self.by_key[peer_info["public_key"]]
+        if self.by_endpoint.get(self._endpoint_key(peer_info)) == peer_id:
+            del self.by_endpoint[self._endpoint_key(peer_info)]
+        self.pool.release(peer_info["internal_ip"])
+        return peer_info
+
+    def set_endpoint(self, peer_id: str, external_ip: str, external_port: int) -> bool:
+        peer_info = self.peers.get(peer_id)
+        if peer_info is None:
+            return False
+        if self.by_endpoint.get(self._endpoint_key(peer_info)) == peer_id:
+            del self.by_endpoint[self._endpoint_key(peer_info)]
+        peer_info["external_ip"] = external_ip
+        peer_info["external_port"] = external_port
+        self.by_endpoint[self._endpoint_key(peer_info)] = peer_id
+        return True
+
+    def apply(self, event: dict):
+        """Replays a peer_* event recorded by another worker or a previous run."""
+        kind = event["event"]
+        if kind == "peer_added":
+            peer = event["peer"]
+            existing = self.peers.get(peer["peer_id"])
+            if existing:
+                existing["name"] = peer["name"]
+            else:
+                self.pool.reserve(peer["internal_ip"])
+                self.insert(dict(peer))
+        elif kind == "peer_removed":
+            self.remove(event["peer_id"])
+        elif kind == "peers_removed":
+            for peer_id in event["peer_ids"]:
+                self.remove(peer_id)
+        elif kind == "peer_endpoint_changed":
+            self.set_endpoint(event["peer_id"], event["external_ip"], event["external_port"])
+
+    @staticmethod
+    def _endpoint_key(peer_info: dict) -> Tuple[str, str, int]:
+        return (peer_info["public_key"], peer_info["external_ip"], peer_info["external_port"])
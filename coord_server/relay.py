@@ -0,0 +1,201 @@
+import asyncio
+import os
+import socket
+import time
+from typing import Dict, FrozenSet, Optional, Tuple
+
+Address = Tuple[str, int]
+Pair = FrozenSet[str]
+
+# Public address peers send relayed traffic to; the relay is off without it.
+RELAY_HOST = os.environ.get("COORD_RELAY_HOST", "")
+RELAY_BIND = os.environ.get("COORD_RELAY_BIND", "0.0.0.0")
+RELAY_PORTS = os.environ.get("COORD_RELAY_PORTS", "40000-44999")
+# Per-session token bucket, in bytes per second each way combined.
+RELAY_RATE = int(os.environ.get("COORD_RELAY_RATE", str(4 * 1024 * 1024)))
+RELAY_BURST = int(os.environ.get("COORD_RELAY_BURST", str(1024 * 1024)))
+# Sessions without traffic for this long are closed (relayed WireGuard
+# peers send a keepalive every 25s).
+RELAY_IDLE = float(os.environ.get("COORD_RELAY_IDLE", "180"))
+# Datagrams forwarded per readiness callback before yielding to the loop.
+DRAIN_BATCH = 64
+
+
+class RelaySession:
+    """Forwards datagrams between the two peers of one pair on one UDP port.
+
+    Both WireGuard peers are pointed at this port as if it were the other
+    peer. The relay never looks inside the (already encrypted) payload: it
+    learns each side's address from the source of its packets, accepting
+    only the peers' known public IPs, and sends every packet to the other
+    side's last address."""
+
+    def __init__(self, sock: socket.socket, pair: Tuple[str, str], ips: Tuple[str, str], rate: int, burst: int):
+        self.sock = sock
+        self.pair = pair
+        self.ips = ips
+        self.addrs: list = [None, None]  # learned (ip, port) for each side
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.refilled = time.monotonic()
+        self.last_seen = self.refilled
+        self.packets = 0
+        self.bytes = 0
+        self.dropped = 0
+
+    def _side(self, addr: Address) -> int:
+        if addr == self.addrs[0]:
+            return 0
+        if addr == self.addrs[1]:
+            return 1
+        # New source: a peer's NAT port or (roaming) address changed, or the
+        # first packet from it. Both peers behind one NAT share an IP, so the
+        # first unknown port takes the first unlearned side.
+        ip = addr[0]
+        for side in (0, 1):
+            if self.ips[side] == ip and self.addrs[side] is None:
+                break
+        else:
+            side = 0 if self.ips[0] == ip else 1 if self.ips[1] == ip else -1
+        if side >= 0:
+            self.addrs[side] = addr
+        return side
+
+    def route(self, addr: Address, size: int) -> Optional[Address]:
+        """Where a datagram of `size` bytes from `addr` goes, or None to drop it."""
+        side = self._side(addr)
+        if side < 0:
+            self.dropped += 1
+            return None
+        now = time.monotonic()
+        self.last_seen = now
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+        dest = self.addrs[1 - side]
+        if dest is None or self.tokens < size:
+            self.dropped += 1
+            return None
+        self.tokens -= size
+        self.packets += 1
+        self.bytes += size
+        return dest
+
+    def drain(self, buf: memoryview):
+        # Event loop reader callback. Unlike a DatagramProtocol, which gets
+        # one datagram (and one bytes copy) per wakeup, this forwards
+        # everything queued on the socket, up to a batch to stay fair to
+        # other sessions, through one shared buffer.
+        sock = self.sock
+        for _ in range(DRAIN_BATCH):
+            try:
+                n, addr = sock.recvfrom_into(buf)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                continue  # e.g. ICMP port unreachable from a vanished peer
+            dest = self.route(addr, n)
+            if dest is not None:
+                try:
+                    sock.sendto(buf[:n], dest)
+                except OSError:
+                    self.dropped += 1
+
+    def update_ip(self, peer_id: str, ip: str):
+        side = self.pair.index(peer_id)
+        ips = list(self.ips)
+        ips[side] = ip
+        self.ips = (ips[0], ips[1])
+        self.addrs[side] = None
+
+    def stats(self) -> dict:
+        return {"packets": self.packets, "bytes": self.bytes, "dropped": self.dropped}
+
+
+class Relay:
+    """Allocates one RelaySession (and UDP port) per peer pair that cannot
+    reach each other directly."""
+
+    def __init__(self, host: str = RELAY_HOST, bind: str = RELAY_BIND, ports: str = RELAY_PORTS,
+                 rate: int = RELAY_RATE, burst: int = RELAY_BURST):
+        self.host = host
+        self.bind = bind
+        low, high = (int(p) for p in ports.split("-"))
+        self.ports = range(low, high + 1)
+        self.next_port = 0
+        self.rate = rate
+        self.burst = burst
+        self.buffer = memoryview(bytearray(65536))  # shared: one loop, one packet at a time
+        self.sessions: Dict[Tuple[str, Pair], Tuple[int, RelaySession]] = {}  # (group, pair) -> (port, session)
+        self.closed_packets = 0
+        self.closed_bytes = 0
+        self.closed_dropped = 0
+
+    def endpoint(self, group: str, pair: Pair) -> Optional[str]:
+        entry = self.sessions.get((group, pair))
+        return f"{self.host}:{entry[0]}" if entry else None
+
+    def _socket(self) -> socket.socket:
+        # Round-robin over the range so a just-closed port is not reused
+        # while packets for the old session may still arrive.
+        for _ in range(len(self.ports)):
+            port = self.ports[self.next_port % len(self.ports)]
+            self.next_port += 1
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                sock.bind((self.bind, port))
+            except OSError:
+                sock.close()
+                continue  # in use, e.g. by another coordinator worker
+            sock.setblocking(False)
+            return sock
+        raise OSError("no free relay ports")
+
+    def open(self, group: str, a: str, b: str, ip_a: str, ip_b: str) -> str:
+        """Starts (or returns the existing) session for a pair; returns the
+        endpoint both peers should use for each other."""
+        pair = frozenset((a, b))
+        existing = self.endpoint(group, pair)
+        if existing:
+            return existing
+        sock = self._socket()
+        session = RelaySession(sock, (a, b), (ip_a, ip_b), self.rate, self.burst)
+        asyncio.get_running_loop().add_reader(sock.fileno(), session.drain, self.buffer)
+        self.sessions[(group, pair)] = (sock.getsockname()[1], session)
+        return self.endpoint(group, pair)
+
+    def close(self, group: str, pair: Pair) -> bool:
+        entry = self.sessions.pop((group, pair), None)
+        if entry is None:
+            return False
+        session = entry[1]
+        self.closed_packets += session.packets
+        self.closed_bytes += session.bytes
+        self.closed_dropped += session.dropped
+        asyncio.get_running_loop().remove_reader(session.sock.fileno())
+        session.sock.close()
+        return True
+
+    def pairs_of(self, group: str, peer_id: str):
+        return [pair for (g, pair) in self.sessions if g == group and peer_id in pair]
+
+    def update_ip(self, group: str, peer_id: str, ip: str):
+        for pair in self.pairs_of(group, peer_id):
+            self.sessions[(group, pair)][1].update_ip(peer_id, ip)
+
+    def expire_idle(self, idle: float = RELAY_IDLE):
+        """Closes sessions without traffic for `idle` seconds; returns their keys."""
+        cutoff = time.monotonic() - idle
+        expired = [key for key, (_, session) in self.sessions.items() if session.last_seen < cutoff]
+        for group, pair in expired:
+            self.close(group, pair)
+        return expired
+
+    def stats(self) -> dict:
+        sessions = [session for _, session in self.sessions.values()]
+        return {
+            "sessions": len(sessions),
+            "packets": self.closed_packets + sum(s.packets for s in sessions),
+            "bytes": self.closed_bytes + sum(s.bytes for s in sessions),
+            "dropped": self.closed_dropped + sum(s.dropped for s in sessions),
+        }
@@ -0,0 +1,166 @@
+import asyncio
+import time
+import uuid
+from collections import deque
+from typing import Callable, Dict, FrozenSet, Optional, Set, Tuple
+
+from coord_server.broadcast import Connection
+
+# Head start given to both peers so the punch messages reach them before
+# either starts sending.
+PUNCH_LEAD = 0.5
+# How long agents try before reporting failure; a punch nobody reports on
+# is failed a little after that.
+PUNCH_TIMEOUT = 12.0
+REPORT_GRACE = 3.0
+# Successful punch durations kept for the stats percentiles.
+DURATION_SAMPLES = 1000
+
+Pair = FrozenSet[str]
+
+
+class Punch:
+    def __init__(self, group: str, pair: Pair):
+        self.punch_id = uuid.uuid4().hex
+        self.group = group
+        self.pair = pair
+        self.started = time.monotonic()
+        self.reported: Set[str] = set()
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class Rendezvous:
+    """Coordinates simultaneous hole punching between two peers.
+
+    Peers that connected their websocket with their peer_id can ask for a
+    punch towards another peer. Both then get a `punch` message carrying the
+    other side's reflexive endpoint and the same `start_in` delay, so their
+    first packets cross in the NATs at about the same time. Each agent
+    reports a punch_result; pairs where neither side got through are kept in
+    `failed` until a later punch succeeds or one of them leaves.
+    on_failed(group, pair) and on_direct(group, pair) are called when a punch
+    fails or succeeds."""
+
+    def __init__(self, lead: float = PUNCH_LEAD, timeout: float = PUNCH_TIMEOUT,
+                 on_failed: Optional[Callable[[str, Pair], None]] = None,
+                 on_direct: Optional[Callable[[str, Pair], None]] = None):
+        self.lead = lead
+        self.timeout = timeout
+        self.on_failed = on_failed
+        self.on_direct = on_direct
+        self.conns: Dict[Tuple[str, str], Connection] = {}  # (group, peer_id) -> websocket
+        self.pending: Dict[str, Punch] = {}  # punch_id -> punch
+        self.by_pair: Dict[Tuple[str, Pair], str] = {}  # (group, pair) -> punch_id
+        self.failed: Dict[str, Set[Pair]] = {}  # group -> pairs without a direct path
+        self.durations: deque = deque(maxlen=DURATION_SAMPLES)
+        self.succeeded = 0
+        self.failures = 0
+
+    def attach(self, group: str, peer_id: str, conn: Connection):
+        self.conns[(group, peer_id)] = conn
+
+    def detach(self, group: str, peer_id: str, conn: Connection):
+        if self.conns.get((group, peer_id)) is conn:
+            del self.conns[(group, peer_id)]
+
+    def notify(self, group: str, peer_id: str, message: dict) -> bool:
+        conn = self.conns.get((group, peer_id))
+        if conn is None:
+            return False
+        conn.send(message)
+        return True
+
+    def clear_failed(self, group: str, pair: Pair):
+        self.failed.get(group, set()).discard(pair)
+
+    def forget_peer(self, group: str, peer_id: str):
+        failed = self.failed.get(group)
+        if failed:
+            self.failed[group] = {pair for pair in failed if peer_id not in pair}
+
+    def is_failed(self, group: str, a: str, b: str) -> bool:
+        return frozenset((a, b)) in self.failed.get(group, ())
+
+    def request(self, group: str, peers: Dict[str, dict], a: str, b: str) -> Optional[str]:
+        """Starts a punch between peers a and b; returns an error or None."""
+        if a == b or a not in peers or b not in peers:
+            return "unknown peer"
+        if (group, a) not in self.conns or (group, b) not in self.conns:
+            return "peer not connected"
+        pair = frozenset((a, b))
+        if (group, pair) in self.by_pair:
+            return None  # already punching; both sides get the same punch
+        punch = Punch(group, pair)
+        self.pending[punch.punch_id] = punch
+        self.by_pair[(group, pair)] = punch.punch_id
+        loop = asyncio.get_running_loop()
+        punch.timer = loop.call_later(self.lead + self.timeout + REPORT_GRACE, self._expire, punch.punch_id)
+        for me, other in ((a, b), (b, a)):
+            peer = peers[other]
+            self.conns[(group, me)].send({
+                "type": "punch",
+                "punch_id": punch.punch_id,
+                "peer_id": other,
+                "public_key": peer["public_key"],
+                "external_ip": peer["external_ip"],
+                "external_port": peer["external_port"],
+                "start_in": self.lead,
+                "timeout": self.timeout,
+            })
+        return None
+
+    def report(self, group: str, peer_id: str, punch_id: str, success: bool, elapsed: Optional[float]):
+        punch = self.pending.get(punch_id)
+        if punch is None or punch.group != group or peer_id not in punch.pair:
+            return
+        punch.reported.add(peer_id)
+        if success:
+            # A WireGuard handshake completes on both ends at once.
+            self._finish(punch, True, elapsed)
+        elif punch.reported == punch.pair:
+            self._finish(punch, False, None)
+
+    def _expire(self, punch_id: str):
+        punch = self.pending.get(punch_id)
+        if punch is not None:
+            self._finish(punch, False, None)
+
+    def _finish(self, punch: Punch, success: bool, elapsed: Optional[float]):
+        del self.pending[punch.punch_id]
+        del self.by_pair[(punch.group, punch.pair)]
+        if punch.timer:
+            punch.timer.cancel()
+        a, b = sorted(punch.pair)
+        if success:
+            self.succeeded += 1
+            self.durations.append(elapsed if elapsed is not None else time.monotonic() - punch.started)
+            self.failed.get(punch.group, set()).discard(punch.pair)
+            print(f"Punch {a} <-> {b} in {punch.group}: direct path in {self.durations[-1]:.2f}s")
+            if self.on_direct:
+                self.on_direct(punch.group, punch.pair)
+            return
+        self.failures += 1
+        self.failed.setdefault(punch.group, set()).add(punch.pair)
+        print(f"Punch {a} <-> {b} in {punch.group}: failed, needs a relay")
+        for me, other in ((a, b), (b, a)):
+            self.notify(punch.group, me, {"type": "punch_failed", "punch_id": punch.punch_id, "peer_id": other})
+        if self.on_failed:
+            self.on_failed(punch.group, punch.pair)
+
+    def stats(self) -> dict:
+        durations = sorted(self.durations)
+
+        def percentile(p: float) -> Optional[float]:
+            if not durations:
+                return None
+            return round(durations[min(len(durations) - 1, int(p * len(durations)))], 3)
+
+        return {
+            "pending": len(self.pending),
+            "succeeded": self.succeeded,
+            "failed": self.failures,
+            "failed_pairs": sum(len(pairs) for pairs in self.failed.values()),
+            "p50_seconds": percentile(0.5),
+            "p90_seconds": percentile(0.9),
+            "max_seconds": percentile(1.0),
+        }
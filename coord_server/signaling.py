@@ -0,0 +1,70 @@
+from collections import deque
+from typing import Dict, Optional, Set, Tuple
+
+from coord_server.broadcast import Connection
+
+# Signal kinds relayed between peers: SDP offers/answers and trickle ICE
+# candidates (a null candidate means end-of-candidates).
+SIGNAL_KINDS = ("offer", "answer", "candidate")
+# Reported data-channel open times kept for the stats percentiles.
+OPEN_SAMPLES = 1000
+
+
+class Signaling:
+    """WebRTC signaling between named peers of a group, carried over the
+    group websocket. Messages are forwarded as they arrive, so candidates can
+    trickle in while the other side is still gathering."""
+
+    def __init__(self):
+        self.names: Dict[Tuple[str, str], Set[Connection]] = {}  # (group, name) -> websockets
+        self.open_times: deque = deque(maxlen=OPEN_SAMPLES)
+        self.forwarded = 0
+        self.undeliverable = 0
+
+    def attach(self, group: str, name: str, conn: Connection):
+        self.names.setdefault((group, name), set()).add(conn)
+
+    def detach(self, group: str, name: str, conn: Connection):
+        conns = self.names.get((group, name))
+        if conns is not None:
+            conns.discard(conn)
+            if not conns:
+                del self.names[(group, name)]
+
+    def relay(self, group: str, sender: str, message: dict) -> Optional[str]:
+        """Forwards a signal to every connection of the named peer; returns an
+        error for the sender or None."""
+        kind = message.get("kind")
+        if kind not in SIGNAL_KINDS:
+            return "unknown signal kind"
+        conns = self.names.get((group, message.get("to")))
+        if not conns:
+            self.undeliverable += 1
+            return "peer not connected"
+        out = {"type": "signal", "kind": kind, "from": sender, "session": message.get("session"),
+               "data": message.get("data")}
+        for conn in conns:
+            conn.send(out)
+        self.forwarded += 1
+        return None
+
+    def report_open(self, seconds) -> None:
+        if isinstance(seconds, (int, float)) and 0 <= seconds < 3600:
+            self.open_times.append(float(seconds))
+
+    def stats(self) -> dict:
+        times = sorted(self.open_times)
+
+        def percentile(p: float) -> Optional[float]:
+            if not times:
+                return None
+            return round(times[min(len(times) - 1, int(p * len(times)))], 3)
+
+        return {
+            "connected": sum(len(conns) for conns in self.names.values()),
+            "forwarded": self.forwarded,
+            "undeliverable": self.undeliverable,
+            "channels_opened": len(times),
+            "open_p50_seconds": percentile(0.5),
+            "open_p90_seconds": percentile(0.9),
+        }
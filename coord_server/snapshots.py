@@ -0,0 +1,93 @@
+import gzip
+import json
+import struct
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+import peer_records
+
+JSON = "application/json"
+RECORDS = peer_records.CONTENT_TYPE
+# Bodies smaller than this are sent uncompressed; gzip would not pay for
+# its own header and CPU.
+GZIP_MIN_SIZE = 1024
+GZIP_LEVEL = 6
+
+
+class Snapshot:
+    """One group revision's peer list, encoded once per format and
+    encoding on first use and then served from memory."""
+
+    def __init__(self, epoch: str, revision: int, peers: list):
+        self.epoch = epoch
+        self.revision = revision
+        self.peers = peers
+        self.bodies: Dict[Tuple[str, bool], Optional[bytes]] = {}  # (format, gzip) -> body
+        self.text: Optional[str] = None
+
+    def etag(self, fmt: str) -> str:
+        # Weak: the gzip and identity bodies of a format share the tag.
+        return f'W/"{self.epoch}-{self.revision}-{"bin" if fmt == RECORDS else "json"}"'
+
+    def json_text(self) -> str:
+        if self.text is None:
+            self.text = self.body(JSON).decode()
+        return self.text
+
+    def body(self, fmt: str, compressed: bool = False) -> Optional[bytes]:
+        """The encoded peer list, or None if fmt cannot represent it."""
+        key = (fmt, compressed)
+        if key not in self.bodies:
+            if compressed:
+                raw = self.body(fmt)
+                self.bodies[key] = None if raw is None else gzip.compress(raw, GZIP_LEVEL, mtime=0)
+            elif fmt == RECORDS:
+                try:
+                    self.bodies[key] = peer_records.encode(self.peers)
+                except (ValueError, KeyError, TypeError, struct.error):
+                    self.bodies[key] = None
+            else:
+                self.bodies[key] = json.dumps(self.peers, separators=(",", ":")).encode()
+        return self.bodies[key]
+
+
+class SnapshotCache:
+    """Latest Snapshot per group, rebuilt only when the group's revision
+    (or the store epoch) moves. Polling clients and websocket resyncs of an
+    unchanged group all share one serialization."""
+
+    def __init__(self, peers: Callable[[str], Iterable[dict]]):
+        self.peers = peers  # group -> current peer dicts
+        self.snapshots: Dict[str, Snapshot] = {}
+        self.builds = 0
+
+    def get(self, group: str, epoch: str, revision: int) -> Snapshot:
+        snapshot = self.snapshots.get(group)
+        if snapshot is None or snapshot.revision != revision or snapshot.epoch != epoch:
+            snapshot = Snapshot(epoch, revision, list(self.peers(group)))
+            self.snapshots[group] = snapshot
+            self.builds += 1
+        return snapshot
+
+    def forget(self, group: str):
+        self.snapshots.pop(group, None)
+
+
+def matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match uses weak comparison: W/ prefixes are ignored."""
+    if not if_none_match:
+        return False
+    wanted = etag[2:] if etag.startswith("W/") else etag
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or (tag[2:] if tag.startswith("W/") else tag) == wanted:
+            return True
+    return False
+
+
+def accepts(header: Optional[str], token: str) -> bool:
+    """Whether an Accept or Accept-Encoding header lists token without q=0."""
+    for part in (header or "").split(","):
+        value, *params = [item.strip() for item in part.split(";")]
+        if value == token:
+            return not any(param.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000") for param in params)
+    return False
@@ -0,0 +1,350 @@
+import contextlib
+import json
+import os
+import sqlite3
+import uuid
+from typing import Dict, List, Set, Tuple
+
+# Shared events kept for workers that are still catching up; a worker that
+# falls further behind than this reloads full state instead.
+SHARED_EVENTS_KEPT = 10000
+# Log events appended before the log store folds them into a new snapshot.
+COMPACT_EVERY = 50000
+
+
+class StoreReset(Exception):
+    """Raised by poll() when events were missed and state must be reloaded."""
+
+
+class MemoryStore:
+    """State lives only in this process; for a single uvicorn worker."""
+
+    shared = False
+
+    def __init__(self):
+        self.epoch = uuid.uuid4().hex
+
+    def load(self) -> Dict[str, Tuple[int, List[dict]]]:
+        return {}
+
+    def transaction(self):
+        # Handlers never await while mutating, so the event loop already
+        # serializes them.
+        return contextlib.nullcontext()
+
+    def append(self, group: str, event: dict):
+        pass
+
+    def poll(self) -> List[Tuple[str, dict]]:
+        return []
+
+    def needs_compaction(self) -> bool:
+        return False
+
+    def compact(self, state: Dict[str, Tuple[int, List[dict]]]):
+        pass
+
+    def renew_leases(self, leases: Dict[Tuple[str, str], float]):
+        # One worker: its own lease wheel is the whole truth.
+        pass
+
+    def lease_deadlines(self, group: str, peer_ids: List[str]) -> Dict[str, float]:
+        return {}
+
+    def close(self):
+        pass
+
+
+class SqliteStore:
+    """State shared by every worker on one host through a SQLite database in
+    WAL mode. The events table doubles as the cross-worker pub/sub channel:
+    each worker polls for rows written by the others."""
+
+    shared = True
+
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA busy_timeout=5000")
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS groups (name TEXT PRIMARY KEY, revision INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS peers (
+                grp TEXT NOT NULL, peer_id TEXT NOT NULL, info TEXT NOT NULL,
+                PRIMARY KEY (grp, peer_id)
+            );
+            CREATE TABLE IF NOT EXISTS events (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT, grp TEXT NOT NULL, payload TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS leases (
+                grp TEXT NOT NULL, peer_id TEXT NOT NULL, deadline REAL NOT NULL,
+                PRIMARY KEY (grp, peer_id)
+            );
+        """)
+        self.db.execute(
+            "INSERT OR IGNORE INTO meta (key, value) VALUES ('epoch', ?)", (uuid.uuid4().hex,)
+        )
+        self.epoch = self.db.execute("SELECT value FROM meta WHERE key = 'epoch'").fetchone()[0]
+        self.last_seq = 0
+
+    def load(self) -> Dict[str, Tuple[int, List[dict]]]:
+        """Current state of every group: name -> (revision, peers)."""
+        self.db.execute("BEGIN")
+        try:
+            self.last_seq = self.db.execute("SELECT COALESCE(MAX(seq), 0) FROM events").fetchone()[0]
+            state = {name: (revision, []) for name, revision in self.db.execute("SELECT name, revision FROM groups")}
+            for grp, info in self.db.execute("SELECT grp, info FROM peers ORDER BY rowid"):
+                state[grp][1].append(json.loads(info))
+        finally:
+            self.db.execute("COMMIT")
+        return state
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # BEGIN IMMEDIATE takes the database write lock, so mutations from all
+        # workers are serialized and revisions stay contiguous.
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+    def append(self, group: str, event: dict):
+        kind = event["event"]
+        if kind == "peer_added":
+            peer = event["peer"]
+            self.db.execute(
+                "INSERT INTO peers (grp, peer_id, info) VALUES (?, ?, ?) "
+                "ON CONFLICT (grp, peer_id) DO UPDATE SET info = excluded.info",
+                (group, peer["peer_id"], json.dumps(peer)),
+            )
+        elif kind == "peer_removed":
+            self.db.execute("DELETE FROM peers WHERE grp = ? AND peer_id = ?", (group, event["peer_id"]))
+            self.db.execute("DELETE FROM leases WHERE grp = ? AND peer_id = ?", (group, event["peer_id"]))
+        elif kind == "peers_removed":
+            rows = [(group, peer_id) for peer_id in event["peer_ids"]]
+            self.db.executemany("DELETE FROM peers WHERE grp = ? AND peer_id = ?", rows)
+            self.db.executemany("DELETE FROM leases WHERE grp = ? AND peer_id = ?", rows)
+        elif kind == "peer_endpoint_changed":
+            row = self.db.execute(
+                "SELECT info FROM peers WHERE grp = ? AND peer_id = ?", (group, event["peer_id"])
+            ).fetchone()
+            if row:
+                peer = json.loads(row[0])
+                peer["external_ip"] = event["external_ip"]
+                peer["external_port"] = event["external_port"]
+                self.db.execute(
+                    "UPDATE peers SET info = ? WHERE grp = ? AND peer_id = ?",
+                    (json.dumps(peer), group, event["peer_id"]),
+                )
+        self.db.execute(
+            "INSERT INTO groups (name, revision) VALUES (?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET revision = excluded.revision",
+            (group, event["revision"]),
+        )
+        cur = self.db.execute("INSERT INTO events (grp, payload) VALUES (?, ?)", (group, json.dumps(event)))
+        self.last_seq = cur.lastrowid
+        if self.last_seq % 1000 == 0:
+            self.db.execute("DELETE FROM events WHERE seq <= ?", (self.last_seq - SHARED_EVENTS_KEPT,))
+
+    def poll(self) -> List[Tuple[str, dict]]:
+        """Events written by other workers since we last looked."""
+        rows = self.db.execute(
+            "SELECT seq, grp, payload FROM events WHERE seq > ? ORDER BY seq", (self.last_seq,)
+        ).fetchall()
+        if not rows:
+            return []
+        if rows[0][0] != self.last_seq + 1:
+            oldest = self.db.execute("SELECT MIN(seq) FROM events").fetchone()[0]
+            if oldest > self.last_seq + 1:
+                raise StoreReset(f"missed events {self.last_seq + 1}..{oldest - 1}")
+        self.last_seq = rows[-1][0]
+        return [(grp, json.loads(payload)) for _, grp, payload in rows]
+
+    def needs_compaction(self) -> bool:
+        return False
+
+    def compact(self, state: Dict[str, Tuple[int, List[dict]]]):
+        pass
+
+    def renew_leases(self, leases: Dict[Tuple[str, str], float]):
+        """Publishes lease renewals seen by this worker, so another worker's
+        wheel does not expire a peer whose websocket lives here."""
+        self.db.executemany(
+            "INSERT INTO leases (grp, peer_id, deadline) VALUES (?, ?, ?) "
+            "ON CONFLICT (grp, peer_id) DO UPDATE SET deadline = MAX(deadline, excluded.deadline)",
+            [(group, peer_id, deadline) for (group, peer_id), deadline in leases.items()],
+        )
+
+    def lease_deadlines(self, group: str, peer_ids: List[str]) -> Dict[str, float]:
+        result = {}
+        for peer_id in peer_ids:
+            row = self.db.execute(
+                "SELECT deadline FROM leases WHERE grp = ? AND peer_id = ?", (group, peer_id)
+            ).fetchone()
+            if row:
+                result[peer_id] = row[0]
+        return result
+
+    def close(self):
+        self.db.close()
+
+
+class LogStore(MemoryStore):
+    """Durable single-worker state: every event is appended to a log segment
+    and the registry is periodically compacted into a snapshot. Startup loads
+    the snapshot and replays only the segments written after it.
+
+    Appends are flushed to the OS on every write, which survives a
+    coordinator crash or restart; snapshots are fsynced."""
+
+    def __init__(self, directory: str, compact_every: int = COMPACT_EVERY):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.compact_every = compact_every
+        self.snapshot_path = os.path.join(directory, "snapshot.json")
+        # Peers that ever held a lease, so a restart still expires the ones
+        # that never come back. Deadlines are not kept: the wheel re-arms
+        # every loaded peer with a full TTL anyway.
+        self.leases_path = os.path.join(directory, "leases.json")
+        self.held: Set[Tuple[str, str]] = set()
+        self.pending = 0  # events appended since the last snapshot
+        self.segment = 0
+        self.log = None
+        self.epoch = uuid.uuid4().hex
+
+    def _segment_path(self, number: int) -> str:
+        return os.path.join(self.directory, f"events.{number:08d}.log")
+
+    def _segments(self) -> List[int]:
+        numbers = []
+        for name in os.listdir(self.directory):
+            if name.startswith("events.") and name.endswith(".log"):
+                numbers.append(int(name[len("events."):-len(".log")]))
+        return sorted(numbers)
+
+    def load(self) -> Dict[str, Tuple[int, List[dict]]]:
+        covered = -1
+        groups: Dict[str, Tuple[int, Dict[str, dict]]] = {}
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path) as f:
+                snapshot = json.load(f)
+            self.epoch = snapshot["epoch"]
+            covered = snapshot["segment"]
+            for name, group in snapshot["groups"].items():
+                groups[name] = (group["revision"], {p["peer_id"]: p for p in group["peers"]})
+        segments = [n for n in self._segments() if n > covered]
+        for number in segments:
+            with open(self._segment_path(number)) as f:
+                for line in f:
+                    try:
+                        name, event = json.loads(line)
+                    except ValueError:
+                        break  # torn write at the tail of a crashed segment
+                    revision, peers = groups.get(name, (0, {}))
+                    if event["revision"] > revision:
+                        _replay(peers, event)
+                        groups[name] = (event["revision"], peers)
+                    self.pending += 1
+        if os.path.exists(self.leases_path):
+            with open(self.leases_path) as f:
+                self.held = {(name, peer_id) for name, peer_id in json.load(f)
+                             if name in groups and peer_id in groups[name][1]}
+        self.segment = max(segments + [covered]) + 1
+        self.log = open(self._segment_path(self.segment), "a")
+        state = {name: (revision, list(peers.values())) for name, (revision, peers) in groups.items()}
+        if not os.path.exists(self.snapshot_path):
+            # Pins the epoch; the segments just replayed are folded into it.
+            self.compact(state)
+        return state
+
+    def append(self, group: str, event: dict):
+        self.log.write(json.dumps([group, event], separators=(",", ":")) + "\n")
+        self.log.flush()
+        self.pending += 1
+        # Removed peers linger in leases.json until its next write; load()
+        # drops entries for peers that no longer exist.
+        if event["event"] == "peer_removed":
+            self.held.discard((group, event["peer_id"]))
+        elif event["event"] == "peers_removed":
+            self.held.difference_update((group, peer_id) for peer_id in event["peer_ids"])
+
+    def renew_leases(self, leases: Dict[Tuple[str, str], float]):
+        if all(key in self.held for key in leases):
+            return
+        self.held.update(leases)
+        tmp_path = self.leases_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(json.dumps(sorted(self.held), separators=(",", ":")))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.leases_path)
+
+    def lease_deadlines(self, group: str, peer_ids: List[str]) -> Dict[str, float]:
+        # Held, deadline unknown: only the wheel's own deadline counts.
+        return {peer_id: 0.0 for peer_id in peer_ids if (group, peer_id) in self.held}
+
+    def needs_compaction(self) -> bool:
+        return self.pending >= self.compact_every
+
+    def compact(self, state: Dict[str, Tuple[int, List[dict]]]):
+        """Writes `state` (which must include every appended event) as the new
+        snapshot and drops the log segments it covers."""
+        covered = self.segment
+        self.log.close()
+        self.segment += 1
+        self.log = open(self._segment_path(self.segment), "a")
+        snapshot = {
+            "epoch": self.epoch,
+            "segment": covered,
+            "groups": {
+                name: {"revision": revision, "peers": peers}
+                for name, (revision, peers) in state.items()
+            },
+        }
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(json.dumps(snapshot, separators=(",", ":")))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        for number in self._segments():
+            if number <= covered:
+                os.remove(self._segment_path(number))
+        self.pending = 0
+
+    def close(self):
+        if self.log:
+            self.log.close()
+            self.log = None
+
+
+def _replay(peers: Dict[str, dict], event: dict):
+    kind = event["event"]
+    if kind == "peer_added":
+        peers[event["peer"]["peer_id"]] = event["peer"]
+    elif kind == "peer_removed":
+        peers.pop(event["peer_id"], None)
+    elif kind == "peers_removed":
+        for peer_id in event["peer_ids"]:
+            peers.pop(peer_id, None)
+    elif kind == "peer_endpoint_changed" and event["peer_id"] in peers:
+        peers[event["peer_id"]]["external_ip"] = event["external_ip"]
+        peers[event["peer_id"]]["external_port"] = event["external_port"]
+
+
+def open_store(url: str):
+    """memory:// (default), sqlite:///path/to/state.db or log:///path/to/dir"""
+    if not url or url == "memory://":
+        return MemoryStore()
+    if url.startswith("sqlite:///"):
+        path = url[len("sqlite:///"):]
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        return SqliteStore(path)
+    if url.startswith("log:///"):
+        return LogStore(url[len("log:///"):])
+    raise ValueError(f"Unsupported COORD_STORE {url!r}")
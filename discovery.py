@@ -1,25 +1,226 @@
-import stun
+"""Public endpoint discovery over STUN (RFC 5389 binding requests).
+
+Queries several STUN servers at once from the port WireGuard (or the
+userspace tunnel) listens on, so the reported mapping is the one peers will
+actually reach, and returns as soon as two servers agree. Comparing the
+mappings different servers see also tells us the NAT type: one mapping for
+every destination is endpoint-independent (hole punching works), a mapping
+per destination is symmetric. Results are cached per local port.
+"""
+import asyncio
+import collections
+import errno
+import os
+import secrets
 import socket
+import struct
+import time
+
+STUN_SERVERS = [
+    s.strip() for s in os.environ.get(
+        'STUN_SERVERS',
+        'stun.l.google.com:19302,stun1.l.google.com:19302,stun.cloudflare.com:3478,stun.nextcloud.com:3478',
+    ).split(',') if s.strip()
+]
+STUN_TIMEOUT = float(os.environ.get('STUN_TIMEOUT', '3'))
+STUN_CACHE_TTL = float(os.environ.get('STUN_CACHE_TTL', '60'))
+
+MAGIC_COOKIE = 0x2112A442
+BINDING_REQUEST = 0x0001
+BINDING_SUCCESS = 0x0101
+ATTR_MAPPED_ADDRESS = 0x0001
+ATTR_XOR_MAPPED_ADDRESS = 0x0020
+INITIAL_RTO = 0.5
+
+NAT_OPEN = 'open'
+NAT_ENDPOINT_INDEPENDENT = 'endpoint-independent'
+NAT_SYMMETRIC = 'symmetric'
+NAT_UNKNOWN = 'unknown'
+NAT_BLOCKED = 'blocked'
+
+Discovery = collections.namedtuple(
+    'Discovery', ['external_ip', 'external_port', 'nat_type', 'local_port', 'answers']
+)
+
+_cache = {}  # local port -> (expires at, Discovery)
+
+
+def binding_request(transaction_id):
+    return struct.pack('!HHI12s', BINDING_REQUEST, 0, MAGIC_COOKIE, transaction_id)
+
+
+def parse_binding_response(data):
+    """(transaction id, (ip, port)) from a binding success response, or None."""
+    if len(data) < 20:
+        return None
+    msg_type, length, cookie, transaction_id = struct.unpack_from('!HHI12s', data)
+    if msg_type != BINDING_SUCCESS or cookie != MAGIC_COOKIE:
+        return None
+    mapped = None
+    offset, end = 20, min(len(data), 20 + length)
+    while offset + 4 <= end:
+        attr_type, attr_len = struct.unpack_from('!HH', data, offset)
+        value = data[offset + 4:offset + 4 + attr_len]
+        # Only IPv4 mappings: family 0x01 and a 4 byte address.
+        if attr_type in (ATTR_XOR_MAPPED_ADDRESS, ATTR_MAPPED_ADDRESS) and len(value) >= 8 and value[1] == 1:
+            port, = struct.unpack_from('!H', value, 2)
+            address = value[4:8]
+            if attr_type == ATTR_XOR_MAPPED_ADDRESS:
+                port ^= MAGIC_COOKIE >> 16
+                address = (int.from_bytes(address, 'big') ^ MAGIC_COOKIE).to_bytes(4, 'big')
+            mapped = (socket.inet_ntoa(address), port)
+            if attr_type == ATTR_XOR_MAPPED_ADDRESS:
+                break
+        offset += 4 + (attr_len + 3) // 4 * 4
+    return (transaction_id, mapped) if mapped else None
+
+
+class _StunProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.pending = {}  # transaction id -> future
+
+    def datagram_received(self, data, addr):
+        parsed = parse_binding_response(data)
+        if parsed is None:
+            return
+        future = self.pending.pop(parsed[0], None)
+        if future is not None and not future.done():
+            future.set_result(parsed[1])
+
+
+def parse_server(server):
+    host, _, port = server.rpartition(':')
+    return host, int(port)
+
+
+def classify(answers, local_ips, local_port):
+    mappings = {mapped for _, mapped in answers}
+    if not answers:
+        return NAT_BLOCKED
+    if len(mappings) > 1:
+        return NAT_SYMMETRIC
+    ip, port = next(iter(mappings))
+    if ip in local_ips and port == local_port:
+        return NAT_OPEN
+    if len(answers) == 1:
+        return NAT_UNKNOWN
+    return NAT_ENDPOINT_INDEPENDENT
 
-def get_public_info():
-    # Attempt to use a common Google STUN server
-    print("Requesting details from STUN server...")
+
+def _bind(port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.bind(('', port))
+    except OSError as e:
+        if e.errno != errno.EADDRINUSE or not port:
+            raise
+        print(f"Port {port} is in use, discovering from an ephemeral port instead.")
+        sock.bind(('', 0))
+    sock.setblocking(False)
+    return sock
+
+
+async def _query(protocol, transport, server, deadline):
+    loop = asyncio.get_running_loop()
+    host, port = parse_server(server)
+    infos = await loop.getaddrinfo(host, port, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+    addr = infos[0][4]
+    transaction_id = secrets.token_bytes(12)
+    future = protocol.pending[transaction_id] = loop.create_future()
+    rto = INITIAL_RTO
+    try:
+        while True:
+            transport.sendto(binding_request(transaction_id), addr)
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise asyncio.TimeoutError
+            try:
+                return addr, await asyncio.wait_for(asyncio.shield(future), min(rto, remaining))
+            except asyncio.TimeoutError:
+                rto *= 2
+    finally:
+        protocol.pending.pop(transaction_id, None)
+
+
+def _local_ips(server_addrs):
+    # The address the kernel would send from; matching it means no NAT.
+    ips = set()
+    for addr in server_addrs[:1]:
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            probe.connect(addr)
+            ips.add(probe.getsockname()[0])
+        except OSError:
+            pass
+        finally:
+            probe.close()
+    return ips
+
+
+async def discover(port=0, servers=None, timeout=STUN_TIMEOUT, use_cache=True):
+    """Returns a Discovery for `port`. `answers` lists the (server address,
+    mapping) pairs that came back; external_ip is None if none did."""
+    cached = _cache.get(port)
+    if use_cache and cached and cached[0] > time.monotonic():
+        return cached[1]
+    loop = asyncio.get_running_loop()
+    sock = _bind(port)
+    local_port = sock.getsockname()[1]
+    protocol = _StunProtocol()
+    transport, _ = await loop.create_datagram_endpoint(lambda: protocol, sock=sock)
+    deadline = loop.time() + timeout
+    tasks = [asyncio.create_task(_query(protocol, transport, s, deadline)) for s in servers or STUN_SERVERS]
+    answers = []
+    seen = collections.Counter()
+    try:
+        for task in asyncio.as_completed(tasks):
+            try:
+                addr, mapped = await task
+            except (OSError, asyncio.TimeoutError):
+                continue
+            answers.append((addr, mapped))
+            seen[mapped] += 1
+            if seen[mapped] >= 2:
+                break
+    finally:
+        for task in tasks:
+            task.cancel()
+        transport.close()
+
+    nat_type = classify(answers, _local_ips([addr for addr, _ in answers]), local_port)
+    if not answers:
+        return Discovery(None, None, nat_type, local_port, answers)
+    (external_ip, external_port), _ = seen.most_common(1)[0]
+    if local_port != port and port and external_port == local_port:
+        # Probed from a stand-in port because the real one is busy; the NAT
+        # preserved that port, so it most likely preserves ours too.
+        external_port = port
+    result = Discovery(external_ip, external_port, nat_type, local_port, answers)
+    _cache[port] = (time.monotonic() + STUN_CACHE_TTL, result)
+    return result
+
+
+def print_discovery(result):
+    print("\n--- Network Info ---")
+    print(f"NAT Type:     {result.nat_type}")
+    print(f"External IP:   {result.external_ip}")
+    print(f"External Port: {result.external_port}")
+    print(f"STUN answers:  {len(result.answers)}")
+    print("--------------------")
+
+
+def get_public_info(port=0):
+    """Blocking wrapper for scripts: (external_ip, external_port), or
+    (None, None) if no STUN server answered."""
+    print("Requesting details from STUN servers...")
     try:
-        nat_type, external_ip, external_port = stun.get_ip_info(
-            stun_host='stun.l.google.com', 
-            stun_port=19302
-        )
-        
-        print("\n--- Network Info ---")
-        print(f"NAT Type:     {nat_type}")
-        print(f"External IP:   {external_ip}")
-        print(f"External Port: {external_port}")
-        print("--------------------")
-        
-        return external_ip, external_port
-    except Exception as e:
+        result = asyncio.run(discover(port))
+    except OSError as e:
         print(f"Error: {e}")
         return None, None
+    print_discovery(result)
+    return result.external_ip, result.external_port
+
 
 if __name__ == "__main__":
     get_public_info()
@@ -0,0 +1,134 @@
+"""Notices when our public endpoint changes (roaming between networks).
+
+Listens for rtnetlink address, link and default-route events, which is how
+a laptop switching Wi-Fi networks or a phone moving to cellular shows up
+locally, and re-runs STUN shortly after each burst. A periodic STUN check
+also catches NAT rebinding that produces no local event. `on_change(ip,
+port)` is awaited whenever the mapping differs from the last one reported.
+"""
+import asyncio
+import os
+import socket
+import struct
+
+from discovery import discover
+
+STUN_INTERVAL = float(os.environ.get('WG_STUN_INTERVAL', '60'))
+# Network switches arrive as a burst of events; wait for it to settle.
+SETTLE_DELAY = 1.0
+RETRY_INTERVAL = 5.0
+
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+RTM_NEWLINK, RTM_DELLINK = 16, 17
+RTM_NEWADDR, RTM_DELADDR = 20, 21
+RTM_NEWROUTE, RTM_DELROUTE = 24, 25
+NLMSG_HEADER = struct.Struct('=IHHII')
+
+
+def open_netlink():
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+    sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV4_ROUTE))
+    sock.setblocking(False)
+    return sock
+
+
+def relevant_events(data, ignore_index):
+    """Counts messages in a netlink datagram that can change our endpoint:
+    address and link changes on interfaces other than `ignore_index`, and
+    default route changes. Routes WireGuard adds for AllowedIPs never match."""
+    count = 0
+    offset = 0
+    while offset + NLMSG_HEADER.size <= len(data):
+        length, msg_type, _, _, _ = NLMSG_HEADER.unpack_from(data, offset)
+        if length < NLMSG_HEADER.size:
+            break
+        body = offset + NLMSG_HEADER.size
+        if msg_type in (RTM_NEWADDR, RTM_DELADDR):
+            index, = struct.unpack_from('=I', data, body + 4)
+            count += index != ignore_index
+        elif msg_type in (RTM_NEWLINK, RTM_DELLINK):
+            index, = struct.unpack_from('=i', data, body + 4)
+            count += index != ignore_index
+        elif msg_type in (RTM_NEWROUTE, RTM_DELROUTE):
+            dst_len = data[body + 1]
+            count += dst_len == 0
+        offset += (length + 3) & ~3
+    return count
+
+
+class EndpointMonitor:
+    def __init__(self, port, on_change, current=None, ignore_ifname=None, interval=STUN_INTERVAL):
+        self.port = port
+        self.on_change = on_change
+        self.current = current
+        self.ignore_ifname = ignore_ifname
+        self.interval = interval
+        self.wakeup = asyncio.Event()
+        self.checks = 0
+        self.changes = 0
+
+    def _ignore_index(self):
+        try:
+            return socket.if_nametoindex(self.ignore_ifname) if self.ignore_ifname else 0
+        except OSError:
+            return 0
+
+    def _on_netlink(self, sock):
+        try:
+            while True:
+                if relevant_events(sock.recv(65536), self._ignore_index()):
+                    self.wakeup.set()
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            print(f'Netlink read failed: {e}')
+
+    async def check(self):
+        """Runs STUN once; returns False if no server answered."""
+        self.checks += 1
+        info = await discover(self.port, use_cache=False)
+        if info.external_ip is None:
+            return False
+        port = info.external_port
+        if info.local_port != self.port and port != self.port and self.current:
+            # Probed from a stand-in port whose mapping says nothing about the
+            # listen port's; only trust the address.
+            port = self.current[1]
+        endpoint = (info.external_ip, port)
+        if endpoint != self.current:
+            print(f'Public endpoint changed: {self.current} -> {endpoint} ({info.nat_type} NAT)')
+            await self.on_change(*endpoint)
+            self.current = endpoint
+            self.changes += 1
+        return True
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        sock = None
+        try:
+            sock = open_netlink()
+            loop.add_reader(sock.fileno(), self._on_netlink, sock)
+        except OSError as e:
+            print(f'Netlink unavailable ({e}), relying on periodic STUN only.')
+        try:
+            timeout = self.interval
+            while True:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                    await asyncio.sleep(SETTLE_DELAY)
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+                try:
+                    ok = await self.check()
+                except Exception as e:
+                    print(f'Endpoint check failed: {e}')
+                    ok = False
+                # While the network is down, keep retrying until STUN answers.
+                timeout = self.interval if ok else RETRY_INTERVAL
+        finally:
+            if sock is not None:
+                loop.remove_reader(sock.fileno())
+                sock.close()
@@ -0,0 +1,143 @@
+"""Agent side of coordinator-orchestrated hole punching.
+
+The coordinator sends both peers a `punch` message with the other side's
+reflexive endpoint and a common start delay. WireGuard owns the listen
+port, so the punch packets are WireGuard's own: at the start time we point
+the peer at that endpoint with a one-second keepalive, which makes the
+kernel send handshake initiations from the mapped port, and wait for a
+handshake newer than the punch. Peers that have gone without a handshake
+for a while are reported to the coordinator as punch candidates.
+
+When a punch fails the coordinator may hand out a relay endpoint for the
+pair, which then replaces that peer's endpoint until it is withdrawn.
+"""
+import asyncio
+import os
+import time
+
+from wg_reconcile import PERSISTENT_KEEPALIVE
+
+PUNCH_KEEPALIVE = 1
+POLL_INTERVAL = 0.25
+# WireGuard re-handshakes every two minutes on a live tunnel with keepalive,
+# so a peer quiet for longer than this has no working path.
+STALE_AFTER = float(os.environ.get('WG_PUNCH_STALE_AFTER', '180'))
+CHECK_INTERVAL = float(os.environ.get('WG_PUNCH_CHECK_INTERVAL', '30'))
+# Do not ask again for a peer we punched (or failed to) this recently.
+RETRY_AFTER = float(os.environ.get('WG_PUNCH_RETRY_AFTER', '300'))
+
+
+class HolePuncher:
+    def __init__(self, backend, send, on_relays_changed=None, applied=None):
+        self.backend = backend  # WgCli-like: handshakes(), set_endpoint()
+        self.send = send  # async (message dict) -> None, over the coordinator websocket
+        # public key -> settings last applied for the peer (endpoint,
+        # keepalive), put back after a punch; None if not applied yet.
+        self.applied = applied or (lambda key: None)
+        self.on_relays_changed = on_relays_changed
+        self.tasks = set()
+        self.last_attempt = {}  # peer_id -> monotonic time of our last punch
+        self.failed = set()  # peer_ids the coordinator says need a relay
+        self.relays = {}  # peer_id -> (relay ip, port) to use instead of its endpoint
+        self.results = []  # (peer_id, success, seconds)
+
+    def handle(self, message):
+        """Dispatches a punch-related websocket message; False if it is not one."""
+        kind = message.get('type')
+        if kind == 'punch':
+            task = asyncio.create_task(self.punch(message))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        elif kind == 'punch_failed':
+            self.failed.add(message.get('peer_id'))
+            print(f"No direct path to peer {message.get('peer_id')}, relay needed.")
+        elif kind == 'relay':
+            ip, _, port = message['endpoint'].rpartition(':')
+            self.relays[message['peer_id']] = (ip, int(port))
+            print(f"Relaying traffic for peer {message['peer_id']} via {message['endpoint']}")
+            if self.on_relays_changed:
+                self.on_relays_changed()
+        elif kind == 'relay_closed':
+            if self.relays.pop(message['peer_id'], None) and self.on_relays_changed:
+                self.on_relays_changed()
+        else:
+            return False
+        return True
+
+    def with_relays(self, peers):
+        """The peer list with relayed peers' endpoints pointing at their relay."""
+        if not self.relays:
+            return peers
+        result = []
+        for peer in peers:
+            relay = self.relays.get(peer['peer_id'])
+            if relay:
+                peer = dict(peer, external_ip=relay[0], external_port=relay[1])
+            result.append(peer)
+        return result
+
+    async def punch(self, message):
+        key = message['public_key']
+        peer_id = message['peer_id']
+        endpoint = f"{message['external_ip']}:{message['external_port']}"
+        timeout = message.get('timeout', 12.0)
+        self.last_attempt[peer_id] = time.monotonic()
+        await asyncio.sleep(message.get('start_in', 0))
+        started_wall = time.time()
+        started = time.monotonic()
+        success = False
+        try:
+            await asyncio.to_thread(self.backend.set_endpoint, key, endpoint, PUNCH_KEEPALIVE)
+            while time.monotonic() - started < timeout:
+                handshakes = await asyncio.to_thread(self.backend.handshakes)
+                # latest-handshakes has one-second resolution.
+                if handshakes.get(key, 0) >= int(started_wall):
+                    success = True
+                    break
+                await asyncio.sleep(POLL_INTERVAL)
+        except Exception as e:
+            print(f'Punch to {endpoint} failed: {e}')
+        finally:
+            # Put back what the reconciler applied (a relay endpoint, a lazy
+            # peer's zero keepalive): it only pushes changes, so it would
+            # never undo the punch settings itself.
+            want = self.applied(key)
+            restore = (want['endpoint'], want['keepalive']) if want else (endpoint, PERSISTENT_KEEPALIVE)
+            try:
+                await asyncio.to_thread(self.backend.set_endpoint, key, *restore)
+            except Exception as e:
+                print(f'Could not restore endpoint and keepalive for {key}: {e}')
+        elapsed = time.monotonic() - started
+        self.results.append((peer_id, success, elapsed))
+        if success:
+            self.failed.discard(peer_id)
+        print(f"Punch to {endpoint}: {'direct path' if success else 'no handshake'} after {elapsed:.2f}s")
+        await self.send({
+            'type': 'punch_result',
+            'punch_id': message['punch_id'],
+            'peer_id': peer_id,
+            'success': success,
+            'elapsed': round(elapsed, 3),
+        })
+
+    def stale_peers(self, live, peers, my_ip):
+        """peer_ids whose WireGuard peer has not handshaken for STALE_AFTER."""
+        now = time.time()
+        mono = time.monotonic()
+        stale = []
+        for peer in peers:
+            if peer['internal_ip'] == my_ip:
+                continue
+            have = live.get(peer['public_key'])
+            if have is None or now - have.get('handshake', 0) < STALE_AFTER:
+                continue
+            if mono - self.last_attempt.get(peer['peer_id'], -RETRY_AFTER) < RETRY_AFTER:
+                continue
+            stale.append(peer['peer_id'])
+        return stale
+
+    async def request_stale(self, peers, my_ip):
+        live = await asyncio.to_thread(self.backend.dump)
+        for peer_id in self.stale_peers(live, peers, my_ip):
+            self.last_attempt[peer_id] = time.monotonic()
+            await self.send({'type': 'punch_request', 'peer_id': peer_id})
@@ -0,0 +1,83 @@
+"""RTT and loss probes to every peer, sent through the tunnel.
+
+Each agent answers probes on its internal address and, every
+PROBE_INTERVAL seconds, sends a short burst to every peer's internal
+address. A probe is 13 bytes: 'P' (or 'R' for the echo), a sequence
+number and the send time, which comes straight back. The per-peer summary
+of a round (median RTT in ms, loss fraction) is what gets reported to the
+coordinator.
+"""
+import asyncio
+import os
+import statistics
+import struct
+import time
+
+PROBE_PORT = int(os.environ.get('WG_PROBE_PORT', '54321'))
+PROBE_INTERVAL = float(os.environ.get('WG_PROBE_INTERVAL', '30'))
+PROBES_PER_ROUND = 5
+PROBE_SPACING = 0.2
+PROBE_TIMEOUT = 2.0
+PROBE = struct.Struct('!cIQ')
+
+
+class LatencyProber(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.transport = None
+        self.seq = 0
+        self.pending = {}  # seq -> peer_id
+        self.rtts = {}  # peer_id -> RTTs (ms) seen this round
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) != PROBE.size:
+            return
+        kind, seq, sent = PROBE.unpack(data)
+        if kind == b'P':
+            self.transport.sendto(b'R' + data[1:], addr)
+        elif kind == b'R':
+            peer_id = self.pending.pop(seq, None)
+            if peer_id is not None:
+                self.rtts.setdefault(peer_id, []).append((time.monotonic_ns() - sent) / 1e6)
+
+    def error_received(self, exc):
+        pass  # unreachable peers just show up as loss
+
+    async def round(self, targets):
+        """Probes {peer_id: internal_ip}; returns {peer_id: (median RTT ms or None, loss)}."""
+        self.pending.clear()
+        self.rtts = {}
+        for _ in range(PROBES_PER_ROUND):
+            for peer_id, ip in targets.items():
+                self.seq = (self.seq + 1) & 0xFFFFFFFF
+                self.pending[self.seq] = peer_id
+                self.transport.sendto(PROBE.pack(b'P', self.seq, time.monotonic_ns()), (ip, PROBE_PORT))
+            await asyncio.sleep(PROBE_SPACING)
+        await asyncio.sleep(PROBE_TIMEOUT)
+        summary = {}
+        for peer_id in targets:
+            rtts = self.rtts.get(peer_id, [])
+            loss = 1 - len(rtts) / PROBES_PER_ROUND
+            summary[peer_id] = (round(statistics.median(rtts), 2) if rtts else None, round(loss, 2))
+        return summary
+
+
+async def start_prober(internal_ip):
+    loop = asyncio.get_running_loop()
+    _, prober = await loop.create_datagram_endpoint(LatencyProber, local_addr=(internal_ip, PROBE_PORT))
+    return prober
+
+
+async def probe_forever(prober, targets, report, interval=PROBE_INTERVAL):
+    """Every `interval` seconds probes targets() and awaits report(summary)."""
+    while True:
+        await asyncio.sleep(interval)
+        current = targets()
+        if not current:
+            continue
+        try:
+            await report(await prober.round(current))
+        except Exception as e:
+            print(f'Latency probe round failed: {e}')
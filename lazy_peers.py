@@ -0,0 +1,249 @@
+"""On-demand peer activation (WG_LAZY=1).
+
+Every peer is installed, but only peers we actually talk to get a
+persistent keepalive. An idle WireGuard peer without keepalive sends
+nothing at all, so a node that talks to a handful of peers no longer wakes
+up every 25 seconds for each member of the group.
+
+Inactive peers keep their endpoint. Without one the kernel answers the
+first packet with ICMP host unreachable, which fails TCP connects outright.
+With one, the first packet just starts a handshake. The trigger is a packet
+socket on wg0. A classic BPF filter passes only outgoing packets whose
+destination is not an active peer, so active traffic never reaches Python.
+The first packet towards an inactive peer activates it: keepalive on, in
+one netlink call, and an `activate` message through the coordinator. That
+message makes the other side turn its keepalive on too, which opens its NAT
+towards us. A peer whose counters show no more than keepalives and rekeys
+for `idle_timeout` seconds goes back to sleep.
+"""
+import asyncio
+import ctypes
+import ipaddress
+import os
+import socket
+import struct
+import threading
+import time
+
+from wg_reconcile import PERSISTENT_KEEPALIVE, WG_INTERFACE
+
+IDLE_TIMEOUT = float(os.environ.get('WG_LAZY_IDLE', '300'))
+IDLE_CHECK_INTERVAL = 30.0
+# Bytes a quiet but active peer still moves per check: a keepalive each way
+# per 25 s plus a rekey handshake. Anything above that is real traffic.
+IDLE_BYTES = 1024
+
+ETH_P_ALL = 0x0003
+ETH_P_IP = 0x0800
+SO_ATTACH_FILTER = 26
+PACKET_OUTGOING = 4
+SKF_AD_PROTOCOL = 0xFFFFF000 + 0  # SKF_AD_OFF + ...
+SKF_AD_PKTTYPE = 0xFFFFF000 + 4
+BPF_LD_W_ABS = 0x20
+BPF_JEQ_K = 0x15
+BPF_AND_K = 0x54
+BPF_RET_K = 0x06
+BPF_MAXINSNS = 4096
+BPF_INSN = struct.Struct('=HBBI')
+IPV4_DST = 16
+SNAPLEN = 20
+
+
+def build_filter(routes=()):
+    """Classic BPF that keeps an outgoing IPv4 packet only if it is routed
+    to an inactive peer. `routes` is [(network, mask, active)] as ints.
+    Routes are matched most specific first, like WireGuard's allowed-IPs
+    trie. Inactive routes are only listed where an active, wider route
+    would otherwise hide them. With too many routes to list, every
+    outgoing packet passes and the lookup ignores those for active peers."""
+    routes = sorted(routes, key=lambda route: -route[1])
+    wide = [(network, mask) for network, mask, active in routes if active and mask != 0xFFFFFFFF]
+    needed = [(network, mask, active) for network, mask, active in routes
+              if active or any(network & wide_mask == wide_network and mask > wide_mask
+                               for wide_network, wide_mask in wide)]
+    insns = [
+        (BPF_LD_W_ABS, 0, 0, SKF_AD_PKTTYPE),
+        (BPF_JEQ_K, 0, 2, PACKET_OUTGOING),
+        (BPF_LD_W_ABS, 0, 0, SKF_AD_PROTOCOL),
+        (BPF_JEQ_K, 1, 0, ETH_P_IP),
+        (BPF_RET_K, 0, 0, 0),
+        (BPF_LD_W_ABS, 0, 0, IPV4_DST),
+    ]
+    if len(insns) + 4 * len(needed) + 1 <= BPF_MAXINSNS:
+        for network, mask, active in needed:
+            verdict = (BPF_RET_K, 0, 0, 0 if active else SNAPLEN)
+            if mask == 0xFFFFFFFF:
+                insns += [(BPF_JEQ_K, 0, 1, network), verdict]
+            else:
+                insns += [(BPF_AND_K, 0, 0, mask), (BPF_JEQ_K, 0, 1, network), verdict,
+                          (BPF_LD_W_ABS, 0, 0, IPV4_DST)]
+    insns.append((BPF_RET_K, 0, 0, SNAPLEN))
+    return b''.join(BPF_INSN.pack(*insn) for insn in insns)
+
+
+def attach_filter(sock, program):
+    buf = ctypes.create_string_buffer(program)
+    fprog = struct.pack('HL', len(program) // BPF_INSN.size, ctypes.addressof(buf))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+
+def open_packet_socket(interface):
+    # Only ETH_P_ALL taps see outgoing packets. Create it unbound (protocol
+    # 0) and filter before binding, so nothing slips through unfiltered.
+    sock = socket.socket(socket.AF_PACKET, socket.SOCK_DGRAM, 0)
+    attach_filter(sock, build_filter())
+    sock.bind((interface, ETH_P_ALL))
+    sock.setblocking(False)
+    return sock
+
+
+class LazyPeers:
+    def __init__(self, backend, on_activate=None, idle_timeout=IDLE_TIMEOUT, interface=WG_INTERFACE):
+        self.backend = backend  # WgCli-like: dump(), set_endpoint()
+        self.on_activate = on_activate  # async (public key) -> None, tells the other side
+        self.idle_timeout = idle_timeout
+        self.interface = interface
+        self.desired = {}  # public key -> settings, as desired_peers() builds them
+        self.hosts = {}  # /32 address int -> public key
+        self.networks = []  # (network int, mask, public key) for wider AllowedIPs
+        self.active = {}  # public key -> monotonic time traffic was last seen
+        self.counters = {}  # public key -> rx + tx at the last idle check
+        self.sock = None
+        # shape() runs in the apply thread, everything else on the loop.
+        self.lock = threading.RLock()
+        self.tasks = set()
+        self.activations = 0
+        self.deactivations = 0
+
+    def shape(self, desired):
+        """Records the peers we want and returns them with keepalive off for
+        every peer that is not active."""
+        hosts = {}
+        networks = []
+        for key, want in desired.items():
+            for cidr in filter(None, want['allowed_ips'].split(',')):
+                network = ipaddress.IPv4Network(cidr.strip())
+                if network.prefixlen == 32:
+                    hosts[int(network.network_address)] = key
+                else:
+                    networks.append((int(network.network_address), int(network.netmask), key))
+        # Most specific first, like the kernel's allowed-IPs trie.
+        networks.sort(key=lambda entry: -entry[1])
+        with self.lock:
+            self.desired, self.hosts, self.networks = desired, hosts, networks
+            for key in [key for key in self.active if key not in desired]:
+                del self.active[key]
+                self.counters.pop(key, None)
+            self._refilter()
+            return {key: want if key in self.active else dict(want, keepalive=0) for key, want in desired.items()}
+
+    def is_active(self, key):
+        return key in self.active
+
+    def lookup(self, address):
+        with self.lock:
+            key = self.hosts.get(address)
+            if key is not None:
+                return key
+            for network, mask, key in self.networks:
+                if address & mask == network:
+                    return key
+        return None
+
+    def activate(self, key, notify=True):
+        with self.lock:
+            if key in self.active or key not in self.desired:
+                return False
+            self.active[key] = time.monotonic()
+            self._refilter()
+            self.activations += 1
+            endpoint = self.desired[key]['endpoint']
+        try:
+            self.backend.set_endpoint(key, endpoint, PERSISTENT_KEEPALIVE)
+        except Exception as e:
+            print(f'Could not activate peer {key}: {e}')
+        if notify and self.on_activate:
+            task = asyncio.create_task(self.on_activate(key))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        return True
+
+    def deactivate(self, key):
+        with self.lock:
+            if self.active.pop(key, None) is None:
+                return
+            self.counters.pop(key, None)
+            self._refilter()
+            self.deactivations += 1
+            endpoint = self.desired[key]['endpoint']
+        try:
+            self.backend.set_endpoint(key, endpoint, 0)
+        except Exception as e:
+            print(f'Could not deactivate peer {key}: {e}')
+
+    def check_idle(self, live):
+        """Puts peers to sleep that moved no more than keepalive traffic for
+        idle_timeout; `live` is a backend dump()."""
+        now = time.monotonic()
+        idle = []
+        with self.lock:
+            for key in list(self.active):
+                have = live.get(key)
+                total = have['rx'] + have['tx'] if have else 0
+                if total - self.counters.get(key, total) > IDLE_BYTES:
+                    self.active[key] = now
+                self.counters[key] = total
+                if now - self.active[key] > self.idle_timeout:
+                    idle.append(key)
+        for key in idle:
+            self.deactivate(key)
+
+    def _refilter(self):
+        if self.sock is None:
+            return
+        routes = [(address, 0xFFFFFFFF, key in self.active) for address, key in self.hosts.items()]
+        routes += [(network, mask, key in self.active) for network, mask, key in self.networks]
+        try:
+            attach_filter(self.sock, build_filter(routes))
+        except OSError as e:
+            print(f'Could not update the lazy peer filter: {e}')
+
+    def _on_packets(self):
+        try:
+            while True:
+                data = self.sock.recv(SNAPLEN)
+                if len(data) < SNAPLEN:
+                    continue
+                address, = struct.unpack_from('!I', data, IPV4_DST)
+                key = self.lookup(address)
+                if key is not None and self.activate(key):
+                    print(f'Traffic to {socket.inet_ntoa(data[IPV4_DST:SNAPLEN])}: activated peer {key}')
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            print(f'Packet socket read failed: {e}')
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        try:
+            self.sock = open_packet_socket(self.interface)
+        except OSError as e:
+            # No trigger: peers only wake up when the other side asks.
+            print(f'Packet socket unavailable ({e}), lazy peers activate on request only.')
+        else:
+            with self.lock:
+                self._refilter()
+            loop.add_reader(self.sock.fileno(), self._on_packets)
+        try:
+            while True:
+                await asyncio.sleep(IDLE_CHECK_INTERVAL)
+                try:
+                    self.check_idle(await asyncio.to_thread(self.backend.dump))
+                except Exception as e:
+                    print(f'Error checking idle peers: {e}')
+        finally:
+            with self.lock:
+                if self.sock is not None:
+                    loop.remove_reader(self.sock.fileno())
+                    self.sock.close()
+                    self.sock = None
@@ -0,0 +1,228 @@
+"""Minimal Prometheus text-format metrics.
+
+Recording is an attribute add (counters) or a bisect plus two adds
+(histograms); labelled children are looked up once and can be kept.
+Anything that can be read from existing state (connection counts, peers
+per group, `wg show dump`) is a collector, called only when scraped.
+
+    REQUESTS = registry.histogram('coord_request_seconds', 'Request latency', labelnames=('endpoint',))
+    REQUESTS.labels('register').observe(0.004)
+    text = registry.render()
+"""
+import asyncio
+import bisect
+import functools
+import math
+import time
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_labels(names, values, extra=''):
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class CounterValue:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class GaugeValue(CounterValue):
+    __slots__ = ()
+
+    def set(self, value):
+        self.value = value
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+
+class HistogramValue:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        return _Timer(self)
+
+
+class _Timer:
+    __slots__ = ('histogram', 'started')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+
+class Metric:
+    """A metric family; without labelnames it records directly."""
+
+    def __init__(self, kind, name, help, labelnames=(), factory=CounterValue):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.factory = factory
+        self.children = {}
+        if not self.labelnames:
+            self.unlabelled = self.children[()] = factory()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.factory()
+        return child
+
+    def remove(self, *values):
+        self.children.pop(values, None)
+
+    # Shortcuts for unlabelled metrics.
+    def inc(self, amount=1):
+        self.unlabelled.inc(amount)
+
+    def set(self, value):
+        self.unlabelled.set(value)
+
+    def observe(self, value):
+        self.unlabelled.observe(value)
+
+    def time(self):
+        return self.unlabelled.time()
+
+    def timed(self, *values):
+        """Decorator timing an async function into this histogram."""
+        child = self.labels(*values)
+
+        def decorate(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    child.observe(time.perf_counter() - started)
+            return wrapper
+        return decorate
+
+    def lines(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} {self.kind}'
+        for values, child in list(self.children.items()):
+            if self.kind != 'histogram':
+                yield f'{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}'
+                continue
+            cumulative = 0
+            for bound, count in zip(child.buckets + (math.inf,), child.counts):
+                cumulative += count
+                le = f'le="{_format_value(float(bound))}"'
+                yield f'{self.name}_bucket{_format_labels(self.labelnames, values, le)} {cumulative}'
+            labels = _format_labels(self.labelnames, values)
+            yield f'{self.name}_sum{labels} {_format_value(child.sum)}'
+            yield f'{self.name}_count{labels} {child.count}'
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(Metric('counter', name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()):
+        return self._add(Metric('gauge', name, help, labelnames, GaugeValue))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        buckets = tuple(sorted(buckets))
+        return self._add(Metric('histogram', name, help, labelnames, lambda: HistogramValue(buckets)))
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def collector(self, func):
+        """Registers func() -> iterable of (name, kind, help, labelnames,
+        [(label values, value), ...]), evaluated at scrape time."""
+        self.collectors.append(func)
+        return func
+
+    def render(self):
+        out = []
+        for metric in self.metrics:
+            out.extend(metric.lines())
+        for func in self.collectors:
+            try:
+                families = list(func())
+            except Exception as e:
+                print(f'Metrics collector {func.__name__} failed: {e}')
+                continue
+            for name, kind, help, labelnames, samples in families:
+                out.append(f'# HELP {name} {help}')
+                out.append(f'# TYPE {name} {kind}')
+                for values, value in samples:
+                    if value is not None:
+                        out.append(f'{name}{_format_labels(labelnames, values)} {_format_value(value)}')
+        out.append('')
+        return '\n'.join(out)
+
+
+async def serve(registry, host, port):
+    """Serves GET /metrics on a bare asyncio listener (no web framework on
+    the agent). Rendering runs in a thread since collectors may fork."""
+
+    async def handle(reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request.split()
+            if len(parts) >= 2 and parts[0] == b'GET' and parts[1].split(b'?')[0] == b'/metrics':
+                body = (await asyncio.to_thread(registry.render)).encode()
+                status = b'200 OK'
+            else:
+                body, status = b'not found\n', b'404 Not Found'
+            writer.write(b'HTTP/1.1 ' + status + b'\r\nContent-Type: ' + CONTENT_TYPE.encode() +
+                         b'\r\nContent-Length: ' + str(len(body)).encode() + b'\r\nConnection: close\r\n\r\n' + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
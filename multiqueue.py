@@ -0,0 +1,94 @@
+"""Multi-core data plane for the userspace tunnel.
+
+Opens the TUN device with IFF_MULTI_QUEUE and runs one worker process per
+queue, each with its own SO_REUSEPORT UDP socket on the shared port. The
+kernel picks the TUN queue and the reuseport socket by flow hash, so all
+packets of one flow are handled by the same worker and stay in order.
+"""
+import fcntl
+import ipaddress
+import multiprocessing
+import os
+import socket
+import struct
+import subprocess
+
+TUNSETIFF = 0x400454ca
+IFF_TUN = 0x0001
+IFF_NO_PI = 0x1000
+IFF_MULTI_QUEUE = 0x0100
+
+
+def open_tun_queues(name, count):
+    """Opens `count` queues of one multi-queue TUN device; returns (name, fds)."""
+    fds = []
+    for _ in range(count):
+        fd = os.open('/dev/net/tun', os.O_RDWR)
+        ifr = struct.pack('16sH22x', name.encode(), IFF_TUN | IFF_NO_PI | IFF_MULTI_QUEUE)
+        ifr = fcntl.ioctl(fd, TUNSETIFF, ifr)
+        # The kernel fills in the real name when given a pattern like tun%d.
+        name = ifr[:16].rstrip(b'\0').decode()
+        fds.append(fd)
+    return name, fds
+
+
+def configure_tun(name, my_ip, netmask, dstaddr=None, mtu=1400):
+    prefixlen = ipaddress.ip_network(f'0.0.0.0/{netmask}').prefixlen
+    addr = ['ip', 'addr', 'add', f'{my_ip}/{prefixlen}']
+    if dstaddr:
+        addr += ['peer', dstaddr]
+    subprocess.run(addr + ['dev', name], check=True)
+    subprocess.run(['ip', 'link', 'set', 'dev', name, 'mtu', str(mtu), 'up'], check=True)
+    print(f"TUN device {name} set up with IP {my_ip}")
+
+
+def reuseport_socket(port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(('', port))
+    return sock
+
+
+class WorkerPool:
+    """One forked worker per TUN queue. `run(index, sock, tun_fd, conn)` is the
+    worker body; `conn` receives whatever the parent publish()es. A tun_fd
+    of None starts a socket-only worker."""
+
+    def __init__(self, tun_fds, port, run):
+        ctx = multiprocessing.get_context('fork')
+        self.conns = []
+        self.processes = []
+        for index, tun_fd in enumerate(tun_fds):
+            parent_conn, child_conn = ctx.Pipe()
+            process = ctx.Process(
+                target=_worker, args=(index, tun_fds, port, run, child_conn), daemon=True
+            )
+            process.start()
+            child_conn.close()
+            self.conns.append(parent_conn)
+            self.processes.append(process)
+        # Only the workers may hold queues: an unread queue still gets its
+        # share of packets.
+        for tun_fd in tun_fds:
+            if tun_fd is not None:
+                os.close(tun_fd)
+
+    def __len__(self):
+        return len(self.processes)
+
+    def publish(self, message):
+        for conn in self.conns:
+            conn.send(message)
+
+    def join(self):
+        for process in self.processes:
+            process.join()
+
+
+def _worker(index, tun_fds, port, run, conn):
+    for other in tun_fds:
+        if other is not None and other != tun_fds[index]:
+            os.close(other)
+    cpus = sorted(os.sched_getaffinity(0))
+    os.sched_setaffinity(0, {cpus[index % len(cpus)]})
+    run(index, reuseport_socket(port), tun_fds[index], conn)
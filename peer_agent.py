@@ -1,73 +1,134 @@
 import os
 import subprocess
-import requests
 import json
 import asyncio
 import websockets
 import signal
-from discovery import get_public_info
-
-def generate_keys():
-    if not os.path.exists('privatekey'):
-        priv = subprocess.check_output(['wg', 'genkey']).decode().strip()
-        with open('privatekey', 'w') as f:
-            f.write(priv)
-        pub = subprocess.check_output(['wg', 'pubkey'], input=priv.encode()).decode().strip()
-        with open('publickey', 'w') as f:
-            f.write(pub)
-    else:
-        with open('privatekey') as f:
-            priv = f.read().strip()
-        with open('publickey') as f:
-            pub = f.read().strip()
-    return priv, pub
-
-def register_with_server(server_url, group, name, public_key, external_ip, external_port):
-    resp = requests.post(f'{server_url}/register', json={
-        'group': group,
-        'name': name,
-        'public_key': public_key,
-        'external_ip': external_ip,
-        'external_port': external_port
-    })
-    resp.raise_for_status()
-    return resp.json()
-
-def fetch_peers(server_url, group):
-    resp = requests.get(f'{server_url}/peers/{group}')
-    resp.raise_for_status()
-    return resp.json()
-
-def generate_wg_config(private_key, internal_ip, listen_port, peers):
+import time
+from apply_scheduler import ApplyScheduler
+from coord_client import CoordClient, heartbeat_interval, send_heartbeats
+from discovery import discover, print_discovery
+from endpoint_monitor import EndpointMonitor
+from hole_punch import CHECK_INTERVAL, HolePuncher
+from lazy_peers import LazyPeers
+from latency_probe import probe_forever, start_prober
+from metrics import Registry, serve as serve_metrics
+from peer_table import Evicted, PeerTable, RevisionGap
+from topology import Topology
+from wg_netlink import WgNetlink, available as netlink_available, can_configure
+from wg_reconcile import PERSISTENT_KEEPALIVE, WgCli, WgReconciler, desired_peers, touched
+from wgkeys import load_or_create
+
+# Seconds to wait after a peer update for more to arrive before applying.
+APPLY_WINDOW = float(os.environ.get('WG_APPLY_WINDOW', '0.5'))
+# Optional Prometheus listener (e.g. WG_METRICS_PORT=9586), off by default.
+METRICS_PORT = os.environ.get('WG_METRICS_PORT')
+METRICS_ADDR = os.environ.get('WG_METRICS_ADDR', '127.0.0.1')
+# How wg0 is configured: 'netlink' talks to the kernel directly, 'cli' runs
+# wg/wg-quick, 'auto' uses netlink when the wireguard module is loaded and we
+# have CAP_NET_ADMIN.
+WG_BACKEND = os.environ.get('WG_BACKEND', 'auto')
+# WG_LAZY=1: keepalive only for peers we exchange traffic with.
+LAZY = os.environ.get('WG_LAZY') == '1'
+
+registry = Registry()
+APPLY_SECONDS = registry.histogram('wg_agent_apply_seconds', 'Time to apply a peer change to wg0.')
+WS_MESSAGES = registry.counter('wg_agent_ws_messages_total', 'Messages received from the coordinator.')
+RECONNECTS = registry.counter('wg_agent_reconnects_total', 'Coordinator websocket reconnects.')
+
+def generate_wg_config(private_key, internal_ip, listen_port, peers, prefixlen=24, topology=None, lazy=None):
     config = [
         '[Interface]',
         f'PrivateKey = {private_key}',
-        f'Address = {internal_ip}/24',
+        f'Address = {internal_ip}/{prefixlen}',
         f'ListenPort = {listen_port}',
         ''
     ]
-    for peer in peers:
-        if peer['internal_ip'] == internal_ip:
-            continue
+    neighbors, _ = (topology or Topology()).neighbors(internal_ip, peers)
+    for peer, allowed_ips in neighbors:
         config += [
             '[Peer]',
             f'PublicKey = {peer["public_key"]}',
-            f'AllowedIPs = {peer["internal_ip"]}/32',
+            f'AllowedIPs = {", ".join(allowed_ips)}',
             f'Endpoint = {peer["external_ip"]}:{peer["external_port"]}',
-            'PersistentKeepalive = 25',
-            ''
         ]
+        if lazy is None or lazy.is_active(peer['public_key']):
+            config.append('PersistentKeepalive = 25')
+        config.append('')
     return '\n'.join(config)
 
-def bring_up_interface():
-    subprocess.run(['sudo', 'wg-quick', 'down', './wg0.conf'], check=False, capture_output=True)
-    subprocess.run(['sudo', 'wg-quick', 'up', './wg0.conf'], check=True)
+def make_backend():
+    if WG_BACKEND == 'netlink' or (WG_BACKEND == 'auto' and netlink_available() and can_configure()):
+        return WgNetlink()
+    return WgCli()
+
+reconciler = WgReconciler(make_backend())
+# Filled in once registered; the netlink backend brings wg0 up from these
+# instead of wg0.conf.
+interface = {}
+
+def wanted_peers(internal_ip, peers):
+    desired = desired_peers(internal_ip, peers, interface['topology'])
+    lazy = interface.get('lazy')
+    return lazy.shape(desired) if lazy else desired
+
+def bring_up_interface(internal_ip, peers):
+    desired = wanted_peers(internal_ip, peers)
+    if isinstance(reconciler.backend, WgNetlink):
+        address = f"{internal_ip}/{interface['prefixlen']}"
+        reconciler.backend.up(interface['private_key'], interface['listen_port'], address, desired)
+    else:
+        subprocess.run(['sudo', 'wg-quick', 'down', './wg0.conf'], check=False, capture_output=True)
+        subprocess.run(['sudo', 'wg-quick', 'up', './wg0.conf'], check=True)
     print('WireGuard interface brought up successfully.')
 
-def save_and_apply_config(config):
+def save_config(config):
     with open('wg0.conf', 'w') as f:
         f.write(config)
-    bring_up_interface()
+
+def bring_down_interface():
+    if isinstance(reconciler.backend, WgNetlink):
+        reconciler.backend.down()
+    else:
+        subprocess.run(['sudo', 'wg-quick', 'down', './wg0.conf'], check=False, capture_output=True)
+
+def enable_forwarding():
+    # Shard hubs route traffic between their spokes and the other shards.
+    path = '/proc/sys/net/ipv4/ip_forward'
+    try:
+        with open(path) as f:
+            if f.read().strip() == '1':
+                return
+        with open(path, 'w') as f:
+            f.write('1')
+    except OSError:
+        subprocess.run(['sudo', 'sysctl', '-w', 'net.ipv4.ip_forward=1'], check=False, capture_output=True)
+    print('IP forwarding enabled: this node is a shard hub.')
+
+def save_and_apply_config(config, internal_ip, peers):
+    save_config(config)
+    bring_up_interface(internal_ip, peers)
+    if interface['topology'].neighbors(internal_ip, peers)[1]:
+        enable_forwarding()
+
+def save_and_reconcile(config, internal_ip, peers):
+    # Keep wg0.conf current for wg-quick down, but only touch changed peers
+    # on the live interface instead of restarting it.
+    save_config(config)
+    if interface['topology'].neighbors(internal_ip, peers)[1]:
+        enable_forwarding()
+    desired = wanted_peers(internal_ip, peers)
+    try:
+        result = reconciler.reconcile(desired)
+    except (subprocess.CalledProcessError, OSError) as e:
+        print(f'Incremental reconcile failed ({e}), restarting interface.')
+        bring_up_interface(internal_ip, peers)
+        reconciler.applied = desired
+        return
+    print(
+        f'Reconciled wg0: {len(result.added)} added, {len(result.removed)} removed, '
+        f'{len(result.updated)} updated ({touched(result)} peers touched).'
+    )
 
 def configs_equal(a, b):
     return a.strip() == b.strip()
@@ -86,34 +147,188 @@ async def peer_agent():
     group = input('Group name: ').strip()
     name = input('Your name: ').strip()
     listen_port = int(input('WireGuard listen port (e.g. 54320): ').strip())
-    priv, pub = generate_keys()
-    ext_ip, ext_port = get_public_info()
-    if ext_ip is None or ext_port is None:
+    priv, pub = load_or_create()
+    info = await discover(listen_port)
+    print_discovery(info)
+    if info.external_ip is None:
         print('Could not determine external IP/port. Exiting.')
         return
-    reg = register_with_server(server_url, group, name, pub, ext_ip, ext_port)
+    ext_ip, ext_port = info.external_ip, info.external_port
+    client = CoordClient(server_url)
+    try:
+        reg = await client.register(group, name, pub, ext_ip, ext_port)
+    except Exception:
+        await client.close()
+        raise
     internal_ip = reg['internal_ip']
-    peers = reg['peers']
-    config = generate_wg_config(priv, internal_ip, listen_port, peers)
-    save_and_apply_config(config)
+    prefixlen = int(reg.get('subnet', '10.0.0.0/24').split('/')[1])
+    topology = Topology.from_registration(reg)
+    lazy = LazyPeers(reconciler.backend) if LAZY else None
+    interface.update(private_key=priv, listen_port=listen_port, prefixlen=prefixlen, topology=topology, lazy=lazy)
+    table = PeerTable()
+    table.load(reg['epoch'], reg['revision'], reg['peers'])
+    peers = table.values()
+    config = generate_wg_config(priv, internal_ip, listen_port, peers, prefixlen, topology, lazy)
+    save_and_apply_config(config, internal_ip, peers)
     print('Initial WireGuard config applied.')
     print_peer_table(peers, internal_ip)
-    ws_url = server_url.replace('http', 'ws') + f'/ws/{group}'
-    print(f'Connecting to WebSocket: {ws_url}')
+    ws_base = client.ws_url(group, reg['peer_id'])
+
+    def render_config(peers):
+        return generate_wg_config(priv, internal_ip, listen_port, peers, prefixlen, topology, lazy)
+
+    def apply_config(config, peers):
+        with APPLY_SECONDS.time():
+            save_and_reconcile(config, internal_ip, peers)
+        print_peer_table(peers, internal_ip)
+        print(f'Apply scheduler: {scheduler.counters()}')
+
+    scheduler = ApplyScheduler(render_config, apply_config, configs_equal, APPLY_WINDOW)
+    scheduler.last_config = config
+    scheduler_task = asyncio.create_task(scheduler.run())
+
+    async def endpoint_changed(external_ip, external_port):
+        # The coordinator pushes just this change to the other peers.
+        await client.update(group, reg['peer_id'], external_ip, external_port)
+
+    monitor = EndpointMonitor(listen_port, endpoint_changed, (ext_ip, ext_port), ignore_ifname='wg0')
+    monitor_task = asyncio.create_task(monitor.run())
+
+    live_ws = {'ws': None}
+
+    async def send_ws(message):
+        # Punch results and requests only make sense on a live connection;
+        # the coordinator times out anything we could not deliver.
+        if live_ws['ws'] is not None:
+            try:
+                await live_ws['ws'].send(json.dumps(message))
+            except websockets.ConnectionClosed:
+                pass
+
+    def applied_settings(key):
+        want = reconciler.applied.get(key)
+        if want and lazy and lazy.is_active(key):
+            # Woken up since the last apply: keepalive is on.
+            want = dict(want, keepalive=PERSISTENT_KEEPALIVE)
+        return want
+
+    puncher = HolePuncher(reconciler.backend, send_ws,
+                          on_relays_changed=lambda: scheduler.submit(puncher.with_relays(table.values())),
+                          applied=applied_settings)
+
+    async def punch_stale_peers():
+        while True:
+            await asyncio.sleep(CHECK_INTERVAL)
+            # Sleeping lazy peers never handshake; that is not a broken path.
+            peers = [p for p in table.values() if lazy is None or lazy.is_active(p['public_key'])]
+            try:
+                await puncher.request_stale(peers, internal_ip)
+            except Exception as e:
+                print(f'Error checking peer handshakes: {e}')
+
+    punch_task = asyncio.create_task(punch_stale_peers())
+
+    lazy_task = None
+    if lazy:
+        async def activate_remote(key):
+            # Asks the other side to turn its keepalive on too, so its NAT
+            # lets our handshake in.
+            for peer in table.values():
+                if peer['public_key'] == key:
+                    await send_ws({'type': 'activate', 'peer_id': peer['peer_id']})
+
+        lazy.on_activate = activate_remote
+        lazy_task = asyncio.create_task(lazy.run())
+
+    def probe_targets():
+        # Only the peers we configure; in a sharded group that keeps probing
+        # from growing with the group. Sleeping lazy peers are skipped: a
+        # probe is outgoing traffic and would wake every one of them.
+        neighbors, _ = topology.neighbors(internal_ip, table.values())
+        return {n.peer['peer_id']: n.peer['internal_ip'] for n in neighbors
+                if lazy is None or lazy.is_active(n.peer['public_key'])}
+
+    async def report_latency(summary):
+        await send_ws({'type': 'latency_report', 'peers': summary})
+
+    @registry.collector
+    def collect_agent():
+        for key, value in scheduler.counters().items():
+            yield (f'wg_agent_{key}_total', 'counter', f'Apply scheduler {key}.', (), [((), value)])
+        yield ('wg_agent_peers', 'gauge', 'Peers in the group.', (), [((), len(table.peers))])
+        if lazy:
+            yield ('wg_agent_lazy_active_peers', 'gauge', 'Peers woken up by traffic.', (), [((), len(lazy.active))])
+            yield ('wg_agent_lazy_activations_total', 'counter', 'Lazy peer activations.', (),
+                   [((), lazy.activations)])
+            yield ('wg_agent_lazy_deactivations_total', 'counter', 'Lazy peers put back to sleep.', (),
+                   [((), lazy.deactivations)])
+        live = reconciler.backend.dump()
+        names = {p['public_key']: p.get('name', '') for p in table.values()}
+        now = time.time()
+        labels = ('public_key', 'name')
+        yield ('wg_peer_handshake_age_seconds', 'gauge', 'Seconds since the latest handshake.', labels,
+               [((key, names.get(key, '')), now - peer['handshake'] if peer['handshake'] else None)
+                for key, peer in live.items()])
+        yield ('wg_peer_receive_bytes_total', 'counter', 'Bytes received from the peer.', labels,
+               [((key, names.get(key, '')), peer['rx']) for key, peer in live.items()])
+        yield ('wg_peer_transmit_bytes_total', 'counter', 'Bytes sent to the peer.', labels,
+               [((key, names.get(key, '')), peer['tx']) for key, peer in live.items()])
 
     async def leave_group():
         try:
-            requests.post(f'{server_url}/leave', json={"group": group, "public_key": pub})
+            await client.leave(group, pub)
         except Exception as e:
             print(f"Error leaving group: {e}")
+        finally:
+            await client.close()
         try:
-            subprocess.run(['sudo', 'wg-quick', 'down', './wg0.conf'], check=False, capture_output=True)
+            bring_down_interface()
             print('WireGuard interface brought down.')
         except Exception as e:
             print(f"Error bringing down WireGuard: {e}")
 
+    async def resync_over_http():
+        # Between websocket attempts a conditional GET keeps wg0 current;
+        # when nothing changed it costs the coordinator a 304.
+        try:
+            peers = await client.fetch_peers(group)
+        except Exception as e:
+            print(f'Peer list fetch failed: {e}')
+            return
+        epoch, revision = client.peer_list_version(group)
+        if epoch is None:
+            return
+        if epoch != table.epoch or revision > table.revision:
+            table.load(epoch, revision, peers)
+            if reg['peer_id'] not in table.peers:
+                await rejoin()
+                return
+            scheduler.submit(puncher.with_relays(table.values()))
+
     stop_event = asyncio.Event()
 
+    async def rejoin():
+        # Register again, asking for the address wg0 already has.
+        nonlocal ws_base
+        try:
+            new = await client.register(group, name, pub, *(monitor.current or (ext_ip, ext_port)),
+                                        internal_ip=internal_ip)
+        except Exception as e:
+            print(f'Could not rejoin group: {e}')
+            await asyncio.sleep(5)
+            return
+        if new['internal_ip'] != internal_ip:
+            print(f"Rejoined with a different address ({new['internal_ip']}); restart the agent to use it.")
+            stop_event.set()
+            return
+        reg.update(new)
+        ws_base = client.ws_url(group, reg['peer_id'])
+        table.load(new['epoch'], new['revision'], new['peers'])
+        scheduler.submit(puncher.with_relays(table.values()))
+        print(f"Rejoined group {group} as {reg['peer_id']}.")
+
+    heartbeat = heartbeat_interval(reg)
+
     loop = asyncio.get_running_loop()
     for sig in (signal.SIGINT, signal.SIGTERM):
         try:
@@ -122,37 +337,80 @@ async def peer_agent():
             # add_signal_handler may not be implemented on Windows
             pass
 
+    prober = probe_task = metrics_server = None
     try:
+        # These bind sockets, so they start inside the try: if a bind fails
+        # we still leave the group. RTT/loss to every peer through the
+        # tunnel, summarised for the coordinator's latency matrix.
+        prober = await start_prober(internal_ip)
+        probe_task = asyncio.create_task(probe_forever(prober, probe_targets, report_latency))
+        if METRICS_PORT:
+            metrics_server = await serve_metrics(registry, METRICS_ADDR, int(METRICS_PORT))
+            print(f'Serving metrics on http://{METRICS_ADDR}:{METRICS_PORT}/metrics')
+
         while not stop_event.is_set():
             try:
+                # Resume from our last revision; the server sends only the
+                # deltas we missed, or a snapshot if we are too far behind.
+                ws_url = ws_base + table.resume_params('&')
+                print(f'Connecting to WebSocket: {ws_url}')
                 async with websockets.connect(ws_url) as ws:
+                    live_ws['ws'] = ws
                     async def ws_receiver():
                         async for msg in ws:
+                            WS_MESSAGES.inc()
                             data = json.loads(msg)
-                            if data.get('event') == 'peer_update':
-                                new_peers = data['peers']
-                                new_config = generate_wg_config(priv, internal_ip, listen_port, new_peers)
-                                print('--- DEBUG: Received peer_update event ---')
-                                print('New peer list:', json.dumps(new_peers, indent=2))
-                                print('Regenerating WireGuard config...')
-                                save_and_apply_config(new_config)
-                                print('WireGuard config applied and interface reloaded.')
-                                print_peer_table(new_peers, internal_ip)
+                            if data.get('type') == 'activate':
+                                peer = table.peers.get(data.get('peer_id'))
+                                if lazy and peer:
+                                    lazy.activate(peer['public_key'], notify=False)
+                                continue
+                            if puncher.handle(data):
+                                continue
+                            if table.apply(data):
+                                if reg['peer_id'] not in table.peers:
+                                    raise Evicted(f"peer {reg['peer_id']} was removed")
+                                scheduler.submit(puncher.with_relays(table.values()))
 
                     ws_task = asyncio.create_task(ws_receiver())
                     stop_task = asyncio.create_task(stop_event.wait())
+                    # Keeps our lease alive on the coordinator.
+                    heartbeat_task = asyncio.create_task(send_heartbeats(ws, heartbeat)) if heartbeat else None
                     done, pending = await asyncio.wait(
                         [ws_task, stop_task],
                         return_when=asyncio.FIRST_COMPLETED
                     )
                     for task in pending:
                         task.cancel()
+                    if heartbeat_task:
+                        heartbeat_task.cancel()
                     if stop_event.is_set():
                         break
+                    ws_task.result()
+            except RevisionGap as e:
+                RECONNECTS.inc()
+                print(f'Missed peer events ({e}). Resyncing...')
+            except Evicted as e:
+                RECONNECTS.inc()
+                print(f'Removed from the group ({e}). Rejoining...')
+                await rejoin()
             except Exception as e:
+                RECONNECTS.inc()
                 print(f'WebSocket error: {e}. Reconnecting in 5 seconds...')
                 await asyncio.sleep(5)
+                await resync_over_http()
     finally:
+        scheduler_task.cancel()
+        monitor_task.cancel()
+        punch_task.cancel()
+        if probe_task:
+            probe_task.cancel()
+        if lazy_task:
+            lazy_task.cancel()
+        if prober:
+            prober.transport.close()
+        if metrics_server:
+            metrics_server.close()
         await leave_group()
         print('Peer agent stopped and left group.')
 
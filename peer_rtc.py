@@ -1,72 +1,208 @@
+"""WebRTC data channels between named peers, signaled through the coordinator.
+
+Offers, answers and ICE candidates travel over the group websocket
+(/ws/{group}?name=...), which forwards them to the named peer as soon as
+they arrive. Remote candidates may trickle in at any time. aiortc itself
+only finishes setLocalDescription() once gathering is complete, so local
+candidates go out inside the SDP; to keep that off the critical path an
+offer is gathered ahead of time and used by the next connect().
+
+Every opened channel's time-to-open (offer created or received until the
+channel is open) is kept in `open_times` and reported to the coordinator.
+
+    peer = RtcPeer('http://coord:8000', 'group', 'alice')
+    await peer.start()
+    channel = await peer.connect('bob')       # or: remote, channel = await peer.accept()
+"""
 import asyncio
+import json
+import os
 import sys
-from aiortc import RTCPeerConnection, RTCSessionDescription
+import time
+import uuid
+
+import websockets
+from aiortc import RTCConfiguration, RTCIceServer, RTCPeerConnection, RTCSessionDescription
+from aiortc.sdp import candidate_from_sdp
+
+from discovery import STUN_SERVERS
+
+# STUN servers for ICE; empty for host candidates only (e.g. on a LAN).
+RTC_STUN = os.environ.get('RTC_STUN', STUN_SERVERS[0] if STUN_SERVERS else '')
+CONNECT_TIMEOUT = 30.0
+
+
+def ice_config(stun=RTC_STUN):
+    servers = [RTCIceServer(urls=f'stun:{url}') for url in stun.split(',') if url]
+    return RTCConfiguration(iceServers=servers)
 
-async def run():
-    pc = RTCPeerConnection()
 
-    @pc.on("connectionstatechange")
-    async def on_connectionstatechange():
-        print("Connection state is", pc.connectionState)
-        if pc.connectionState == "connected":
-            print("Peers are connected!")
-        elif pc.connectionState in ("failed", "closed", "disconnected"):
+class RtcPeer:
+    def __init__(self, server_url, group, name, stun=RTC_STUN, label='data'):
+        self.ws_url = server_url.rstrip('/').replace('http', 'ws', 1) + f'/ws/{group}?name={name}'
+        self.name = name
+        self.stun = stun
+        self.label = label
+        self.ws = None
+        self.reader = None
+        self.sessions = {}  # session id -> RTCPeerConnection
+        self.answers = {}  # session id -> future for the remote answer
+        self.incoming = asyncio.Queue()  # (remote name, open channel)
+        self.spare = None  # task gathering the next offer
+        self.open_times = {}  # remote name -> seconds to open the last channel
+
+    async def start(self):
+        self.ws = await websockets.connect(self.ws_url)
+        self.reader = asyncio.create_task(self._read())
+        self.spare = asyncio.create_task(self._prepare_offer())
+
+    async def close(self):
+        for task in (self.reader, self.spare):
+            if task:
+                task.cancel()
+        for pc in self.sessions.values():
             await pc.close()
-            print("Connection closed.")
+        if self.spare and self.spare.done() and not self.spare.cancelled() and not self.spare.exception():
+            await self.spare.result()[0].close()
+        if self.ws:
+            await self.ws.close()
 
-    # Data channel for testing
-    async def send_pings(channel, label):
-        count = 0
-        while True:
-            await asyncio.sleep(2)
-            msg = f"ping {count} from {label}"
-            channel.send(msg)
-            print(f"[Sent] {msg}")
-            count += 1
-
-    if len(sys.argv) > 1 and sys.argv[1] == "offer":
-        channel = pc.createDataChannel("chat")
-        @channel.on("open")
-        def on_open():
-            print("Data channel is open!")
-            channel.send("Hello from offerer!")
-            asyncio.create_task(send_pings(channel, "offerer"))
-        @channel.on("message")
-        def on_message(message):
-            print("[Received]", message)
-        offer = await pc.createOffer()
-        await pc.setLocalDescription(offer)
-        print("\n=== Paste this offer to the other peer ===\n")
-        print(pc.localDescription.sdp)
-        print("\n=== End offer ===\n")
-        print("Paste the answer SDP:")
-        answer_sdp = sys.stdin.read()
-        answer = RTCSessionDescription(sdp=answer_sdp, type="answer")
-        await pc.setRemoteDescription(answer)
-    else:
-        print("Paste the offer SDP:")
-        offer_sdp = sys.stdin.read()
-        print(offer_sdp)
-        offer = RTCSessionDescription(sdp=offer_sdp, type="offer")
-        await pc.setRemoteDescription(offer)
-        answer = await pc.createAnswer()
-        await pc.setLocalDescription(answer)
-        print("\n=== Paste this answer to the offer peer ===\n")
-        print(pc.localDescription.sdp)
-        print("\n=== End answer ===\n")
-        @pc.on("datachannel")
-        def on_datachannel(channel):
-            @channel.on("open")
-            def on_open():
-                print("Data channel is open!")
-                channel.send("Hello from answerer!")
-                asyncio.create_task(send_pings(channel, "answerer"))
-            @channel.on("message")
-            def on_message(message):
-                print("[Received]", message)
-    # Keep the event loop running
+    async def _send(self, message):
+        await self.ws.send(json.dumps(message))
+
+    async def _signal(self, to, session, kind, data):
+        await self._send({'type': 'signal', 'to': to, 'session': session, 'kind': kind, 'data': data})
+
+    async def _prepare_offer(self):
+        pc = RTCPeerConnection(ice_config(self.stun))
+        channel = pc.createDataChannel(self.label)
+        await pc.setLocalDescription(await pc.createOffer())  # gathers candidates
+        return pc, channel
+
+    async def _opened(self, channel, remote, started):
+        if channel.readyState != 'open':
+            opened = asyncio.get_running_loop().create_future()
+            channel.once('open', lambda: opened.done() or opened.set_result(None))
+            await opened
+        seconds = time.perf_counter() - started
+        self.open_times[remote] = seconds
+        print(f'Data channel with {remote} open after {seconds * 1000:.0f} ms')
+        try:
+            await self._send({'type': 'rtc_open', 'peer': remote, 'seconds': round(seconds, 4)})
+        except websockets.ConnectionClosed:
+            pass
+        return channel
+
+    async def connect(self, remote, timeout=CONNECT_TIMEOUT):
+        """Opens a data channel to the named peer; returns it once open."""
+        started = time.perf_counter()
+        pc, channel = await self.spare
+        self.spare = asyncio.create_task(self._prepare_offer())
+        session = uuid.uuid4().hex
+        self.sessions[session] = pc
+        answer = self.answers[session] = asyncio.get_running_loop().create_future()
+        try:
+            await self._signal(remote, session, 'offer', {'sdp': pc.localDescription.sdp, 'type': 'offer'})
+            async with asyncio.timeout(timeout):
+                await pc.setRemoteDescription(RTCSessionDescription(**await answer))
+                return await self._opened(channel, remote, started)
+        except BaseException:
+            self.sessions.pop(session, None)
+            await pc.close()
+            raise
+        finally:
+            self.answers.pop(session, None)
+
+    async def accept(self):
+        """Waits for a peer to connect; returns (remote name, open channel)."""
+        return await self.incoming.get()
+
+    async def _answer(self, message):
+        started = time.perf_counter()
+        remote, session = message['from'], message['session']
+        pc = RTCPeerConnection(ice_config(self.stun))
+        self.sessions[session] = pc
+        channel_ready = asyncio.get_running_loop().create_future()
+        pc.on('datachannel', lambda channel: channel_ready.done() or channel_ready.set_result(channel))
+        try:
+            await pc.setRemoteDescription(RTCSessionDescription(**message['data']))
+            await pc.setLocalDescription(await pc.createAnswer())
+            await self._signal(remote, session, 'answer', {'sdp': pc.localDescription.sdp, 'type': 'answer'})
+            async with asyncio.timeout(CONNECT_TIMEOUT):
+                channel = await self._opened(await channel_ready, remote, started)
+        except Exception as e:
+            print(f'Could not answer {remote}: {e!r}')
+            self.sessions.pop(session, None)
+            await pc.close()
+            return
+        await self.incoming.put((remote, channel))
+
+    async def _candidate(self, message):
+        pc = self.sessions.get(message['session'])
+        if pc is None:
+            return
+        data = message['data']
+        if data is None:
+            await pc.addIceCandidate(None)  # end of candidates
+            return
+        candidate = candidate_from_sdp(data['candidate'].split(':', 1)[1])
+        candidate.sdpMid = data.get('sdpMid')
+        candidate.sdpMLineIndex = data.get('sdpMLineIndex')
+        await pc.addIceCandidate(candidate)
+
+    async def _read(self):
+        async for text in self.ws:
+            message = json.loads(text)
+            kind = message.get('type')
+            if kind == 'signal':
+                if message['kind'] == 'offer':
+                    asyncio.create_task(self._answer(message))
+                elif message['kind'] == 'answer':
+                    future = self.answers.get(message['session'])
+                    if future and not future.done():
+                        future.set_result(message['data'])
+                elif message['kind'] == 'candidate':
+                    try:
+                        await self._candidate(message)
+                    except Exception as e:
+                        print(f"Bad ICE candidate from {message.get('from')}: {e!r}")
+            elif kind == 'signal_error':
+                future = self.answers.get(message.get('session'))
+                if future and not future.done():
+                    future.set_exception(ConnectionError(f"{message.get('to')}: {message.get('error')}"))
+
+
+async def send_pings(channel, label):
+    count = 0
     while True:
-        await asyncio.sleep(1)
+        await asyncio.sleep(2)
+        msg = f"ping {count} from {label}"
+        channel.send(msg)
+        print(f"[Sent] {msg}")
+        count += 1
+
+
+def chat(channel, label):
+    channel.on('message', lambda message: print("[Received]", message))
+    channel.send(f"Hello from {label}!")
+    asyncio.create_task(send_pings(channel, label))
+
+
+async def run(server_url, group, name, remote=None):
+    peer = RtcPeer(server_url, group, name)
+    await peer.start()
+    try:
+        if remote:
+            chat(await peer.connect(remote), name)
+        while True:
+            remote, channel = await peer.accept()
+            chat(channel, name)
+    finally:
+        await peer.close()
+
 
 if __name__ == "__main__":
-    asyncio.run(run())
+    if len(sys.argv) not in (4, 5):
+        print("Usage: python peer_rtc.py <coord_url> <group> <name> [remote_name]")
+        sys.exit(1)
+    asyncio.run(run(*sys.argv[1:]))
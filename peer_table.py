@@ -0,0 +1,56 @@
+class RevisionGap(Exception):
+    pass
+
+
+class Evicted(Exception):
+    """The coordinator removed us, e.g. our lease ran out while suspended."""
+
+
+class PeerTable:
+    """Local copy of a group's peers, kept current from the coordinator's
+    versioned peer_* event stream."""
+
+    def __init__(self):
+        self.epoch = None
+        self.revision = 0
+        self.peers = {}  # peer_id -> peer_info
+
+    def load(self, epoch, revision, peers):
+        self.epoch = epoch
+        self.revision = revision
+        self.peers = {p['peer_id']: p for p in peers}
+
+    def values(self):
+        return list(self.peers.values())
+
+    def resume_params(self, sep='?'):
+        if self.epoch is None:
+            return ''
+        return f'{sep}since={self.revision}&epoch={self.epoch}'
+
+    def apply(self, event):
+        """Applies one event, returning True if the peer set changed."""
+        kind = event.get('event')
+        if kind == 'peer_snapshot':
+            self.load(event['epoch'], event['revision'], event['peers'])
+            return True
+        if kind not in ('peer_added', 'peer_removed', 'peers_removed', 'peer_endpoint_changed'):
+            return False
+        revision = event['revision']
+        if revision <= self.revision:
+            return False
+        if revision != self.revision + 1:
+            raise RevisionGap(f'expected revision {self.revision + 1}, got {revision}')
+        self.revision = revision
+        if kind == 'peer_added':
+            self.peers[event['peer']['peer_id']] = event['peer']
+        elif kind == 'peer_removed':
+            self.peers.pop(event['peer_id'], None)
+        elif kind == 'peers_removed':
+            for peer_id in event['peer_ids']:
+                self.peers.pop(peer_id, None)
+        elif event['peer_id'] in self.peers:
+            peer = self.peers[event['peer_id']]
+            peer['external_ip'] = event['external_ip']
+            peer['external_port'] = event['external_port']
+        return True
@@ -1,7 +1,6 @@
 
 
 
-import stun
 from pytun import TunTapDevice, IFF_TUN, IFF_NO_PI
 import os
 import fcntl
@@ -10,7 +9,16 @@ import threading
 import json
 import time
 import sys
-nat_type, external_ip, external_port = stun.get_ip_info(stun_host='stun.l.google.com', stun_port=19302)
+import asyncio
+import ipaddress
+import websockets
+from batch_io import BatchReceiver, BatchSender, FRAME_CONTROL, FRAME_DATA, read_batch
+from coord_client import CoordClient, heartbeat_interval, send_heartbeats
+from discovery import get_public_info
+from multiqueue import WorkerPool, configure_tun, open_tun_queues
+from peer_table import Evicted, PeerTable, RevisionGap
+from routing import routes_from_peers
+from tunnel_crypto import FRAME_SEALED, TunnelCrypto, load_private_key, public_key_b64
 
 
 
@@ -22,6 +30,7 @@ PEER_CONFIGS = {
         "PEER_PORT": 54320,
         "MY_VPN_IP": "10.8.0.1",
         "PEER_VPN_IP": "10.8.0.2",
+        "PEER_PUBLIC_KEY": None,  # peer2's tunnel key, printed at its startup
     },
     "peer2": {
         "MY_PORT": 54320,
@@ -29,9 +38,18 @@ PEER_CONFIGS = {
         "PEER_PORT": 54320,
         "MY_VPN_IP": "10.8.0.2",
         "PEER_VPN_IP": "10.8.0.1",
+        "PEER_PUBLIC_KEY": None,  # peer1's tunnel key, printed at its startup
     }
 }
 VPN_NETMASK = '255.255.255.0'
+# Port the mesh mode listens on (and registers with the coordinator).
+MESH_PORT = 54320
+# Worker processes for the data plane. Above 1 the TUN device is opened
+# multi-queue with one queue and one SO_REUSEPORT socket per worker.
+VPN_WORKERS = int(os.environ.get('VPN_WORKERS', '1'))
+# Seal every tunnelled packet with ChaCha20-Poly1305 (see tunnel_crypto).
+# While on, plaintext data frames are dropped.
+VPN_ENCRYPT = os.environ.get('VPN_ENCRYPT', '1') != '0'
 
 
 def is_valid_ip_packet(data):
@@ -44,78 +62,269 @@ def is_valid_ip_packet(data):
 
 
 
-def main():
-    if len(sys.argv) != 2 or sys.argv[1] not in PEER_CONFIGS:
-        print("Usage: sudo python peer_vpn.py [peer1|peer2]")
-        sys.exit(1)
-    peer = sys.argv[1]
-    config = PEER_CONFIGS[peer]
-
-    nat_type, external_ip, external_port = stun.get_ip_info(stun_host='stun.l.google.com', stun_port=19302)
-    print(f"NAT Type: {nat_type}")
-    print(f"External IP: {external_ip}")
-    print(f"External Port: {external_port}")
+# Set up TUN device
+def setup_tun(my_ip, netmask, dstaddr=None):
+    tun = TunTapDevice(flags=IFF_TUN | IFF_NO_PI)
+    tun.addr = my_ip
+    if dstaddr:
+        tun.dstaddr = dstaddr
+    tun.netmask = netmask
+    tun.mtu = 1400
+    tun.up()
+    print(f"TUN device {tun.name} set up with IP {my_ip}")
+    return tun
 
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.bind(('', config["MY_PORT"]))
 
+def send_control(sock, message, dest):
+    sock.sendto(bytes([FRAME_CONTROL]) + json.dumps(message).encode(), dest)
 
-    # Set up TUN device
-    def setup_tun():
-        tun = TunTapDevice(flags=IFF_TUN | IFF_NO_PI)
-        tun.addr = config["MY_VPN_IP"]
-        tun.dstaddr = config["PEER_VPN_IP"]
-        tun.netmask = VPN_NETMASK
-        tun.mtu = 1400
-        tun.up()
-        print(f"TUN device {tun.name} set up with IP {config['MY_VPN_IP']}")
-        return tun
 
+def handle_control(sock, payload, addr, name):
+    message = json.loads(payload)
+    print(f"[RECV] From {addr}: {message}")
+    if message.get("type") == "ping":
+        response = {
+            "type": "pong",
+            "timestamp": time.time(),
+            "from": name
+        }
+        send_control(sock, response, addr)
 
 
-    # Listen for UDP packets and write to TUN if it's a VPN packet
-    def udp_listener(tun):
-        while True:
-            data, addr = sock.recvfrom(4096)
-            # Try to decode as control message
-            try:
-                message = json.loads(data.decode())
-                print(f"[RECV] From {addr}: {message}")
-                if message.get("type") == "ping":
-                    response = {
-                        "type": "pong",
-                        "timestamp": time.time(),
-                        "from": peer
-                    }
-                    sock.sendto(json.dumps(response).encode(), (config["PEER_IP"], config["PEER_PORT"]))
-            except Exception:
-                # Not a control message, treat as VPN packet
-                if is_valid_ip_packet(data):
+# Listen for UDP packets; the framing byte says whether each one is a
+# tunnelled IP packet for the TUN device or a control message.
+def udp_listener(sock, tun_fd, name, crypto=None):
+    rx = BatchReceiver(sock)
+    # Decrypted packets land here, never in a fresh bytes object.
+    plain = memoryview(bytearray(rx.slot_size))
+    while True:
+        for frame, slot in rx.recv():
+            if not frame:
+                continue
+            if frame[0] == FRAME_SEALED and crypto:
+                n = crypto.open(frame, plain)
+                if n < 0:
+                    print(f"[DROP] Unauthenticated or replayed packet from {rx.source(slot)}")
+                elif is_valid_ip_packet(plain[:n]):
                     try:
-                        tun.write(data)
-                    except Exception as e:
+                        os.write(tun_fd, plain[:n])
+                    except OSError as e:
+                        print(f"[TUN WRITE ERROR] {e}")
+            elif frame[0] == FRAME_DATA and crypto:
+                print(f"[DROP] Plaintext packet from {rx.source(slot)} while encryption is on")
+            elif frame[0] == FRAME_DATA:
+                packet = frame[1:]
+                if is_valid_ip_packet(packet):
+                    try:
+                        os.write(tun_fd, packet)
+                    except OSError as e:
                         print(f"[TUN WRITE ERROR] {e}")
                 else:
-                    print(f"[DROP] Non-IP packet received from {addr}, length={len(data)}")
+                    print(f"[DROP] Non-IP packet received from {rx.source(slot)}, length={len(packet)}")
+            elif frame[0] == FRAME_CONTROL:
+                try:
+                    handle_control(sock, bytes(frame[1:]), rx.source(slot), name)
+                except ValueError:
+                    print(f"[DROP] Malformed control message from {rx.source(slot)}")
+            else:
+                print(f"[DROP] Unknown frame type {frame[0]} from {rx.source(slot)}")
 
 
+def sealer(crypto, static_peer=None):
+    # Packets are sealed for the peer owning their destination address, or
+    # for static_peer (an internal IP) on a point-to-point link.
+    if static_peer:
+        peer = int.from_bytes(socket.inet_aton(static_peer), 'big')
+        return lambda packet, buf: crypto.seal(packet, buf, peer)
+    return lambda packet, buf: crypto.seal(packet, buf, int.from_bytes(packet[16:20], 'big'))
 
-    def tun_reader(tun):
-        while True:
-            try:
-                packet = tun.read(tun.mtu)
-                # Send raw IP packet to peer
-                sock.sendto(packet, (config["PEER_IP"], config["PEER_PORT"]))
-            except Exception as e:
-                print(f"[TUN READ ERROR] {e}")
 
+def tun_reader(sock, tun_fd, dest_for, seal=None):
+    # Drain the TUN device into one sendmmsg batch at a time. dest_for maps
+    # each packet to the UDP endpoint of the peer it is for.
+    tx = BatchSender(sock)
+    os.set_blocking(tun_fd, False)
+    while True:
+        try:
+            read_batch(tun_fd, tx, dest_for, seal)
+        except OSError as e:
+            print(f"[TUN READ ERROR] {e}")
 
-    tun = setup_tun()
 
+def start_data_plane(sock, tun_fd, dest_for, name, crypto=None, static_peer=None):
+    seal = sealer(crypto, static_peer) if crypto else None
     # Start UDP listener (for both control and VPN packets)
-    threading.Thread(target=udp_listener, args=(tun,), daemon=True).start()
+    threading.Thread(target=udp_listener, args=(sock, tun_fd, name, crypto), daemon=True).start()
     # Start TUN reader (to send VPN packets)
-    threading.Thread(target=tun_reader, args=(tun,), daemon=True).start()
+    threading.Thread(target=tun_reader, args=(sock, tun_fd, dest_for, seal), daemon=True).start()
+
+
+def start_workers(workers, port, my_ip, netmask, name, dstaddr=None, static_dest=None,
+                  private_key=None, static_peers=None):
+    # Multi-core data plane: worker processes get their peer list (for the
+    # routing table and session keys) over a pipe unless every packet goes
+    # to static_dest. Each worker seals under its own epoch.
+    tun_name, tun_fds = open_tun_queues('tun%d', workers)
+    configure_tun(tun_name, my_ip, netmask, dstaddr)
+
+    def run(index, sock, tun_fd, conn):
+        router = {'routes': routes_from_peers([], my_ip)}
+        crypto = TunnelCrypto(private_key, my_ip) if private_key else None
+        if crypto and static_peers:
+            crypto.set_peers(static_peers)
+        if static_dest:
+            dest_for = lambda packet: static_dest
+        else:
+            dest_for = lambda packet: router['routes'].lookup_packet(packet)
+
+        def receive_routes():
+            while True:
+                peers = conn.recv()
+                if crypto:
+                    crypto.set_peers(peers)
+                router['routes'] = routes_from_peers(peers, my_ip)
+
+        threading.Thread(target=receive_routes, daemon=True).start()
+        threading.Thread(target=udp_listener, args=(sock, tun_fd, name, crypto), daemon=True).start()
+        seal = sealer(crypto, dstaddr if static_dest else None) if crypto else None
+        tun_reader(sock, tun_fd, dest_for, seal)
+
+    pool = WorkerPool(tun_fds, port, run)
+    print(f"Started {len(pool)} data plane workers on {tun_name}")
+    return pool
+
+
+async def run_mesh(server_url, group, name, my_port, my_external_ip, my_external_port):
+    # The tunnel's X25519 public key doubles as our identity with the
+    # coordinator, so every peer entry carries the key to seal packets with.
+    private_key = load_private_key()
+    identity = public_key_b64(private_key)
+    async with CoordClient(server_url) as client:
+        reg = await client.register(group, name, identity, my_external_ip, my_external_port)
+        internal_ip = reg['internal_ip']
+        netmask = str(ipaddress.ip_network(reg.get('subnet', '10.0.0.0/24')).netmask)
+        table = PeerTable()
+        table.load(reg['epoch'], reg['revision'], reg['peers'])
+        # Swapped wholesale on every change; the TUN reader thread always
+        # sees a complete table.
+        router = {'routes': routes_from_peers(table.values(), internal_ip)}
+
+        crypto = None
+        if VPN_WORKERS > 1:
+            pool = start_workers(VPN_WORKERS, my_port, internal_ip, netmask, name,
+                                 private_key=private_key if VPN_ENCRYPT else None)
+            pool.publish(table.values())
+        else:
+            pool = None
+            if VPN_ENCRYPT:
+                crypto = TunnelCrypto(private_key, internal_ip)
+                crypto.set_peers(table.values())
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(('', my_port))
+            tun = setup_tun(internal_ip, netmask)
+            start_data_plane(sock, tun.fileno(), lambda packet: router['routes'].lookup_packet(packet), name,
+                             crypto)
+        print(f"Routing to {len(router['routes'])} peers")
+
+        def publish():
+            if crypto:
+                crypto.set_peers(table.values())
+            router['routes'] = routes_from_peers(table.values(), internal_ip)
+            if pool:
+                pool.publish(table.values())
+            print(f"Routing to {len(router['routes'])} peers (revision {table.revision})")
+
+        async def rejoin():
+            # Register again with the address the TUN device already has.
+            try:
+                new = await client.register(group, name, identity, my_external_ip, my_external_port,
+                                            internal_ip=internal_ip)
+            except Exception as e:
+                print(f"Could not rejoin group: {e}")
+                await asyncio.sleep(5)
+                return True
+            if new['internal_ip'] != internal_ip:
+                print(f"Rejoined with a different address ({new['internal_ip']}); restart to use it.")
+                return False
+            reg.update(new)
+            table.load(new['epoch'], new['revision'], new['peers'])
+            publish()
+            print(f"Rejoined group {group} as {reg['peer_id']}.")
+            return True
+
+        heartbeat = heartbeat_interval(reg)
+        try:
+            while True:
+                try:
+                    ws_url = client.ws_url(group, reg['peer_id']) + table.resume_params('&')
+                    async with websockets.connect(ws_url) as ws:
+                        # Renews our lease; the coordinator drops peers that stop.
+                        heartbeat_task = asyncio.create_task(send_heartbeats(ws, heartbeat)) if heartbeat else None
+                        try:
+                            async for msg in ws:
+                                if table.apply(json.loads(msg)):
+                                    if reg['peer_id'] not in table.peers:
+                                        raise Evicted(f"peer {reg['peer_id']} was removed")
+                                    publish()
+                        finally:
+                            if heartbeat_task:
+                                heartbeat_task.cancel()
+                except RevisionGap as e:
+                    print(f"Missed peer events ({e}). Resyncing...")
+                except Evicted as e:
+                    print(f"Removed from the group ({e}). Rejoining...")
+                    if not await rejoin():
+                        break
+                except Exception as e:
+                    print(f"WebSocket error: {e}. Reconnecting in 5 seconds...")
+                    await asyncio.sleep(5)
+        finally:
+            await client.leave(group, identity)
+
+
+def main():
+    if len(sys.argv) >= 5 and sys.argv[1] == "mesh":
+        server_url, group, name = sys.argv[2:5]
+        my_port = int(sys.argv[5]) if len(sys.argv) > 5 else MESH_PORT
+        external_ip, external_port = get_public_info(my_port)
+        if external_ip is None:
+            print("Could not determine external IP/port. Exiting.")
+            sys.exit(1)
+        asyncio.run(run_mesh(server_url, group, name, my_port, external_ip, external_port))
+        return
+    if len(sys.argv) != 2 or sys.argv[1] not in PEER_CONFIGS:
+        print("Usage: sudo python peer_vpn.py [peer1|peer2]")
+        print("       sudo python peer_vpn.py mesh <coord_url> <group> <name> [port]")
+        sys.exit(1)
+    peer = sys.argv[1]
+    config = PEER_CONFIGS[peer]
+
+    get_public_info(config["MY_PORT"])
+
+    peer_addr = (config["PEER_IP"], config["PEER_PORT"])
+    private_key = None
+    static_peers = None
+    if VPN_ENCRYPT:
+        private_key = load_private_key()
+        print(f"Tunnel public key: {public_key_b64(private_key)}")
+        if config.get("PEER_PUBLIC_KEY"):
+            static_peers = [{"internal_ip": config["PEER_VPN_IP"], "public_key": config["PEER_PUBLIC_KEY"]}]
+        else:
+            print("No PEER_PUBLIC_KEY configured, running the tunnel unencrypted.")
+            private_key = None
+    if VPN_WORKERS > 1:
+        start_workers(VPN_WORKERS, config["MY_PORT"], config["MY_VPN_IP"], VPN_NETMASK, peer,
+                      dstaddr=config["PEER_VPN_IP"], static_dest=peer_addr,
+                      private_key=private_key, static_peers=static_peers)
+    else:
+        crypto = None
+        if private_key:
+            crypto = TunnelCrypto(private_key, config["MY_VPN_IP"])
+            crypto.set_peers(static_peers)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('', config["MY_PORT"]))
+        tun = setup_tun(config["MY_VPN_IP"], VPN_NETMASK, config["PEER_VPN_IP"])
+        start_data_plane(sock, tun.fileno(), lambda packet: peer_addr, peer, crypto, config["PEER_VPN_IP"])
 
     # Optionally, send an initial ping to peer to open NAT
     # message = {
@@ -123,7 +332,7 @@ def main():
     #     "timestamp": time.time(),
     #     "from": peer
     # }
-    # sock.sendto(json.dumps(message).encode(), (config["PEER_IP"], config["PEER_PORT"]))
+    # send_control(sock, message, peer_addr)
 
     # Keep process alive
     while True:
@@ -0,0 +1,84 @@
+import socket
+
+
+def parse_cidr(cidr):
+    if '/' in cidr:
+        address, length = cidr.split('/')
+        length = int(length)
+    else:
+        address, length = cidr, 32
+    mask = (0xFFFFFFFF << (32 - length)) & 0xFFFFFFFF
+    return int.from_bytes(socket.inet_aton(address), 'big') & mask, length
+
+
+class RoutingTable:
+    """IPv4 longest-prefix-match table for per-packet forwarding.
+
+    Host routes (/32, one per mesh peer) live in a single dict keyed by the
+    destination as an int, so the common case is one hash lookup. Shorter
+    prefixes get one dict per prefix length, probed longest first."""
+
+    def __init__(self):
+        self.hosts = {}  # dst int -> value
+        self.prefixes = {}  # prefix length -> {network int: value}
+        self.lengths = []  # (length, mask) longest first
+
+    def __len__(self):
+        return len(self.hosts) + sum(len(t) for t in self.prefixes.values())
+
+    def add(self, cidr, value):
+        network, length = parse_cidr(cidr)
+        if length == 32:
+            self.hosts[network] = value
+            return
+        if length not in self.prefixes:
+            self.prefixes[length] = {}
+            self._reindex()
+        self.prefixes[length][network] = value
+
+    def remove(self, cidr):
+        network, length = parse_cidr(cidr)
+        if length == 32:
+            self.hosts.pop(network, None)
+            return
+        table = self.prefixes.get(length)
+        if table is not None:
+            table.pop(network, None)
+            if not table:
+                del self.prefixes[length]
+                self._reindex()
+
+    def _reindex(self):
+        self.lengths = [
+            (length, (0xFFFFFFFF << (32 - length)) & 0xFFFFFFFF)
+            for length in sorted(self.prefixes, reverse=True)
+        ]
+
+    def lookup_int(self, dst):
+        value = self.hosts.get(dst)
+        if value is not None:
+            return value
+        for length, mask in self.lengths:
+            value = self.prefixes[length].get(dst & mask)
+            if value is not None:
+                return value
+        return None
+
+    def lookup(self, address):
+        return self.lookup_int(int.from_bytes(socket.inet_aton(address), 'big'))
+
+    def lookup_packet(self, packet):
+        """Route for an IPv4 packet, by its destination address (bytes 16-19)."""
+        if len(packet) < 20:
+            return None
+        return self.lookup_int(int.from_bytes(packet[16:20], 'big'))
+
+
+def routes_from_peers(peers, my_ip):
+    """Host route to each peer's internal_ip via its external endpoint."""
+    table = RoutingTable()
+    for peer in peers:
+        if peer['internal_ip'] == my_ip:
+            continue
+        table.add(peer['internal_ip'], (peer['external_ip'], peer['external_port']))
+    return table
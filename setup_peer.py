@@ -1,38 +1,14 @@
 import os
 import subprocess
-import requests
+import asyncio
 import json
+from coord_client import CoordClient
 from discovery import get_public_info
+from wgkeys import generate_keypair, load_or_create
 
-def generate_keys():
-    if not os.path.exists('privatekey'):
-        priv = subprocess.check_output(['wg', 'genkey']).decode().strip()
-        with open('privatekey', 'w') as f:
-            f.write(priv)
-        pub = subprocess.check_output(['wg', 'pubkey'], input=priv.encode()).decode().strip()
-        with open('publickey', 'w') as f:
-            f.write(pub)
-    else:
-        with open('privatekey') as f:
-            priv = f.read().strip()
-        with open('publickey') as f:
-            pub = f.read().strip()
-    return priv, pub
-
-def register_with_server(server_url, group, public_key, external_ip, external_port):
-    resp = requests.post(f'{server_url}/register', json={
-        'group': group,
-        'public_key': public_key,
-        'external_ip': external_ip,
-        'external_port': external_port
-    })
-    resp.raise_for_status()
-    return resp.json()
-
-def fetch_peers(server_url, group):
-    resp = requests.get(f'{server_url}/peers/{group}')
-    resp.raise_for_status()
-    return resp.json()
+async def register_with_server(server_url, group, name, public_key, external_ip, external_port):
+    async with CoordClient(server_url) as client:
+        return await client.register(group, name, public_key, external_ip, external_port)
 
 def generate_wg_config(private_key, internal_ip, listen_port, peers):
     config = [
@@ -58,10 +34,11 @@ def generate_wg_config(private_key, internal_ip, listen_port, peers):
 def main():
     server_url = input('Coord server URL (e.g. http://localhost:8000): ').strip()
     group = input('Group name: ').strip()
+    name = input('Your name: ').strip()
     listen_port = int(input('WireGuard listen port (e.g. 54320): ').strip())
-    priv, pub = generate_keys()
-    ext_ip, ext_port = get_public_info()
-    reg = register_with_server(server_url, group, pub, ext_ip, listen_port)
+    priv, pub = load_or_create()
+    ext_ip, ext_port = get_public_info(listen_port)
+    reg = asyncio.run(register_with_server(server_url, group, name, pub, ext_ip, ext_port))
     internal_ip = reg['internal_ip']
     peers = reg['peers']
     config = generate_wg_config(priv, internal_ip, listen_port, peers)
@@ -80,14 +57,10 @@ def main():
 
 main()
 import subprocess
-import os
 
 def generate_keys():
     """Generates WireGuard Private and Public keys."""
-    # We use subprocess to call the 'wg' command
-    priv_key = subprocess.check_output(["wg", "genkey"]).decode("utf-8").strip()
-    pub_key = subprocess.check_output(["wg", "pubkey"], input=priv_key.encode()).decode("utf-8").strip()
-    return priv_key, pub_key
+    return generate_keypair()
 
 def create_config(my_private_key, my_ip, my_port, peer_public_key, peer_endpoint, peer_internal_ip):
     """Generates a WireGuard config string."""
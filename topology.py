@@ -0,0 +1,111 @@
+"""Which peers a node puts on its WireGuard interface.
+
+In the default full mesh that is every other member of the group. In
+sharded mode the group subnet is split into aligned blocks of `shard_size`
+addresses:
+
+- The members of a block peer with each other directly.
+- The member with the lowest address is the block's hub. Hubs also peer
+  with every other hub and forward traffic between blocks. Each remote hub
+  carries its whole block in AllowedIPs.
+- Everyone else (a spoke) routes the rest of the group subnet through its
+  own hub.
+
+A node therefore configures at most shard_size + blocks peers instead of
+N. With shard_size near sqrt(N), config size and keepalive traffic grow
+with sqrt(N).
+
+Every node derives the same hubs from the same peer list, so no extra
+coordination is needed. When a hub leaves, the next-lowest member of its
+block takes over on the next update.
+"""
+import ipaddress
+import socket
+from collections import namedtuple
+
+FULL = 'full'
+SHARDED = 'sharded'
+DEFAULT_SHARD_SIZE = 64
+
+Neighbor = namedtuple('Neighbor', ['peer', 'allowed_ips'])
+
+
+def _ip(address):
+    return int.from_bytes(socket.inet_aton(address), 'big')
+
+
+class Topology:
+    def __init__(self, mode=FULL, shard_size=DEFAULT_SHARD_SIZE, subnet='10.0.0.0/24'):
+        if mode not in (FULL, SHARDED):
+            raise ValueError(f'unknown topology mode {mode!r}')
+        if shard_size < 2 or shard_size & (shard_size - 1):
+            raise ValueError(f'shard size must be a power of two, got {shard_size}')
+        self.mode = mode
+        self.shard_size = shard_size
+        self.subnet = ipaddress.IPv4Network(subnet)
+        self.shard_prefix = max(self.subnet.prefixlen, 32 - shard_size.bit_length() + 1)
+        self.mask = (0xFFFFFFFF << (32 - self.shard_prefix)) & 0xFFFFFFFF
+
+    @classmethod
+    def from_registration(cls, reg):
+        """The coordinator decides the topology for the whole group and
+        returns it with /register."""
+        settings = reg.get('topology') or {}
+        return cls(settings.get('mode', FULL), settings.get('shard_size', DEFAULT_SHARD_SIZE),
+                   reg.get('subnet', '10.0.0.0/24'))
+
+    def as_dict(self):
+        return {'mode': self.mode, 'shard_size': self.shard_size}
+
+    def shard_cidr(self, shard):
+        return f'{ipaddress.IPv4Address(shard)}/{self.shard_prefix}'
+
+    def shards(self, peers):
+        """shard network int -> [hub address int, hub peer, member count]."""
+        result = {}
+        mask = self.mask
+        for peer in peers:
+            address = _ip(peer['internal_ip'])
+            current = result.get(address & mask)
+            if current is None:
+                result[address & mask] = [address, peer, 1]
+            else:
+                if address < current[0]:
+                    current[0], current[1] = address, peer
+                current[2] += 1
+        return result
+
+    def neighbors(self, internal_ip, peers):
+        """Returns ([Neighbor], forwarding): the peers to configure with their
+        AllowedIPs, and whether this node must forward for others."""
+        if self.mode == FULL:
+            return [Neighbor(p, [f'{p["internal_ip"]}/32']) for p in peers if p['internal_ip'] != internal_ip], False
+        me = _ip(internal_ip)
+        my_shard = me & self.mask
+        others = [p for p in peers if p['internal_ip'] != internal_ip]
+        shards = self.shards(others)
+        hub_address, hub, _ = shards.get(my_shard, (me, None, 0))
+        is_hub = me <= hub_address
+        result = []
+        for peer in others:
+            if _ip(peer['internal_ip']) & self.mask != my_shard:
+                continue
+            allowed = [f'{peer["internal_ip"]}/32']
+            if peer is hub and not is_hub:
+                allowed.append(str(self.subnet))  # everything outside our shard
+            result.append(Neighbor(peer, allowed))
+        if is_hub:
+            for shard, (_, other_hub, _) in shards.items():
+                if shard != my_shard:
+                    result.append(Neighbor(other_hub, [self.shard_cidr(shard)]))
+        return result, is_hub and any(shard != my_shard for shard in shards)
+
+    def describe(self, peers):
+        return {
+            'mode': self.mode,
+            'shard_size': self.shard_size,
+            'shards': {
+                self.shard_cidr(shard): {'hub': hub['internal_ip'], 'members': count}
+                for shard, (_, hub, count) in sorted(self.shards(peers).items())
+            } if self.mode == SHARDED else {},
+        }
@@ -0,0 +1,202 @@
+"""Authenticated encryption for the userspace tunnel.
+
+Each node has a static X25519 key; its public key is what it registers with
+the coordinator. Peers derive per-direction ChaCha20-Poly1305 session keys
+from the X25519 shared secret, salted with a per-process epoch that is part
+of every packet, so a restarted sender (or another worker process) never
+reuses a nonce. Every packet is authenticated, and a sliding window per
+(peer, epoch) rejects replays.
+
+Sealed frame layout (FRAME_SEALED):
+
+    type (1) | sender internal IPv4 (4) | epoch (8) | counter (8) | ciphertext + tag
+
+The 21-byte header is the associated data; the nonce is 4 zero bytes
+followed by the little-endian counter. Epochs start with a millisecond
+timestamp; a new epoch more than EPOCH_GRACE_MS older than the newest one
+seen from a peer is refused, and a peer keeps at most EPOCHS_PER_PEER
+windows. There is no handshake: keys are static-static, so there is no
+forward secrecy, and a receiver that restarts forgets its windows and will
+accept one replay of a live sender epoch's packets.
+"""
+import base64
+import secrets
+import socket
+import struct
+import time
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PublicKey
+from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+
+import wgkeys
+
+FRAME_SEALED = 0x02
+HEADER = struct.Struct('!B4s8sQ')
+HEADER_SIZE = HEADER.size
+TAG_SIZE = 16
+OVERHEAD = HEADER_SIZE + TAG_SIZE
+REPLAY_WINDOW = 2048
+EPOCH_GRACE_MS = 300_000
+EPOCHS_PER_PEER = 16
+KDF_LABEL = b'p2p-mesh-wireguard tunnel v1'
+
+
+def load_private_key(path='vpn_private.key'):
+    # Same base64 format as WireGuard keys (see wgkeys).
+    priv, _ = wgkeys.load_or_create(path, None)
+    return wgkeys.private_key_object(priv)
+
+
+def public_key_b64(private_key):
+    return wgkeys.encode(private_key.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw))
+
+
+def new_epoch():
+    millis = int(time.time() * 1000) & 0xFFFFFFFFFFFF
+    return (millis << 16 | secrets.randbits(16)).to_bytes(8, 'big')
+
+
+def epoch_millis(epoch):
+    return int.from_bytes(epoch, 'big') >> 16
+
+
+class ReplayWindow:
+    """Sliding bitmap of the last REPLAY_WINDOW counters seen (RFC 6479 style)."""
+
+    def __init__(self):
+        self.top = -1
+        self.bits = 0
+
+    def check(self, counter):
+        if counter > self.top:
+            return True
+        offset = self.top - counter
+        return offset < REPLAY_WINDOW and not (self.bits >> offset) & 1
+
+    def update(self, counter):
+        if counter > self.top:
+            self.bits = ((self.bits << (counter - self.top)) | 1) & ((1 << REPLAY_WINDOW) - 1)
+            self.top = counter
+        else:
+            self.bits |= 1 << (self.top - counter)
+
+
+class PeerSession:
+    def __init__(self, shared, my_public, peer_public, my_epoch):
+        self.shared = shared
+        self.my_public = my_public
+        self.peer_public = peer_public
+        self.send = ChaCha20Poly1305(self._derive(my_public, peer_public, my_epoch))
+        self.counter = 0
+        self.receivers = {}  # peer epoch -> (cipher, ReplayWindow)
+        self.newest_millis = 0
+
+    def _derive(self, sender, receiver, epoch):
+        return HKDF(
+            algorithm=hashes.SHA256(), length=32, salt=None,
+            info=KDF_LABEL + sender + receiver + epoch,
+        ).derive(self.shared)
+
+    def receiver(self, epoch):
+        """(cipher, window, known) for a sender epoch, or None if the epoch is
+        too old. Unknown epochs are only remembered once a packet in them
+        authenticates (see keep), so forged epochs cannot evict real ones."""
+        entry = self.receivers.get(epoch)
+        if entry is not None:
+            return entry + (True,)
+        if epoch_millis(epoch) + EPOCH_GRACE_MS < self.newest_millis:
+            return None
+        cipher = ChaCha20Poly1305(self._derive(self.peer_public, self.my_public, epoch))
+        return cipher, ReplayWindow(), False
+
+    def keep(self, epoch, cipher, window):
+        if len(self.receivers) >= EPOCHS_PER_PEER:
+            del self.receivers[min(self.receivers, key=epoch_millis)]
+        self.receivers[epoch] = (cipher, window)
+        self.newest_millis = max(self.newest_millis, epoch_millis(epoch))
+
+
+class TunnelCrypto:
+    """Seals and opens tunnel frames in place on caller-provided buffers."""
+
+    def __init__(self, private_key, my_ip):
+        self.private_key = private_key
+        self.my_public = private_key.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+        self.my_address = my_ip
+        self.my_ip = socket.inet_aton(my_ip)
+        self.epoch = new_epoch()
+        self.sessions = {}  # peer internal IPv4 as int -> PeerSession
+        # Every session of this epoch, by peer public key. A peer that leaves
+        # and comes back (or moves to another address) gets its old session
+        # back, so the send counter carries on instead of reusing nonces.
+        self.by_key = {}
+        # Sealing and opening run on different threads; one nonce buffer each.
+        self.tx_nonce = bytearray(12)
+        self.rx_nonce = bytearray(12)
+
+    def set_peers(self, peers):
+        """Keeps sessions for the current peer list, reusing any session a
+        peer's key ever had in this process."""
+        sessions = {}
+        for peer in peers:
+            if peer['internal_ip'] == self.my_address:
+                continue
+            ip = int.from_bytes(socket.inet_aton(peer['internal_ip']), 'big')
+            try:
+                peer_public = base64.b64decode(peer['public_key'])
+            except ValueError:
+                continue
+            if len(peer_public) != 32:
+                continue
+            session = self.by_key.get(peer_public)
+            if session is None:
+                shared = self.private_key.exchange(X25519PublicKey.from_public_bytes(peer_public))
+                session = PeerSession(shared, self.my_public, peer_public, self.epoch)
+                self.by_key[peer_public] = session
+            sessions[ip] = session
+        self.sessions = sessions
+
+    def seal(self, plaintext, out, dst):
+        """Encrypts `plaintext` for the peer whose internal address is `dst`
+        (an int) into `out` as a complete frame; returns its length, or 0 if
+        we have no session for that peer."""
+        session = self.sessions.get(dst)
+        if session is None:
+            return 0
+        counter = session.counter
+        session.counter += 1
+        HEADER.pack_into(out, 0, FRAME_SEALED, self.my_ip, self.epoch, counter)
+        struct.pack_into('<Q', self.tx_nonce, 4, counter)
+        end = HEADER_SIZE + len(plaintext) + TAG_SIZE
+        session.send.encrypt_into(self.tx_nonce, plaintext, out[:HEADER_SIZE], out[HEADER_SIZE:end])
+        return end
+
+    def open(self, frame, out):
+        """Authenticates and decrypts a sealed frame into `out`; returns the
+        plaintext length, or -1 if the frame is forged, replayed or unknown."""
+        if len(frame) < OVERHEAD:
+            return -1
+        _, sender, epoch, counter = HEADER.unpack_from(frame)
+        session = self.sessions.get(int.from_bytes(sender, 'big'))
+        if session is None:
+            return -1
+        entry = session.receiver(epoch)
+        if entry is None:
+            return -1
+        cipher, window, known = entry
+        if not window.check(counter):
+            return -1
+        struct.pack_into('<Q', self.rx_nonce, 4, counter)
+        length = len(frame) - OVERHEAD
+        try:
+            cipher.decrypt_into(self.rx_nonce, frame[HEADER_SIZE:], frame[:HEADER_SIZE], out[:length])
+        except InvalidTag:
+            return -1
+        window.update(counter)
+        if not known:
+            session.keep(epoch, cipher, window)
+        return length
@@ -0,0 +1,138 @@
+import subprocess
+from collections import namedtuple
+
+from topology import Topology
+
+WG_INTERFACE = 'wg0'
+PERSISTENT_KEEPALIVE = 25
+
+ReconcileResult = namedtuple('ReconcileResult', ['added', 'removed', 'updated'])
+
+
+def touched(result):
+    return len(result.added) + len(result.removed) + len(result.updated)
+
+
+def desired_peers(internal_ip, peers, topology=None):
+    """Builds the public_key -> peer settings map we want on the interface:
+    every other peer, or only our neighbors in a sharded topology."""
+    neighbors, _ = (topology or Topology()).neighbors(internal_ip, peers)
+    desired = {}
+    for peer, allowed_ips in neighbors:
+        desired[peer['public_key']] = {
+            'endpoint': f'{peer["external_ip"]}:{peer["external_port"]}',
+            'allowed_ips': ','.join(allowed_ips),
+            'keepalive': PERSISTENT_KEEPALIVE,
+        }
+    return desired
+
+
+class WgCli:
+    """Reads and writes live peer state with the `wg` tool."""
+
+    def __init__(self, interface=WG_INTERFACE):
+        self.interface = interface
+
+    def dump(self):
+        out = subprocess.run(
+            ['sudo', 'wg', 'show', self.interface, 'dump'],
+            check=True, capture_output=True, text=True
+        ).stdout
+        live = {}
+        # First line describes the interface itself, the rest are peers:
+        # public-key preshared-key endpoint allowed-ips handshake rx tx keepalive
+        for line in out.strip().splitlines()[1:]:
+            fields = line.split('\t')
+            if len(fields) < 8:
+                continue
+            pub, _, endpoint, allowed_ips, handshake, rx, tx, keepalive = fields[:8]
+            live[pub] = {
+                'endpoint': None if endpoint == '(none)' else endpoint,
+                'allowed_ips': '' if allowed_ips == '(none)' else allowed_ips,
+                'keepalive': 0 if keepalive == 'off' else int(keepalive),
+                'handshake': int(handshake),
+                'rx': int(rx),
+                'tx': int(tx),
+            }
+        return live
+
+    def handshakes(self):
+        """public key -> unix time of the latest handshake (0 for never)."""
+        out = subprocess.run(
+            ['sudo', 'wg', 'show', self.interface, 'latest-handshakes'],
+            check=True, capture_output=True, text=True
+        ).stdout
+        result = {}
+        for line in out.strip().splitlines():
+            fields = line.split('\t')
+            if len(fields) == 2:
+                result[fields[0]] = int(fields[1])
+        return result
+
+    def set_endpoint(self, key, endpoint, keepalive):
+        subprocess.run(
+            ['sudo', 'wg', 'set', self.interface, 'peer', key,
+             'endpoint', endpoint, 'persistent-keepalive', str(keepalive)],
+            check=True, capture_output=True
+        )
+
+    def set_peers(self, remove, upsert):
+        # A single `wg set` accepts any number of peer clauses, so one fork
+        # covers the whole diff.
+        args = ['sudo', 'wg', 'set', self.interface]
+        for key in remove:
+            args += ['peer', key, 'remove']
+        for key, want in upsert.items():
+            args += ['peer', key]
+            if want['endpoint']:
+                args += ['endpoint', want['endpoint']]
+            args += [
+                'allowed-ips', want['allowed_ips'],
+                'persistent-keepalive', str(want['keepalive']),
+            ]
+        subprocess.run(args, check=True, capture_output=True)
+
+
+def _same_allowed_ips(a, b):
+    return set(filter(None, a.split(','))) == set(filter(None, b.split(',')))
+
+
+class WgReconciler:
+    """Diffs a desired peer set against the live interface, keyed by public key,
+    and touches only the peers that changed."""
+
+    def __init__(self, backend=None):
+        self.backend = backend or WgCli()
+        # Last desired state we applied. WireGuard roams endpoints on its own
+        # when authenticated packets arrive from a new address, so endpoints are
+        # only pushed when the coordinator's view changed, not whenever the live
+        # endpoint differs.
+        self.applied = {}
+
+    def diff(self, live, desired):
+        added, removed, updated = [], [], []
+        for key, want in desired.items():
+            have = live.get(key)
+            if have is None:
+                added.append(key)
+                continue
+            known_endpoint = self.applied.get(key, have)['endpoint']
+            if (
+                want['endpoint'] != known_endpoint or
+                want['keepalive'] != have['keepalive'] or
+                not _same_allowed_ips(want['allowed_ips'], have['allowed_ips'])
+            ):
+                updated.append(key)
+        for key in live:
+            if key not in desired:
+                removed.append(key)
+        return ReconcileResult(added, removed, updated)
+
+    def reconcile(self, desired):
+        live = self.backend.dump()
+        result = self.diff(live, desired)
+        if touched(result):
+            upsert = {key: desired[key] for key in result.added + result.updated}
+            self.backend.set_peers(result.removed, upsert)
+        self.applied = dict(desired)
+        return result
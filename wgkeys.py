@@ -0,0 +1,82 @@
+"""WireGuard keys without the `wg` tool.
+
+Keys are Curve25519 (X25519) and travel as 44-character base64 strings,
+exactly as `wg genkey` / `wg pubkey` print them, so either side of the mesh
+can produce them.
+"""
+import base64
+import binascii
+import os
+import secrets
+
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+
+KEY_SIZE = 32
+
+
+def clamp(raw):
+    # Same clamping `wg genkey` applies, so our private keys are
+    # indistinguishable from the tool's.
+    key = bytearray(raw)
+    key[0] &= 248
+    key[31] = (key[31] & 127) | 64
+    return bytes(key)
+
+
+def key_bytes(key_b64):
+    try:
+        raw = base64.b64decode(key_b64, validate=True)
+    except binascii.Error as e:
+        raise ValueError(f'invalid WireGuard key: {e}') from None
+    if len(raw) != KEY_SIZE:
+        raise ValueError(f'invalid WireGuard key: {len(raw)} bytes, expected {KEY_SIZE}')
+    return raw
+
+
+def encode(raw):
+    return base64.b64encode(raw).decode()
+
+
+def generate_private_key():
+    return encode(clamp(secrets.token_bytes(KEY_SIZE)))
+
+
+def private_key_object(private_b64):
+    return X25519PrivateKey.from_private_bytes(key_bytes(private_b64))
+
+
+def public_key(private_b64):
+    raw = private_key_object(private_b64).public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+    return encode(raw)
+
+
+def generate_keypair():
+    priv = generate_private_key()
+    return priv, public_key(priv)
+
+
+def load_or_create(private_path='privatekey', public_path='publickey'):
+    """Returns (private, public) base64 keys, creating the files on first use.
+    The public key is always derived again, so a stale publickey file is
+    rewritten rather than trusted; public_path=None skips that file."""
+    if os.path.exists(private_path):
+        with open(private_path) as f:
+            priv = f.read().strip()
+    else:
+        priv = generate_private_key()
+        fd = os.open(private_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(priv + '\n')
+    pub = public_key(priv)
+    if public_path is None:
+        return priv, pub
+    try:
+        with open(public_path) as f:
+            current = f.read().strip()
+    except FileNotFoundError:
+        current = None
+    if current != pub:
+        with open(public_path, 'w') as f:
+            f.write(pub + '\n')
+    return priv, pub